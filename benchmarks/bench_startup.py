@@ -0,0 +1,115 @@
+"""
+Startup benchmark: measures how long every subcommand of the CLI takes to start, and which modules it imports, with
+python -X importtime. No API is called, the commands only print their help or read the local credential store.
+
+    python benchmarks/bench_startup.py --repeat 10 --results startup.json
+"""
+# standard imports
+import argparse
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# libraries import
+from harness import SRC_DIR, prepare_workdir, run_cli, save_results
+
+# the commands measured, one per subcommand
+COMMANDS = (
+    ('--help',),
+    ('folder', 'explore', '--help'),
+    ('folder', 'list', '--help'),
+    ('credential', 'add', '--help'),
+    ('credential', 'delete', '--help'),
+    ('credential', 'default', '--help'),
+    ('credential', 'list'),
+)
+
+# modules that should only be imported by the commands that need them
+HEAVY_MODULES = ('googleapiclient.discovery', 'google_auth_oauthlib.flow', 'google.auth.transport.requests',
+                 'output.gsheet', 'output.sqlite', 'tblib', 'multiprocessing.managers')
+
+
+def parse_importtime(stderr):
+    """
+    Parses the output of python -X importtime
+
+    :param stderr: the standard error of the process
+    :return: a list of tuples with the name of every module, its cumulative microseconds and whether it is a top level
+    import (not indented), the cumulative times of the top level imports add up to the total
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            # the header of the table
+            continue
+        modules.append((fields[2].strip(), int(fields[1]), not fields[2].startswith('  ')))
+    return modules
+
+
+def measure_imports(cli_args, workdir):
+    """
+    Runs a command once with python -X importtime
+
+    :param cli_args: the arguments of the CLI
+    :param workdir: the directory where the CLI is run
+    :return: a dictionary with the import time, the imported modules and the slowest top level ones
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', SRC_DIR] + list(cli_args), cwd=workdir,
+                             capture_output=True, text=True)
+    modules = parse_importtime(process.stderr)
+    imported = {name for name, _, _ in modules}
+    top_level = sorted(((name, cumulative) for name, cumulative, is_top_level in modules if is_top_level),
+                       key=lambda module: module[1], reverse=True)
+
+    return {
+        'import_seconds': sum(cumulative for _, cumulative in top_level) / 1_000_000,
+        'imported_modules': len(imported),
+        'heavy_modules': [module for module in HEAVY_MODULES if module in imported],
+        'slowest_imports': top_level[:5],
+    }
+
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix='drive-explorer-bench-')
+    prepare_workdir(workdir)
+
+    results = []
+    try:
+        for command in args.commands:
+            cli_args = command.split()
+            imports = measure_imports(cli_args, workdir)
+            for repeat_i in range(args.repeat):
+                # no request is sent, the endpoint only prevents any call to Google
+                run = run_cli(cli_args, workdir, 'http://127.0.0.1:9', timeout=60)
+                run.pop('output_tail')
+                run.update(imports)
+                run.update({'command': command, 'repeat': repeat_i})
+                results.append(run)
+
+            elapsed = sorted(run['elapsed_seconds'] for run in results if run['command'] == command)
+            print("{:<28} {:>7.3f}s (min {:.3f}s) imports {:>6.3f}s {:>4} modules heavy: {}".format(
+                command, sum(elapsed) / len(elapsed), elapsed[0], imports['import_seconds'],
+                imports['imported_modules'], ', '.join(imports['heavy_modules']) or '-'))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    params = {key: value for key, value in vars(args).items() if key != 'results'}
+    save_results(args.results, 'startup', params, results)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Startup benchmark of the drive-explorer subcommands.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--commands', type=lambda value: value.split(','), default=[' '.join(command)
+                                                                                   for command in COMMANDS],
+                        help='comma separated list of the commands to run')
+    parser.add_argument('--repeat', type=int, default=5, help='runs for every command')
+    parser.add_argument('--results', type=str, default='bench_startup.json', help='where to save the results')
+
+    run_benchmark(parser.parse_args())
@@ -0,0 +1,141 @@
+"""
+End-to-end traversal benchmark: runs the real CLI against the fake Drive server on a synthetic tree, sweeping the
+number of workers and the output formats.
+
+    python benchmarks/bench_traversal.py --depth 4 --fan-out 4 --files-per-folder 50 --workers 1,4,8 \
+        --formats csv,sqlite --results results.json
+"""
+# standard imports
+import argparse
+import json
+import os
+import shlex
+import shutil
+import tempfile
+import urllib.request
+
+# libraries import
+from fake_drive import FakeDriveServer, add_tree_arguments, state_from_args
+from harness import BENCH_USER, count_rows, prepare_workdir, run_cli, save_results
+
+
+def _server_stats(server):
+    with urllib.request.urlopen('{}/__stats'.format(server.url)) as response:
+        return json.loads(response.read())
+
+
+def _reset_server(server):
+    request = urllib.request.Request('{}/__reset'.format(server.url), data=b'', method='POST')
+    urllib.request.urlopen(request).close()
+
+
+def run_benchmark(args):
+    state = state_from_args(args)
+    tree = state.tree
+    print("Synthetic tree: {} folders, {} files".format(tree.folder_count, tree.file_count))
+
+    workdir = tempfile.mkdtemp(prefix='drive-explorer-bench-')
+
+    results = []
+    try:
+        with FakeDriveServer(state) as server:
+            # the other identities can be used by a scenario, e.g. "-u bench@example.com bench1@example.com"
+            users = [BENCH_USER] + ['bench{}@example.com'.format(user_i) for user_i in range(1, args.users)]
+            prepare_workdir(workdir, users, token_uri='{}/token'.format(server.url))
+            for scenario in args.scenarios:
+                for output_format in args.formats:
+                    for num_workers in args.workers:
+                        for repeat_i in range(args.repeat):
+                            output_path = os.path.join(workdir, 'out-{}.{}'.format(num_workers, output_format))
+                            if os.path.exists(output_path):
+                                os.remove(output_path)
+                            stats_path = os.path.join(workdir, 'stats.json')
+
+                            cli_args = ['folder', 'explore', '-id', 'root', '-o', output_path,
+                                        '-nw', num_workers, '-pi', 0, '-sf', stats_path]
+                            cli_args.extend(shlex.split(scenario))
+                            cli_args.extend(shlex.split(args.cli_args))
+
+                            _reset_server(server)
+                            run = run_cli(cli_args, workdir, server.url, args.timeout)
+                            server_stats = _server_stats(server)
+                            rows = count_rows(output_path)
+
+                            result = {
+                                'scenario': scenario,
+                                'format': output_format,
+                                'workers': num_workers,
+                                'repeat': repeat_i,
+                                'elapsed_seconds': run['elapsed_seconds'],
+                                'folders_per_second': (tree.folder_count + 1) / run['elapsed_seconds'],
+                                'rows': rows,
+                                'rows_per_second': (rows or 0) / run['elapsed_seconds'],
+                                'peak_rss_kb': run['peak_rss_kb'],
+                                'api_calls': sum(server_stats['calls'].values()),
+                                'api_calls_per_endpoint': server_stats['calls'],
+                                'api_errors': server_stats['errors'],
+                                'failed': run['failed'],
+                            }
+
+                            if os.path.isfile(stats_path):
+                                with open(stats_path) as stats_file:
+                                    explorer_stats = json.load(stats_file)
+                                result['explorer_stats'] = explorer_stats['derived']
+                                # how long the workers waited for the tree to open up, and for the last folders
+                                for gauge in explorer_stats['gauges']:
+                                    if gauge['name'] in ('time_to_saturation_seconds', 'tail_seconds'):
+                                        result[gauge['name']] = gauge['value']
+                                # the explorations that stop early do not explore the whole tree
+                                explored = sum(counter['value'] for counter in explorer_stats['counters']
+                                               if counter['name'] == 'folders_explored_total')
+                                if explored:
+                                    result['folders_explored'] = explored
+                                    result['folders_per_second'] = explored / run['elapsed_seconds']
+                                os.remove(stats_path)
+
+                            if run['failed']:
+                                result['output_tail'] = run['output_tail']
+
+                            results.append(result)
+                            saturation = result.get('time_to_saturation_seconds')
+                            print("{:<20} {:<7} workers={:<3} {:>8.2f}s {:>9.1f} folders/s {:>10.1f} rows/s "
+                                  "rss={:>8} KB api={:<6} saturated={} tail={}{}".format(
+                                      scenario or 'default', output_format, num_workers, result['elapsed_seconds'],
+                                      result['folders_per_second'], result['rows_per_second'], result['peak_rss_kb'],
+                                      result['api_calls'], '{:.2f}s'.format(saturation) if saturation is not None
+                                      else 'never', '{:.2f}s'.format(result['tail_seconds']) if 'tail_seconds' in result
+                                      else '-', ' FAILED' if run['failed'] else ''))
+    finally:
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print("Work directory kept in {}".format(workdir))
+
+    params = {key: value for key, value in vars(args).items() if key not in ('results', 'keep_workdir')}
+    params['tree'] = {'folders': tree.folder_count, 'files': tree.file_count}
+    save_results(args.results, 'traversal', params, results)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End-to-end traversal benchmark of drive-explorer.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_tree_arguments(parser)
+    parser.add_argument('--workers', type=lambda value: [int(x) for x in value.split(',')], default=[1, 4, 8],
+                        help='comma separated list of --num-workers values to sweep')
+    parser.add_argument('--formats', type=lambda value: value.split(','), default=['csv'],
+                        help='comma separated list of output formats (csv, tsv, json, sqlite)')
+    parser.add_argument('--scenarios', type=lambda value: value.split(';'), default=[''],
+                        help='semicolon separated list of extra CLI arguments to compare (e.g. "--buffer-memory '
+                             '1;--buffer-memory 256"), the empty string is the default behaviour')
+    parser.add_argument('--users', type=int, default=1,
+                        help='identities in the credential store: bench@example.com, bench1@example.com and so on')
+    parser.add_argument('--cli-args', type=str, default='', help='extra arguments passed to every CLI run')
+    parser.add_argument('--repeat', type=int, default=1, help='runs for every combination')
+    parser.add_argument('--timeout', type=int, default=3600, help='seconds after which a run is killed')
+    parser.add_argument('--results', type=str, default='bench_traversal.json', help='where to save the results')
+    parser.add_argument('--keep-workdir', action='store_true', default=False,
+                        help='do not delete the work directory (outputs and logs) at the end')
+
+    run_benchmark(parser.parse_args())
@@ -0,0 +1,228 @@
+"""
+Writer micro-benchmark: feeds the same synthetic rows, shaped like the output of DriveWorker, straight into every
+output format, bypassing the explorer. The Google Sheets output is run against the stub Sheets API of the fake server.
+
+    python benchmarks/bench_writers.py --rows 100000 --chunk-sizes 100,1000,10000 --formats csv,json,sqlite,gs
+"""
+# standard imports
+import argparse
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import tempfile
+
+# standard from imports
+from contextlib import redirect_stdout
+from time import perf_counter
+
+# libraries import
+from fake_drive import FOLDER_MIME_TYPE, ROOT_ID, FakeDriveServer, FakeDriveState, SyntheticTree
+from harness import BENCH_USER, SRC_DIR, save_results
+
+sys.path.insert(0, SRC_DIR)
+
+
+def synthetic_rows(tree, folder_separator='\\'):
+    """
+    Walks a SyntheticTree from the root and builds the rows exactly like DriveWorker does
+
+    :param tree: the SyntheticTree
+    :param folder_separator: the folder separator used in the full names
+    :return: the list of rows
+    """
+    rows = []
+    folders = [(ROOT_ID, tree.items[ROOT_ID]['name'])]
+    while folders:
+        folder_id, folder_full_name = folders.pop()
+        for item in tree.children.get(folder_id, []):
+            full_name = "{}{}{}".format(folder_full_name, folder_separator, item['name'])
+            rows.append({
+                'id': item['id'],
+                'mimeType': item['mimeType'],
+                'name': full_name,
+                'size': item.get('size'),
+                'trashed': item['trashed'],
+                'teamDriveId': item.get('teamDriveId'),
+                'createdTime': item['createdTime'],
+                'modifiedTime': item['modifiedTime'],
+                'parents': item['parents'],
+                'url': item['webViewLink'],
+                'permissions': item['permissions'],
+            })
+            if item['mimeType'] == FOLDER_MIME_TYPE:
+                folders.append((item['id'], full_name))
+    return rows
+
+
+def _read_status_kb(field):
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith(field):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def _reset_peak_rss():
+    # Linux only: resets VmHWM to the current RSS, so that the peak only measures the writer
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def _run_case(rows, output_extension, chunk_size, log_level, results):
+    # imported here so that the cost of the imports is not measured
+    from google.oauth2.credentials import Credentials
+    from common.token_broker import TokenBroker
+    from output.writer import OutputWriter
+    # the writer imports its backend, and the Sheets one the API client, when it is created
+    import googleapiclient.discovery
+    import output.csv
+    import output.gsheet
+    import output.json
+    import output.sqlite
+
+    output_path = 'bench{}'.format(output_extension)
+    if os.path.exists(output_path):
+        os.remove(output_path)
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        # the writer is created exactly like the OutputWriter process does
+        token_broker = TokenBroker(BENCH_USER, Credentials(token='fake-token'), log_level, refresh=False)
+        output_writer = OutputWriter(None, output_path, output_extension, log_level, token_broker)
+
+        baseline_rss_kb = _read_status_kb('VmRSS:')
+        _reset_peak_rss()
+
+        dt_start = perf_counter()
+        output_writer._get_writer(output_extension, rows[0].keys())
+        writer = output_writer._writer
+        writer.writeheader()
+
+        call_seconds = []
+        for chunk_start in range(0, len(rows), chunk_size):
+            dt_call = perf_counter()
+            writer.writerows(rows[chunk_start:chunk_start + chunk_size])
+            call_seconds.append(perf_counter() - dt_call)
+
+        writer.close()
+        elapsed = perf_counter() - dt_start
+
+    peak_rss_kb = _read_status_kb('VmHWM:')
+    results.put({
+        'writer': type(writer).__name__,
+        'elapsed_seconds': elapsed,
+        'writerows_calls': len(call_seconds),
+        'writerows_mean_seconds': sum(call_seconds) / len(call_seconds),
+        'writerows_p50_seconds': _percentile(call_seconds, 0.5),
+        'writerows_p95_seconds': _percentile(call_seconds, 0.95),
+        'writerows_max_seconds': max(call_seconds),
+        'bytes_written': os.path.getsize(output_path) if os.path.isfile(output_path) else None,
+        'peak_rss_kb': peak_rss_kb,
+        'rss_growth_kb': max(peak_rss_kb - baseline_rss_kb, 0),
+    })
+
+
+def run_benchmark(args):
+    tree = SyntheticTree(args.depth, args.fan_out, args.files_per_folder, args.multi_parent_ratio, seed=args.seed)
+    rows = synthetic_rows(tree)
+    rows = (rows * (args.rows // len(rows) + 1))[:args.rows] if args.rows else rows
+    print("{} rows from a synthetic tree of {} folders and {} files".format(len(rows), tree.folder_count,
+                                                                         tree.file_count))
+
+    workdir = tempfile.mkdtemp(prefix='drive-explorer-bench-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+
+    # every case runs in its own forked process, that starts with the same rows, so that memory is measured in isolation
+    context = multiprocessing.get_context('fork')
+    results = []
+    try:
+        with FakeDriveServer(FakeDriveState(tree, latency_ms=args.sheets_latency_ms)) as server:
+            os.environ['DRIVE_EXPLORER_API_ENDPOINT'] = server.url
+
+            for output_format in args.formats:
+                output_extension = '.{}'.format(output_format)
+                for chunk_size in args.chunk_sizes:
+                    for repeat_i in range(args.repeat):
+                        server.state.reset_counters()
+                        results_queue = context.Queue()
+                        process = context.Process(target=_run_case, args=(rows, output_extension, chunk_size,
+                                                                          args.log_level, results_queue))
+                        process.start()
+
+                        # the process may die without sending anything
+                        result = None
+                        while result is None and (process.is_alive() or not results_queue.empty()):
+                            try:
+                                result = results_queue.get(timeout=1)
+                            except queue.Empty:
+                                pass
+                        process.join()
+                        if result is None or process.exitcode != 0:
+                            print("{:<7} chunk={:<6} FAILED (exit code {})".format(output_format, chunk_size,
+                                                                                  process.exitcode))
+                            continue
+
+                        result.update({
+                            'format': output_format,
+                            'rows_per_batch': chunk_size,
+                            'repeat': repeat_i,
+                            'rows': len(rows),
+                            'rows_per_second': len(rows) / result['elapsed_seconds'],
+                        })
+                        # for Google Sheets we count what has been sent to the API
+                        if result['bytes_written'] is None:
+                            result['bytes_written'] = server.state.bytes_received
+                            result['api_calls_per_endpoint'] = dict(server.state.calls)
+
+                        results.append(result)
+                        print("{:<7} chunk={:<6} {:>8.2f}s {:>10.1f} rows/s {:>12} bytes writerows "
+                              "p50={:.4f}s p95={:.4f}s rss+={} KB".format(output_format, chunk_size,
+                                                                         result['elapsed_seconds'],
+                                                                         result['rows_per_second'],
+                                                                         result['bytes_written'],
+                                                                         result['writerows_p50_seconds'],
+                                                                         result['writerows_p95_seconds'],
+                                                                         result['rss_growth_kb']))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    params = {key: value for key, value in vars(args).items() if key != 'results'}
+    save_results(args.results, 'writers', params, results)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmark of the drive-explorer output writers.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--depth', type=int, default=3, help='folder levels of the synthetic tree')
+    parser.add_argument('--fan-out', type=int, default=4, help='sub folders per folder')
+    parser.add_argument('--files-per-folder', type=int, default=100, help='files in every folder')
+    parser.add_argument('--multi-parent-ratio', type=float, default=0.0, help='fraction of items with a second parent')
+    parser.add_argument('--seed', type=int, default=42, help='seed used to generate the tree')
+    parser.add_argument('--rows', type=int, default=0,
+                        help='number of rows to write, the rows of the tree are repeated if needed (0: one per item)')
+    parser.add_argument('--chunk-sizes', type=lambda value: [int(x) for x in value.split(',')],
+                        default=[100, 1_000, 10_000], help='comma separated list of rows per writerows call')
+    parser.add_argument('--formats', type=lambda value: value.split(','), default=['csv', 'tsv', 'json', 'sqlite', 'gs'],
+                        help='comma separated list of output extensions')
+    parser.add_argument('--sheets-latency-ms', type=float, default=0, help='latency of the stub Sheets API')
+    parser.add_argument('--repeat', type=int, default=1, help='runs for every combination')
+    parser.add_argument('--log-level', type=str, default='WARNING', help='logging level of the writers')
+    parser.add_argument('--results', type=str, default='bench_writers.json', help='where to save the results')
+
+    run_benchmark(parser.parse_args())
@@ -0,0 +1,65 @@
+"""
+Compares two benchmark result files, e.g. the ones saved before and after a change:
+
+    python benchmarks/compare.py baseline.json candidate.json
+"""
+# standard imports
+import argparse
+import json
+
+# the fields identifying a run, the other numeric fields are compared
+KEY_FIELDS = ('scenario', 'format', 'workers', 'writer', 'rows_per_batch', 'command')
+METRICS = ('elapsed_seconds', 'folders_per_second', 'rows_per_second', 'peak_rss_kb', 'api_calls', 'import_seconds',
+           'imported_modules', 'time_to_saturation_seconds', 'tail_seconds')
+
+
+def _key(result):
+    return tuple((field, result[field]) for field in KEY_FIELDS if field in result)
+
+
+def _average(results):
+    averages = {}
+    for result in results:
+        key = _key(result)
+        runs = averages.setdefault(key, {})
+        for metric in METRICS:
+            if isinstance(result.get(metric), (int, float)):
+                runs.setdefault(metric, []).append(result[metric])
+
+    return {key: {metric: sum(values) / len(values) for metric, values in runs.items()}
+            for key, runs in averages.items()}
+
+
+def compare(baseline_path, candidate_path):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    with open(candidate_path) as candidate_file:
+        candidate = json.load(candidate_file)
+
+    print("baseline:  {} ({})".format(baseline['environment']['revision'], baseline['environment']['date']))
+    print("candidate: {} ({})".format(candidate['environment']['revision'], candidate['environment']['date']))
+
+    baseline_averages = _average(baseline['results'])
+    candidate_averages = _average(candidate['results'])
+    for key, candidate_metrics in candidate_averages.items():
+        baseline_metrics = baseline_averages.get(key)
+        if baseline_metrics is None:
+            continue
+
+        print(', '.join('{}={}'.format(field, value) for field, value in key))
+        for metric, candidate_value in candidate_metrics.items():
+            baseline_value = baseline_metrics.get(metric)
+            if not baseline_value:
+                continue
+            change = (candidate_value - baseline_value) / baseline_value * 100
+            print("    {:<20} {:>14.2f} -> {:>14.2f} ({:+.1f}%)".format(metric, baseline_value, candidate_value,
+                                                                      change))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares two benchmark result files.')
+    parser.add_argument('baseline', type=str, help='the results used as reference')
+    parser.add_argument('candidate', type=str, help='the results to compare')
+    args = parser.parse_args()
+
+    compare(args.baseline, args.candidate)
@@ -0,0 +1,796 @@
+"""
+A local stand-in for the Google Drive v3 API, serving files.get, files.list and batches of files.get for a synthetic
+folder tree. A stub of
+the Sheets v4 API (spreadsheets create, values append and batchUpdate) and of Drive files.update is also served, so that
+the Google Sheets output can be used offline: rows are counted but never stored. With a token lifetime, access tokens
+are checked and expire, new ones are issued by the /token endpoint (see harness.prepare_workdir).
+
+Every access token belongs to an identity, the index of the user in harness.prepare_workdir. The rate limit is applied
+per identity, like the Drive per-user quota, and a fraction of the folders can be hidden from all the identities but
+the first one: they are answered with 404 File not found.
+
+Run the explorer against it by setting the DRIVE_EXPLORER_API_ENDPOINT environment variable to the URL of the server.
+It can also be started on its own:
+
+    python benchmarks/fake_drive.py --depth 4 --fan-out 5 --files-per-folder 50 --port 8765
+"""
+# standard imports
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+
+# standard from imports
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, monotonic
+from urllib.parse import urlsplit, parse_qs, parse_qsl, unquote
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+FILE_MIME_TYPES = ('application/pdf', 'image/jpeg', 'text/plain', 'application/vnd.google-apps.document',
+                   'application/vnd.google-apps.spreadsheet', 'video/mp4')
+GOOGLE_MIME_PREFIX = 'application/vnd.google-apps.'
+ROOT_ID = 'root'
+
+RATE_LIMIT_ERROR = {
+    'error': {
+        'errors': [{'domain': 'usageLimits', 'reason': 'userRateLimitExceeded',
+                    'message': 'User Rate Limit Exceeded. Rate of requests for user exceed configured project quota.'}],
+        'code': 403,
+        'message': 'User Rate Limit Exceeded. Rate of requests for user exceed configured project quota.',
+    }
+}
+
+BACKEND_ERROR = {
+    'error': {
+        'errors': [{'domain': 'global', 'reason': 'backendError', 'message': 'Internal Error'}],
+        'code': 500,
+        'message': 'Internal Error',
+    }
+}
+
+UNAUTHENTICATED_ERROR = {
+    'error': {
+        'errors': [{'domain': 'global', 'reason': 'authError', 'message': 'Invalid Credentials',
+                    'locationType': 'header', 'location': 'Authorization'}],
+        'code': 401,
+        'message': 'Request had invalid authentication credentials.',
+        'status': 'UNAUTHENTICATED',
+    }
+}
+
+
+def _rfc3339(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}Z'.format(dt.microsecond // 1000)
+
+
+class SyntheticTree:
+    def __init__(self, depth=3, fan_out=4, files_per_folder=20, multi_parent_ratio=0.0, big_folders=0,
+                 big_folder_files=0, users=10, seed=42):
+        """
+        A synthetic Drive tree made of depth levels of folders, each one with fan_out sub folders and
+        files_per_folder files.
+
+        :param depth: number of folder levels below the root
+        :param fan_out: sub folders per folder
+        :param files_per_folder: files per folder
+        :param multi_parent_ratio: fraction of items that get a second parent (always a folder of the same level of
+        their first parent, so that the tree stays acyclic)
+        :param big_folders: number of folders (picked at random) that get big_folder_files extra files
+        :param big_folder_files: number of extra files in each big folder
+        :param users: number of distinct users used in the permissions
+        :param seed: seed for the random generator, the same parameters always generate the same tree
+        """
+        self.params = {
+            'depth': depth, 'fan_out': fan_out, 'files_per_folder': files_per_folder,
+            'multi_parent_ratio': multi_parent_ratio, 'big_folders': big_folders,
+            'big_folder_files': big_folder_files, 'users': users, 'seed': seed,
+        }
+        self._random = random.Random(seed)
+        self._users = ['user{}@example.com'.format(i) for i in range(users)]
+        self._base_time = datetime(2015, 1, 1, tzinfo=timezone.utc)
+        self._sequence = 0
+
+        self.items = {}
+        self.children = {}
+        self.folder_count = 0
+        self.file_count = 0
+
+        self.items[ROOT_ID] = self._new_item(ROOT_ID, 'My Drive', FOLDER_MIME_TYPE, [])
+
+        # folders are generated level by level
+        levels = [[ROOT_ID]]
+        for level in range(depth):
+            current_level = []
+            for parent_id in levels[-1]:
+                for folder_i in range(fan_out):
+                    folder_id = self._new_id('fo')
+                    parents = self._parents(parent_id, levels[-1])
+                    self._add(self._new_item(folder_id, 'Folder {}-{}'.format(level, folder_i), FOLDER_MIME_TYPE,
+                                             parents))
+                    current_level.append(folder_id)
+                    self.folder_count += 1
+            levels.append(current_level)
+
+        all_folders = [folder_id for level in levels for folder_id in level]
+        for level_folders in levels:
+            for folder_id in level_folders:
+                for file_i in range(files_per_folder):
+                    self._add_file(folder_id, level_folders, file_i)
+
+        for folder_id in self._random.sample(all_folders, min(big_folders, len(all_folders))):
+            for file_i in range(big_folder_files):
+                self._add_file(folder_id, [folder_id], files_per_folder + file_i)
+
+    def _new_id(self, prefix):
+        self._sequence += 1
+        return '{}{:010d}'.format(prefix, self._sequence)
+
+    def _parents(self, parent_id, level_folders):
+        parents = [parent_id]
+        if len(level_folders) > 1 and self._random.random() < self.params['multi_parent_ratio']:
+            other_parent = self._random.choice(level_folders)
+            if other_parent != parent_id:
+                parents.append(other_parent)
+        return parents
+
+    def _new_item(self, item_id, name, mime_type, parents):
+        created = self._base_time + timedelta(seconds=self._random.randrange(0, 10 * 365 * 24 * 3600))
+        modified = created + timedelta(seconds=self._random.randrange(0, 365 * 24 * 3600))
+
+        # like in Drive, every user has at most one permission on an item
+        users = self._random.sample(self._users, min(len(self._users), self._random.randrange(1, 5)))
+        permissions = [{'type': 'user', 'emailAddress': users[0], 'role': 'owner'}]
+        for user in users[1:]:
+            permissions.append({'type': 'user', 'emailAddress': user,
+                                'role': self._random.choice(('writer', 'commenter', 'reader'))})
+        if self._random.random() < 0.1:
+            permissions.append({'type': 'domain', 'domain': 'example.com', 'role': 'reader',
+                                'allowFileDiscovery': self._random.random() < 0.5})
+        if self._random.random() < 0.05:
+            permissions.append({'type': 'anyone', 'role': 'reader', 'allowFileDiscovery': False})
+
+        item = {
+            'id': item_id,
+            'name': name,
+            'mimeType': mime_type,
+            'trashed': False,
+            'createdTime': _rfc3339(created),
+            'modifiedTime': _rfc3339(modified),
+            'parents': parents,
+            'webViewLink': 'https://drive.example.com/{}'.format(item_id),
+            'permissions': permissions,
+        }
+
+        if mime_type != FOLDER_MIME_TYPE and not mime_type.startswith(GOOGLE_MIME_PREFIX):
+            # a few sizes are reused on purpose, so that duplicates can be found
+            size = self._random.choice((1024, 4096, 65536)) if self._random.random() < 0.05 \
+                else self._random.randrange(1, 50_000_000)
+            item['size'] = str(size)
+            item['md5Checksum'] = hashlib.md5('{}'.format(size if self._random.random() < 0.5 else item_id)
+                                              .encode()).hexdigest()
+
+        return item
+
+    def _add(self, item):
+        self.items[item['id']] = item
+        for parent_id in item['parents']:
+            self.children.setdefault(parent_id, []).append(item)
+
+    def _add_file(self, folder_id, level_folders, file_i):
+        mime_type = self._random.choice(FILE_MIME_TYPES)
+        extension = '' if mime_type.startswith(GOOGLE_MIME_PREFIX) else '.' + mime_type.split('/')[-1]
+        self._add(self._new_item(self._new_id('fi'), 'File {}{}'.format(file_i, extension), mime_type,
+                                 self._parents(folder_id, level_folders)))
+        self.file_count += 1
+
+    @property
+    def item_count(self):
+        """Number of distinct items (files and folders) below the root."""
+        return len(self.items) - 1
+
+
+_TIME_CLAUSE = re.compile(r"^(createdTime|modifiedTime)\s*(>=|<=|>|<|=)\s*'([^']+)'$")
+
+# files.list q parameter clauses supported by the fake server
+_CLAUSES = (
+    (re.compile(r"^'([^']+)' in parents$"), lambda m: lambda item: m.group(1) in item['parents']),
+    (re.compile(r"^trashed\s*=\s*(true|false)$"), lambda m: lambda item: item['trashed'] == (m.group(1) == 'true')),
+    (re.compile(r"^mimeType\s*=\s*'([^']+)'$"), lambda m: lambda item: item['mimeType'] == m.group(1)),
+    (re.compile(r"^mimeType\s*!=\s*'([^']+)'$"), lambda m: lambda item: item['mimeType'] != m.group(1)),
+    (re.compile(r"^name\s+contains\s+'((?:[^'\\]|\\.)*)'$"),
+     lambda m: lambda item: _unescape(m.group(1)).lower() in item['name'].lower()),
+    (re.compile(r"^fullText\s+contains\s+'((?:[^'\\]|\\.)*)'$"),
+     lambda m: lambda item: _unescape(m.group(1)).lower() in item['name'].lower()),
+    (_TIME_CLAUSE, lambda m: _time_clause(m.group(1), m.group(2), m.group(3))),
+)
+
+_OPERATORS = {
+    '>=': lambda a, b: a >= b, '<=': lambda a, b: a <= b, '>': lambda a, b: a > b, '<': lambda a, b: a < b,
+    '=': lambda a, b: a == b,
+}
+
+
+def _time_clause(field, operator, value):
+    # RFC 3339 timestamps with the same format can be compared as strings
+    value = _rfc3339(datetime.fromisoformat(value.replace('Z', '+00:00')))
+    compare = _OPERATORS[operator]
+    return lambda item: compare(item[field], value)
+
+
+def _unescape(value):
+    # quotes and backslashes are escaped with a backslash in the string values of a query
+    return re.sub(r"\\(.)", r"\1", value)
+
+
+def _split_top(q, operator):
+    """Splits a query on an operator (and, or) outside the string values and the parentheses."""
+    separator = re.compile(r"\s+{}\s+".format(operator))
+    clauses, depth, quoted, start, i = [], 0, False, 0, 0
+    while i < len(q):
+        char = q[i]
+        if quoted:
+            if char == '\\':
+                i += 1
+            elif char == "'":
+                quoted = False
+        elif char == "'":
+            quoted = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif depth == 0 and separator.match(q, i):
+            clauses.append(q[start:i])
+            start = i = separator.match(q, i).end()
+            continue
+        i += 1
+    clauses.append(q[start:])
+    return [clause.strip() for clause in clauses if clause.strip()]
+
+
+def split_query(q):
+    """Splits a query on the top level 'and' operators."""
+    return _split_top(q, 'and')
+
+
+def _parse_clause(clause):
+    if clause.startswith('(') and clause.endswith(')'):
+        # alternatives, e.g. (mimeType = 'image/jpeg' or mimeType = 'video/mp4')
+        alternatives = [_parse_clause(alternative) for alternative in _split_top(clause[1:-1], 'or')]
+        return lambda item: any(alternative(item) for alternative in alternatives)
+
+    for regex, factory in _CLAUSES:
+        match = regex.match(clause)
+        if match:
+            return factory(match)
+    raise ValueError("Unsupported query clause: {}".format(clause))
+
+
+def parse_query(q):
+    """
+    Transforms a (subset of the) Drive query language in a list of predicates
+
+    :param q: the query
+    :return: the list of predicates, all of them must be true for an item to match
+    """
+    return [_parse_clause(clause) for clause in split_query(q)]
+
+
+def _split_fields(fields):
+    """Splits a fields selector on the top level commas."""
+    result, depth, current = [], 0, ''
+    for char in fields:
+        if char == ',' and depth == 0:
+            result.append(current.strip())
+            current = ''
+            continue
+        depth += char == '('
+        depth -= char == ')'
+        current += char
+    if current.strip():
+        result.append(current.strip())
+    return result
+
+
+def select_fields(item, fields):
+    """
+    Keeps only the requested fields of an item (nested selectors are not applied)
+
+    :param item: the item
+    :param fields: the list of fields as returned by _split_fields
+    :return: the new item
+    """
+    if not fields:
+        return item
+    names = [field.split('(')[0].split('/')[0] for field in fields]
+    return {name: item[name] for name in names if name in item}
+
+
+def files_fields(fields):
+    """Extracts the fields requested for the files in a files.list fields selector."""
+    for field in _split_fields(fields or ''):
+        if field.startswith('files(') and field.endswith(')'):
+            return _split_fields(field[len('files('):-1])
+    return []
+
+
+class FakeDriveState:
+    def __init__(self, tree, max_page_size=1000, latency_ms=0, latency_jitter_ms=0, error_rate=0.0,
+                 rate_limit=0, seed=42, token_lifetime=0, hidden_ratio=0.0, slow_rate=0.0, slow_ms=0):
+        """
+        The state shared by all the request handlers of the server
+
+        :param tree: the SyntheticTree served
+        :param max_page_size: the maximum number of items returned in a page, no matter what the client asks
+        :param latency_ms: latency added to every request
+        :param latency_jitter_ms: random jitter added to the latency
+        :param error_rate: fraction of the requests answered with a rate limit (or backend) error
+        :param rate_limit: maximum number of requests per second of every identity, above it rate limit errors are
+        returned. 0 means no limit
+        :param seed: seed for the random generator used for latency and errors
+        :param token_lifetime: seconds an access token issued by the /token endpoint is valid, requests with unknown
+        or expired tokens are rejected. 0 means that tokens are not checked
+        :param hidden_ratio: fraction of the folders (the root excluded) that only the first identity can read
+        :param slow_rate: fraction of the requests that get slow_ms more latency, the tail of the real API
+        :param slow_ms: latency added to the slow requests
+        """
+        self.tree = tree
+        self.max_page_size = max_page_size
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.token_lifetime = token_lifetime
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._list_cache = {}
+        self._rate_windows = {}
+        self.calls = {}
+        self.errors = {}
+        self.bytes_received = 0
+        self.spreadsheets = {}
+        self._tokens = {}
+
+        folder_ids = sorted(item_id for item_id, item in tree.items.items()
+                            if item['mimeType'] == FOLDER_MIME_TYPE and item_id != ROOT_ID)
+        self.hidden = set(random.Random(seed).sample(folder_ids, int(len(folder_ids) * hidden_ratio)))
+
+    def count(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls = {}
+            self.errors = {}
+            self.bytes_received = 0
+            self.spreadsheets = {}
+
+    def issue_token(self, identity=0):
+        """Issues a new access token of an identity, valid for token_lifetime seconds."""
+        with self._lock:
+            token = 'fake-access-token-{}'.format(len(self._tokens))
+            self._tokens[token] = (monotonic() + self.token_lifetime, identity)
+        return token
+
+    def token_valid(self, token):
+        """Is the access token valid? Always True when tokens are not checked."""
+        if not self.token_lifetime:
+            return True
+
+        with self._lock:
+            expiry, _ = self._tokens.get(token, (None, None))
+        return expiry is not None and monotonic() < expiry
+
+    def identity(self, token):
+        """The identity of an access token: issued ones are tracked, the ones of prepare_workdir end with it."""
+        with self._lock:
+            if token in self._tokens:
+                return self._tokens[token][1]
+        suffix = token.rsplit('-', 1)[-1]
+        return int(suffix) if suffix.isdigit() else 0
+
+    def can_read(self, identity, folder_id):
+        """Can the identity read the folder? Hidden folders can only be read by the first identity."""
+        return identity == 0 or folder_id not in self.hidden
+
+    def add_bytes_received(self, size):
+        with self._lock:
+            self.bytes_received += size
+
+    def create_spreadsheet(self, properties):
+        """Creates a stub spreadsheet, only the number of rows appended to it is kept."""
+        with self._lock:
+            spreadsheet_id = 'sheet{:06d}'.format(len(self.spreadsheets))
+            self.spreadsheets[spreadsheet_id] = {'title': properties.get('title'), 'rows': 0}
+        return spreadsheet_id
+
+    def append_rows(self, spreadsheet_id, rows):
+        """Counts the rows appended to a stub spreadsheet, returns False if it does not exist."""
+        with self._lock:
+            if spreadsheet_id not in self.spreadsheets:
+                return False
+            self.spreadsheets[spreadsheet_id]['rows'] += rows
+            return True
+
+    def delay(self):
+        if self.latency_ms or self.latency_jitter_ms or self.slow_rate:
+            with self._lock:
+                jitter = self._random.uniform(0, self.latency_jitter_ms)
+                if self._random.random() < self.slow_rate:
+                    jitter += self.slow_ms
+            sleep((self.latency_ms + jitter) / 1000)
+
+    def injected_error(self, endpoint, identity=0):
+        """Returns the error to be sent back to the client, if any."""
+        with self._lock:
+            error = None
+            if self.rate_limit:
+                second = int(monotonic())
+                window_second, window_calls = self._rate_windows.get(identity, (0, 0))
+                window_calls = window_calls + 1 if window_second == second else 1
+                self._rate_windows[identity] = (second, window_calls)
+                if window_calls > self.rate_limit:
+                    error = (403, RATE_LIMIT_ERROR)
+
+            if error is None and self.error_rate and self._random.random() < self.error_rate:
+                error = (403, RATE_LIMIT_ERROR) if self._random.random() < 0.8 else (500, BACKEND_ERROR)
+
+            if error is not None:
+                key = '{} {}'.format(endpoint, error[0])
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+            return error
+
+    def list_items(self, q, order_by):
+        """Returns all the items matching the query, sorted as requested. Results are cached."""
+        key = (q, order_by)
+        with self._lock:
+            cached = self._list_cache.get(key)
+        if cached is not None:
+            return cached
+
+        # the partitions of a big folder only differ by their time range: they filter the same cached listing, so that
+        # the fake server does not sort the whole folder for every partition
+        clauses = split_query(q)
+        time_clauses = [clause for clause in clauses if _TIME_CLAUSE.match(clause)]
+        if time_clauses and len(time_clauses) < len(clauses):
+            predicates = parse_query(' and '.join(time_clauses))
+            items = [item for item in self.list_items(' and '.join(clause for clause in clauses
+                                                                  if clause not in time_clauses), order_by)
+                     if all(predicate(item) for predicate in predicates)]
+        else:
+            predicates = parse_query(q)
+            parent_match = re.search(r"'([^']+)' in parents", q)
+            candidates = self.tree.children.get(parent_match.group(1), []) if parent_match \
+                else [item for item_id, item in self.tree.items.items() if item_id != ROOT_ID]
+            items = [item for item in candidates if all(predicate(item) for predicate in predicates)]
+
+            for order in reversed([order.strip() for order in (order_by or '').split(',') if order.strip()]):
+                field, _, direction = order.partition(' ')
+                if field == 'folder':
+                    items.sort(key=lambda item: item['mimeType'] != FOLDER_MIME_TYPE, reverse=direction == 'desc')
+                else:
+                    items.sort(key=lambda item: item.get(field, ''), reverse=direction == 'desc')
+
+        with self._lock:
+            self._list_cache[key] = items
+            # we don't want the cache to grow forever
+            if len(self._list_cache) > 10_000:
+                self._list_cache.pop(next(iter(self._list_cache)))
+        return items
+
+
+class FakeDriveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # set on the subclass created by FakeDriveServer
+    state = None
+    # the identity of the access token of the current request
+    identity = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_body(self):
+        size = int(self.headers.get('Content-Length', 0))
+        self.state.add_bytes_received(size)
+        return json.loads(self.rfile.read(size) or b'{}')
+
+    def _begin(self, endpoint):
+        """Counts the request and applies latency and errors, returns False if an error has been sent back."""
+        self.state.count(endpoint)
+        token = self.headers.get('Authorization', '').replace('Bearer ', '', 1)
+        if not self.state.token_valid(token):
+            self.state.count('{} 401'.format(endpoint))
+            self._send_json(401, UNAUTHENTICATED_ERROR)
+            return False
+
+        self.identity = self.state.identity(token)
+        self.state.delay()
+        error = self.state.injected_error(endpoint, self.identity)
+        if error is not None:
+            self._send_json(*error)
+            return False
+        return True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        path = url.path.rstrip('/')
+
+        if path == '/__stats':
+            self._send_json(200, {'calls': self.state.calls, 'errors': self.state.errors,
+                                  'bytes_received': self.state.bytes_received,
+                                  'spreadsheets': self.state.spreadsheets})
+            return
+
+        if path.endswith('/files'):
+            endpoint = 'drive.files.list'
+        elif '/files/' in path:
+            endpoint = 'drive.files.get'
+        else:
+            self._send_json(404, {'error': {'code': 404, 'message': 'Unknown path {}'.format(path)}})
+            return
+
+        if not self._begin(endpoint):
+            return
+
+        if endpoint == 'drive.files.get':
+            self._files_get(unquote(path.rsplit('/', 1)[1]), query)
+        else:
+            self._files_list(query)
+
+    def do_POST(self):
+        path = unquote(urlsplit(self.path).path.rstrip('/'))
+        if path == '/__reset':
+            self.state.reset_counters()
+            self._send_json(200, {})
+            return
+
+        if path.startswith('/batch/'):
+            if self._begin('drive.batch'):
+                self._batch()
+            return
+
+        if path == '/token':
+            # OAuth token endpoint, the request is form encoded, the refresh token ends with the identity
+            self.state.add_bytes_received(int(self.headers.get('Content-Length', 0)))
+            form = dict(parse_qsl(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')))
+            self.state.count('oauth2.token')
+            identity = self.state.identity(form.get('refresh_token', ''))
+            self._send_json(200, {'access_token': self.state.issue_token(identity), 'token_type': 'Bearer',
+                                  'expires_in': self.state.token_lifetime or 3600})
+            return
+
+        body = self._read_body()
+        if path.endswith('/v4/spreadsheets'):
+            if self._begin('sheets.spreadsheets.create'):
+                self._spreadsheets_create(body)
+        elif '/v4/spreadsheets/' in path and path.endswith(':append'):
+            if self._begin('sheets.spreadsheets.values.append'):
+                spreadsheet_id = path.split('/v4/spreadsheets/', 1)[1].split('/', 1)[0]
+                self._spreadsheets_values_append(spreadsheet_id, body)
+        elif '/v4/spreadsheets/' in path and path.endswith(':batchUpdate'):
+            if self._begin('sheets.spreadsheets.batchUpdate'):
+                spreadsheet_id = path.split('/v4/spreadsheets/', 1)[1].rsplit(':', 1)[0]
+                replies = [{} for _ in body.get('requests', [])]
+                self._send_json(200, {'spreadsheetId': spreadsheet_id, 'replies': replies})
+        else:
+            self._send_json(404, {'error': {'code': 404, 'message': 'Unknown path {}'.format(path)}})
+
+    def do_PATCH(self):
+        path = unquote(urlsplit(self.path).path.rstrip('/'))
+        body = self._read_body()
+        if '/files/' in path:
+            if self._begin('drive.files.update'):
+                self._send_json(200, {'id': path.rsplit('/', 1)[1], 'name': body.get('name')})
+        else:
+            self._send_json(404, {'error': {'code': 404, 'message': 'Unknown path {}'.format(path)}})
+
+    def _spreadsheets_create(self, body):
+        properties = body.get('properties', {})
+        spreadsheet_id = self.state.create_spreadsheet(properties)
+        sheets = [{'properties': sheet.get('properties', {})} for sheet in body.get('sheets', [])]
+        self._send_json(200, {
+            'spreadsheetId': spreadsheet_id,
+            'properties': properties,
+            'sheets': sheets,
+            'spreadsheetUrl': 'https://docs.example.com/spreadsheets/d/{}/edit'.format(spreadsheet_id),
+        })
+
+    def _spreadsheets_values_append(self, spreadsheet_id, body):
+        rows = len(body.get('values', []))
+        if not self.state.append_rows(spreadsheet_id, rows):
+            self._send_json(404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}})
+            return
+
+        columns = max((len(row) for row in body.get('values', [])), default=0)
+        self._send_json(200, {'spreadsheetId': spreadsheet_id,
+                              'updates': {'spreadsheetId': spreadsheet_id, 'updatedRows': rows,
+                                          'updatedColumns': columns, 'updatedCells': rows * columns}})
+
+    def _file_resource(self, file_id, query):
+        item = self.state.tree.items.get(file_id)
+        if item is None or not self.state.can_read(self.identity, file_id):
+            return 404, {'error': {'code': 404, 'message': 'File not found: {}.'.format(file_id)}}
+
+        return 200, select_fields(item, _split_fields(query.get('fields', '')))
+
+    def _files_get(self, file_id, query):
+        self._send_json(*self._file_resource(file_id, query))
+
+    def _batch(self):
+        # a multipart/mixed body with one application/http part per request, only files.get is supported. Like in
+        # Drive, every request of the batch counts against the rate limit
+        size = int(self.headers.get('Content-Length', 0))
+        self.state.add_bytes_received(size)
+        body = self.rfile.read(size).decode('utf-8').replace('\r\n', '\n')
+        boundary = re.search(r'boundary="?([^";]+)"?', self.headers.get('Content-Type', '')).group(1)
+
+        response_boundary = 'batch_fake_drive'
+        response = []
+        for part in body.split('--{}'.format(boundary))[1:]:
+            if part.startswith('--'):
+                break
+            part_headers, _, request = part.strip().partition('\n\n')
+            content_id = re.search(r'^Content-ID:\s*<(.*)>$', part_headers, re.IGNORECASE | re.MULTILINE).group(1)
+            method, uri = request.split('\n', 1)[0].split(' ')[:2]
+            url = urlsplit(uri)
+
+            self.state.count('drive.files.get')
+            error = self.state.injected_error('drive.files.get', self.identity)
+            if error is not None:
+                status, resource = error
+            elif method != 'GET' or '/files/' not in url.path:
+                status, resource = 400, {'error': {'code': 400, 'message': 'Unsupported batch request {} {}'.format(
+                    method, url.path)}}
+            else:
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                status, resource = self._file_resource(unquote(url.path.rstrip('/').rsplit('/', 1)[1]), query)
+
+            response.append('--{}\r\nContent-Type: application/http\r\nContent-ID: <response-{}>\r\n\r\n'
+                            'HTTP/1.1 {} {}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n{}\r\n'
+                            .format(response_boundary, content_id, status, 'OK' if status == 200 else 'Error',
+                                    json.dumps(resource)))
+        response.append('--{}--\r\n'.format(response_boundary))
+
+        payload = ''.join(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/mixed; boundary={}'.format(response_boundary))
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _files_list(self, query):
+        # like Drive, listing the children of a folder that can not be read fails
+        parent_match = re.search(r"'([^']+)' in parents", query.get('q', ''))
+        if parent_match and not self.state.can_read(self.identity, parent_match.group(1)):
+            self._send_json(404, {'error': {'code': 404, 'message': 'File not found: {}.'.format(
+                parent_match.group(1))}})
+            return
+
+        try:
+            items = self.state.list_items(query.get('q', ''), query.get('orderBy', ''))
+        except ValueError as ve:
+            self._send_json(400, {'error': {'code': 400, 'message': str(ve)}})
+            return
+
+        if not parent_match and self.identity != 0 and self.state.hidden:
+            # a search on the whole drive only finds the items that can be read
+            items = [item for item in items if self.state.can_read(self.identity, item['id'])
+                     and any(self.state.can_read(self.identity, parent) for parent in item['parents'])]
+
+        page_size = min(int(query.get('pageSize', 100)), self.state.max_page_size)
+        offset = int(query.get('pageToken', 0))
+        page = items[offset:offset + page_size]
+
+        fields = files_fields(query.get('fields'))
+        body = {'files': [select_fields(item, fields) for item in page]}
+        if offset + page_size < len(items):
+            body['nextPageToken'] = str(offset + page_size)
+
+        self._send_json(200, body)
+
+
+class FakeDriveServer:
+    def __init__(self, state, host='127.0.0.1', port=0):
+        """
+        Threaded HTTP server serving the fake Drive API
+
+        :param state: the FakeDriveState
+        :param host: the host to bind
+        :param port: the port to bind, 0 to pick a free one
+        """
+        handler = type('BoundFakeDriveHandler', (FakeDriveHandler,), {'state': state})
+        self.state = state
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def add_tree_arguments(parser):
+    """Adds the arguments used to generate a SyntheticTree and to configure the FakeDriveState to parser."""
+    parser.add_argument('--depth', type=int, default=3, help='folder levels below the root')
+    parser.add_argument('--fan-out', type=int, default=4, help='sub folders per folder')
+    parser.add_argument('--files-per-folder', type=int, default=20, help='files in every folder')
+    parser.add_argument('--multi-parent-ratio', type=float, default=0.0,
+                        help='fraction of items with a second parent')
+    parser.add_argument('--big-folders', type=int, default=0, help='number of folders with extra files')
+    parser.add_argument('--big-folder-files', type=int, default=0, help='extra files in every big folder')
+    parser.add_argument('--seed', type=int, default=42, help='seed used to generate the tree')
+    parser.add_argument('--page-size', type=int, default=1000, help='maximum items per files.list page')
+    parser.add_argument('--latency-ms', type=float, default=0, help='latency added to every request')
+    parser.add_argument('--latency-jitter-ms', type=float, default=0, help='random jitter added to the latency')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='fraction of the requests that are slow')
+    parser.add_argument('--slow-ms', type=float, default=0, help='latency added to the slow requests')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with a rate limit or backend error')
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help='maximum requests per second of every identity, above it rate limit errors are returned '
+                             '(0: no limit)')
+    parser.add_argument('--token-lifetime', type=int, default=0,
+                        help='seconds an access token is valid, expired tokens are rejected (0: tokens not checked)')
+    parser.add_argument('--hidden-ratio', type=float, default=0.0,
+                        help='fraction of the folders that only the first identity can read')
+
+
+def state_from_args(args):
+    """Creates a FakeDriveState from the arguments added by add_tree_arguments."""
+    tree = SyntheticTree(args.depth, args.fan_out, args.files_per_folder, args.multi_parent_ratio, args.big_folders,
+                         args.big_folder_files, seed=args.seed)
+    return FakeDriveState(tree, args.page_size, args.latency_ms, args.latency_jitter_ms, args.error_rate,
+                          args.rate_limit, args.seed, args.token_lifetime, args.hidden_ratio, args.slow_rate,
+                          args.slow_ms)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Fake Google Drive v3 API server.',
+                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_tree_arguments(arg_parser)
+    arg_parser.add_argument('--host', type=str, default='127.0.0.1', help='host to bind')
+    arg_parser.add_argument('--port', type=int, default=8765, help='port to bind')
+    cli_args = arg_parser.parse_args()
+
+    fake_state = state_from_args(cli_args)
+    fake_server = FakeDriveServer(fake_state, cli_args.host, cli_args.port)
+    print("Serving {} folders and {} files on {}".format(fake_state.tree.folder_count, fake_state.tree.file_count,
+                                                        fake_server.url))
+    fake_server.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake_server.stop()
@@ -0,0 +1,206 @@
+"""
+Helpers shared by the benchmark scripts: they run the real drive-explorer CLI against the fake Drive server and
+measure it.
+"""
+# standard imports
+import json
+import os
+import pickle
+import platform
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
+
+# standard from imports
+from datetime import datetime
+from time import perf_counter
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+SRC_DIR = os.path.join(REPO_DIR, 'src')
+
+BENCH_USER = 'bench@example.com'
+
+
+def prepare_workdir(workdir, users=(BENCH_USER,), token_uri=None):
+    """
+    Creates the credential store used by the CLI in workdir, with fake credentials that never expire. The fake
+    server only checks them when it has a token lifetime: in that case the CLI gets new tokens from token_uri.
+
+    :param workdir: the directory where the CLI will be run
+    :param users: the emails of the credentials to store, the first one is the default. The tokens of every user end
+    with its index, the identity of the user for the fake server
+    :param token_uri: the OAuth token endpoint of the fake server, None if tokens are never renewed
+    """
+    from google.oauth2.credentials import Credentials
+
+    os.makedirs(workdir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(workdir, 'drive_explorer.sqlite3'))
+    conn.execute("""CREATE TABLE IF NOT EXISTS credentials (
+                        email        TEXT PRIMARY KEY UNIQUE NOT NULL,
+                        credentials  BLOB   NOT NULL,
+                        default_cred BOOLEAN
+                    );""")
+    for user_i, user in enumerate(users):
+        credentials = Credentials(token='fake-token-{}'.format(user_i),
+                                  refresh_token='fake-refresh-token-{}'.format(user_i),
+                                  token_uri=token_uri, client_id='bench', client_secret='bench')
+        conn.execute("INSERT OR REPLACE INTO credentials (email, credentials, default_cred) VALUES (?, ?, ?)",
+                     (user, pickle.dumps(credentials), 1 if user_i == 0 else 0))
+    conn.commit()
+    conn.close()
+
+
+def _read_rss_kb(pid):
+    try:
+        with open('/proc/{}/status'.format(pid)) as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def _children(pid):
+    children = []
+    try:
+        for task in os.listdir('/proc/{}/task'.format(pid)):
+            with open('/proc/{}/task/{}/children'.format(pid, task)) as children_file:
+                children.extend(int(child) for child in children_file.read().split())
+    except OSError:
+        pass
+    return children
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval=0.1):
+        """
+        Samples the resident memory of a process and of all its descendants (Linux only, elsewhere the peak is 0)
+
+        :param pid: the process to sample
+        :param interval: seconds between two samples
+        """
+        super().__init__(daemon=True)
+        self._pid = pid
+        self._interval = interval
+        self._stopped = threading.Event()
+        self.peak_kb = 0
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            pids = [self._pid]
+            total = 0
+            while pids:
+                pid = pids.pop()
+                total += _read_rss_kb(pid)
+                pids.extend(_children(pid))
+            self.peak_kb = max(self.peak_kb, total)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def run_cli(cli_args, workdir, api_endpoint, timeout=3600, env=None):
+    """
+    Runs the drive-explorer CLI and measures it
+
+    :param cli_args: the arguments of the CLI (e.g. ['folder', 'explore', '-o', 'out.csv'])
+    :param workdir: the directory where the CLI is run, see prepare_workdir
+    :param api_endpoint: the URL of the fake Drive server
+    :param timeout: seconds after which the run is killed
+    :param env: extra environment variables
+    :return: a dictionary with the elapsed time, the peak RSS of the process tree and the return code
+    """
+    run_env = dict(os.environ)
+    run_env['DRIVE_EXPLORER_API_ENDPOINT'] = api_endpoint
+    run_env.update(env or {})
+
+    dt_start = perf_counter()
+    process = subprocess.Popen([sys.executable, SRC_DIR] + [str(arg) for arg in cli_args], cwd=workdir,
+                               env=run_env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               start_new_session=True)
+    sampler = RssSampler(process.pid)
+    sampler.start()
+    try:
+        output, _ = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        # the child processes of the CLI keep the output pipe open, so the whole group is killed
+        os.killpg(process.pid, signal.SIGKILL)
+        output, _ = process.communicate()
+    elapsed = perf_counter() - dt_start
+    sampler.stop()
+
+    output = output.decode('utf-8', errors='replace')
+    return {
+        'elapsed_seconds': elapsed,
+        'peak_rss_kb': sampler.peak_kb,
+        'returncode': process.returncode,
+        'failed': process.returncode != 0 or 'Unhandled exeption' in output,
+        'output_tail': output[-2000:],
+    }
+
+
+def count_rows(output_path):
+    """
+    Counts the rows written by the CLI
+
+    :param output_path: the output file
+    :return: the number of rows, None if the format is not supported
+    """
+    if not os.path.isfile(output_path):
+        return 0
+
+    extension = os.path.splitext(output_path)[1]
+    if extension in ('.csv', '.tsv'):
+        import csv
+        with open(output_path, newline='', encoding='utf-8-sig') as output_file:
+            return max(sum(1 for _ in csv.reader(output_file, delimiter=',' if extension == '.csv' else '\t')) - 1,
+                       0)
+    elif extension == '.json':
+        with open(output_path) as output_file:
+            return len(json.load(output_file)['files'])
+    elif extension in ('.sqlite', '.sqlite3'):
+        conn = sqlite3.connect(output_path)
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table' "
+                                                 "AND name LIKE '%\\_files' ESCAPE '\\'")]
+        rows = sum(conn.execute("SELECT COUNT(*) FROM '{}'".format(table)).fetchone()[0] for table in tables)
+        conn.close()
+        return rows
+
+    return None
+
+
+def environment_info():
+    """Details about the environment, saved with the results so that runs can be compared."""
+    try:
+        revision = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=REPO_DIR, capture_output=True,
+                                  text=True).stdout.strip()
+    except OSError:
+        revision = None
+
+    return {
+        'revision': revision,
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def save_results(results_path, benchmark, params, results):
+    """
+    Saves the results of a benchmark as JSON
+
+    :param results_path: the output file
+    :param benchmark: the name of the benchmark
+    :param params: the parameters of the benchmark
+    :param results: the list of results
+    """
+    with open(results_path, 'w') as results_file:
+        json.dump({'benchmark': benchmark, 'environment': environment_info(), 'params': params,
+                   'results': results}, results_file, indent=2)
+    print("Results saved to {}".format(results_path))
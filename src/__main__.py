@@ -5,19 +5,31 @@ import sys
 # standard from imports
 from multiprocessing import cpu_count, freeze_support
 
-# third parties libraries
-import googleapiclient.errors
-
 # libraries import
-from commands.folder import FolderExplorer
 from commands.credential import GoogleCredential
 from common.exceptions import manage_generic_exception
 from common.logging import get_logger
-from output.writer import supported_types
+from output.types import supported_types
 import common.exceptions
 
 
+def api_errors():
+    """
+    The Google API client is only imported by the commands calling the APIs, so its errors can only be raised once it
+    has been imported
+
+    :return: a tuple with the API errors to be handled, empty when the client has not been imported
+    """
+    if 'googleapiclient.errors' not in sys.modules:
+        return ()
+
+    return sys.modules['googleapiclient.errors'].HttpError,
+
+
 def folder_explorer(explore_args):
+    # the folder commands are imported only when used, they pull in the Google API client
+    from commands.folder import FolderExplorer
+
     fe = None
     try:
         fe = FolderExplorer(explore_args)
@@ -33,6 +45,8 @@ def folder_explorer(explore_args):
 
 
 def folder_lister(explore_args):
+    from commands.folder import FolderExplorer
+
     fl = FolderExplorer(explore_args, False)
     try:
         fl()
@@ -43,6 +57,28 @@ def folder_lister(explore_args):
         print(oe)
 
 
+def folder_searcher(search_args):
+    from commands.folder import FolderSearcher
+
+    fs = FolderSearcher(search_args)
+    try:
+        fs()
+    except KeyboardInterrupt:
+        logger.warning("Detected Interruption by the user. Stopping the writer...")
+        fs.clean()
+
+
+def folder_worker(work_args):
+    from commands.folder import FolderWorkerNode
+
+    fw = FolderWorkerNode(work_args)
+    try:
+        fw()
+    except KeyboardInterrupt:
+        logger.warning("Detected Interruption by the user. Stopping the worker processes...")
+        fw.clean()
+
+
 def credential_add_func(explore_args):
     with GoogleCredential(explore_args.credential_file, log_level=explore_args.log_level) as google_cred:
         google_cred.add_credentials(explore_args.make_default)
@@ -85,6 +121,10 @@ if __name__ == '__main__':
                                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     folders_list = subparsers_folder.add_parser('list', help='list items inside a folder',
                                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    folders_search = subparsers_folder.add_parser('search', help='search items by name, content or type',
+                                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    folders_work = subparsers_folder.add_parser('work', help='explore the folders of a coordinator as a worker node',
+                                                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     # folder explore arguments
     folders_explore.add_argument('-id', '--folder-id', type=str, nargs='*', default=['root'],
@@ -99,13 +139,114 @@ if __name__ == '__main__':
                                  help='Python regex to filter the file types. Does not work on folders.')
     folders_explore.add_argument('-fs', '--folder-separator', type=str, default='\\',
                                  help='folder separator for output file')
+    folders_explore.add_argument('-md', '--max-depth', type=int, default=None,
+                                 help='the sub folders deeper than this are listed but not explored, the folders the '
+                                      'exploration starts from are at depth 0')
+    folders_explore.add_argument('-mr', '--max-results', type=int, default=0,
+                                 help='the exploration stops once this many results have been found, 0 for no limit')
+    folders_explore.add_argument('-fi', '--first-match', action='store_true', default=False,
+                                 help='the exploration stops at the first result, to know whether a file exists')
+    folders_explore_aggregate = folders_explore.add_mutually_exclusive_group()
+    folders_explore_aggregate.add_argument('-ru', '--rollup', action='store_true', default=False,
+                                           help='write one row per folder with its recursive totals, like du: bytes, '
+                                                'files, sub folders, files per type and newest modifiedTime, instead '
+                                                'of the rows of the files')
+    folders_explore_aggregate.add_argument('-du', '--duplicates', action='store_true', default=False,
+                                           help='write only the files with the same content, grouped by size and '
+                                                'md5Checksum, the biggest first, with the bytes wasted by the copies. '
+                                                'The candidates above the buffer memory (-bm) are spilled to disk')
     folders_explore.add_argument('-nw', '--num-workers', type=int, default=cpu_count()*2,
                                  help='number of parallel processes')
-    folders_explore.add_argument('-u', '--user', type=str, default='',
-                                 help='email address to be used')
+    folders_explore.add_argument('-tw', '--threads-per-worker', type=int, default=1,
+                                 help='number of threads exploring folders in every process. Threads spend most of '
+                                      'their time waiting for the API, so many threads in few processes explore as '
+                                      'fast as many processes, using less memory')
+    folders_explore.add_argument('-as', '--autoscale', type=int, default=0, metavar='MIN',
+                                 help='adapts the number of folders explored at the same time between MIN and the '
+                                      'threads of all the workers (-nw x -tw): it goes down when Google throttles the '
+                                      'requests or the API latency degrades, up while folders are waiting. 0 to '
+                                      'explore with all the threads all the time')
+    folders_explore.add_argument('-sp', '--split-pages', type=int, default=10,
+                                 help='number of pages (1000 items each) after which the rest of a folder is split in '
+                                      'creation time ranges explored in parallel, so that a huge folder is not '
+                                      'listed by a single worker. 0 to disable it')
+    folders_explore.add_argument('-st', '--strategy', type=str, default='mixed', choices=['mixed', 'skeleton'],
+                                 help='mixed lists the files and the sub folders of a folder together. skeleton first '
+                                      'expands the folder tree listing only the sub folders, so that all the workers '
+                                      'are busy sooner, the files of every folder are listed by a second task')
+    folders_explore.add_argument('-sk', '--skeleton-cache', type=str, default=None,
+                                 help='file where the folders found are saved. The next exploration of the same '
+                                      'folders queues all of them at the start, so that all the workers are busy '
+                                      'from the first second. The output is the same as without the cache')
+    folders_explore.add_argument('-sc', '--schedule', type=str, default='bfs',
+                                 choices=['bfs', 'dfs', 'largest', 'drives'],
+                                 help='the order in which the folders are explored. bfs explores them in the order '
+                                      'they are found, dfs the last found first, keeping fewer folders in memory. '
+                                      'largest explores first the folders with more rows in the previous exploration, '
+                                      'so that the biggest ones do not end last, it requires the skeleton cache. '
+                                      'drives takes the folders from every shared drive in turn')
+    folders_explore.add_argument('-u', '--user', type=str, nargs='+', default=[],
+                                 help='email addresses to be used. With more than one, the folders are spread across '
+                                      'them and the ones that an identity can not read are explored with another one')
+    folders_explore.add_argument('-uq', '--user-qps', type=float, default=0,
+                                 help='maximum requests per second sent with every identity (0: no limit)')
     folders_explore.add_argument('-o', '--output', type=str, default=None,
                                  help='Path to the output file. Supported formats: {}'
                                  .format(", ".join(sorted(supported_types))))
+    folders_explore.add_argument('-ct', '--connect-timeout', type=float, default=10,
+                                 help='Seconds to wait for a connection to Google before trying again')
+    folders_explore.add_argument('-rt', '--read-timeout', type=float, default=60,
+                                 help='Seconds to wait for every read of a Google response before trying again')
+    folders_explore.add_argument('-hp', '--hedge-percentile', type=float, default=0,
+                                 help='a folder listing slower than this percentile of the latencies measured during '
+                                      'the exploration is sent a second time, the first response wins. E.g. 95, 0 to '
+                                      'disable hedging')
+    folders_explore.add_argument('-bm', '--buffer-memory', type=int, default=256,
+                                 help='Memory (in MB) used to buffer results before spilling them to disk')
+    folders_explore.add_argument('-sd', '--spill-dir', type=str, default=None,
+                                 help='Directory used to spill buffered results when the output is slow. '
+                                      'System temp directory by default')
+    folders_explore.add_argument('-sf', '--stats-file', type=str, default=None,
+                                 help='Path to a file where to save the exploration stats. JSON if the extension is .json, '
+                                      'Prometheus text format otherwise')
+    folders_explore.add_argument('-pi', '--progress-interval', type=float, default=5,
+                                 help='Seconds between two progress reports, 0 to disable them')
+    folders_explore.add_argument('-pr', '--profile', type=str, default=None,
+                                 help='Directory where to save the cProfile stats of the workers and of the writer. A merged '
+                                      'report is also created at the end of the exploration. Every exploration has its own sub '
+                                      'directory')
+    folders_explore.add_argument('-ps', '--profile-sample-interval', type=float, default=0,
+                                 help='When profiling, milliseconds between two wall-clock stack samples saved in the '
+                                      'collapsed (flamegraph) format, 0 to disable them')
+    folders_explore.add_argument('-tr', '--trace', type=str, default=None,
+                                 help='Path to a file where to save a timeline of the exploration in the Chrome trace event '
+                                      'format (it can be opened with Perfetto)')
+    folders_explore_cassette = folders_explore.add_mutually_exclusive_group()
+    folders_explore_cassette.add_argument('-rc', '--record', type=str, default=None,
+                                          help='Path to a cassette file where to save all the Drive responses, so that '
+                                               'the exploration can be replayed offline with the -rp option')
+    folders_explore_cassette.add_argument('-rp', '--replay', type=str, default=None,
+                                          help='Path to a cassette file saved with the -rc option: the Drive responses '
+                                               'are served from it instead of calling the APIs')
+    folders_explore.add_argument('-an', '--anonymize', action='store_true', default=False,
+                                 help='When recording, replace names, emails and domains with pseudonyms')
+    folders_explore.add_argument('-rs', '--replay-speed', type=float, default=0,
+                                 help='When replaying, 0 serves the responses as fast as possible, 1 with the original '
+                                      'latency, 2 twice as fast and so on')
+    folders_explore.add_argument('-ca', '--coordinator-address', type=str, default=None,
+                                 help='Coordinate a distributed exploration: the folders are leased to worker nodes '
+                                      '(see folder work) connecting to this host:port. The local processes are worker '
+                                      'nodes too, use -nw 0 to only coordinate')
+    folders_explore.add_argument('-ak', '--auth-key', type=str, default=None,
+                                 help='Key shared with the worker nodes. Connections are authenticated but not '
+                                      'encrypted, only use a trusted network')
+    folders_explore.add_argument('-wt', '--worker-timeout', type=float, default=600,
+                                 help='Seconds after which a worker that made no progress on its folder is terminated '
+                                      'and replaced, its folders are explored again. Dead workers are always replaced. '
+                                      '0 to never terminate a worker')
+    folders_explore.add_argument('-lt', '--lease-timeout', type=float, default=120,
+                                 help='Seconds after which a folder leased by a worker node that is not heard from '
+                                      'is given to another node')
     folders_explore.add_argument('-cf', '--credential-file', type=str, default='client_id.json',
                                  help='Path to the JSON file containing the configuration in the Google client '
                                       'secrets format')
@@ -126,11 +267,54 @@ if __name__ == '__main__':
                               help='Python regex to filter the file types. Does not work on folders.')
     folders_list.add_argument('-fs', '--folder-separator', type=str, default='\\',
                               help='folder separator for output file')
-    folders_list.add_argument('-u', '--user', type=str, default='',
-                              help='email address to be used')
+    folders_list.add_argument('-u', '--user', type=str, nargs='+', default=[],
+                              help='email addresses to be used. With more than one, the folders are spread across '
+                                   'them and the ones that an identity can not read are explored with another one')
+    folders_list.add_argument('-uq', '--user-qps', type=float, default=0,
+                              help='maximum requests per second sent with every identity (0: no limit)')
     folders_list.add_argument('-o', '--output', type=str, default=None,
                                  help='Path to the output file. Supported formats: {}'
                                  .format(", ".join(sorted(supported_types))))
+    folders_list.add_argument('-ct', '--connect-timeout', type=float, default=10,
+                              help='Seconds to wait for a connection to Google before trying again')
+    folders_list.add_argument('-rt', '--read-timeout', type=float, default=60,
+                              help='Seconds to wait for every read of a Google response before trying again')
+    folders_list.add_argument('-hp', '--hedge-percentile', type=float, default=0,
+                              help='a folder listing slower than this percentile of the latencies measured during '
+                                   'the exploration is sent a second time, the first response wins. E.g. 95, 0 to '
+                                   'disable hedging')
+    folders_list.add_argument('-bm', '--buffer-memory', type=int, default=256,
+                              help='Memory (in MB) used to buffer results before spilling them to disk')
+    folders_list.add_argument('-sd', '--spill-dir', type=str, default=None,
+                              help='Directory used to spill buffered results when the output is slow. '
+                                   'System temp directory by default')
+    folders_list.add_argument('-sf', '--stats-file', type=str, default=None,
+                              help='Path to a file where to save the exploration stats. JSON if the extension is .json, '
+                                   'Prometheus text format otherwise')
+    folders_list.add_argument('-pi', '--progress-interval', type=float, default=5,
+                              help='Seconds between two progress reports, 0 to disable them')
+    folders_list.add_argument('-pr', '--profile', type=str, default=None,
+                              help='Directory where to save the cProfile stats of the workers and of the writer. A merged '
+                                   'report is also created at the end of the exploration. Every exploration has its own sub '
+                                   'directory')
+    folders_list.add_argument('-ps', '--profile-sample-interval', type=float, default=0,
+                              help='When profiling, milliseconds between two wall-clock stack samples saved in the '
+                                   'collapsed (flamegraph) format, 0 to disable them')
+    folders_list.add_argument('-tr', '--trace', type=str, default=None,
+                              help='Path to a file where to save a timeline of the exploration in the Chrome trace event '
+                                   'format (it can be opened with Perfetto)')
+    folders_list_cassette = folders_list.add_mutually_exclusive_group()
+    folders_list_cassette.add_argument('-rc', '--record', type=str, default=None,
+                                       help='Path to a cassette file where to save all the Drive responses, so that '
+                                            'the exploration can be replayed offline with the -rp option')
+    folders_list_cassette.add_argument('-rp', '--replay', type=str, default=None,
+                                       help='Path to a cassette file saved with the -rc option: the Drive responses '
+                                            'are served from it instead of calling the APIs')
+    folders_list.add_argument('-an', '--anonymize', action='store_true', default=False,
+                              help='When recording, replace names, emails and domains with pseudonyms')
+    folders_list.add_argument('-rs', '--replay-speed', type=float, default=0,
+                              help='When replaying, 0 serves the responses as fast as possible, 1 with the original '
+                                   'latency, 2 twice as fast and so on')
     folders_list.add_argument('-cf', '--credential-file', type=str, default='client_id.json',
                               help='Path to the JSON file containing the configuration in the Google client '
                                    'secrets format')
@@ -138,6 +322,77 @@ if __name__ == '__main__':
                               choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
     folders_list.set_defaults(func=folder_lister)
 
+    # folder search arguments
+    folders_search.add_argument('-n', '--name', type=str, nargs='+', default=[],
+                                help='texts that must all be in the names of the items found')
+    folders_search.add_argument('-ft', '--full-text', type=str, nargs='+', default=[],
+                                help='texts that must all be in the names, descriptions or contents of the items found')
+    folders_search.add_argument('-mt', '--mime-type', type=str, nargs='+', default=[],
+                                help='the items found have one of these types. All the types by default')
+    folders_search.add_argument('-co', '--corpora', type=str, default='user', choices=['user', 'domain', 'allDrives'],
+                                help='the items searched: the ones of the user, the ones shared with the domain or '
+                                     'the ones of all the drives of the user')
+    folders_search.add_argument('-di', '--drive-id', type=str, default=None,
+                                help='the id of a shared drive, only its items are searched')
+    folders_search.add_argument('-it', '--include-trashed', action='store_true', default=False,
+                                help='Do we want to include trashed files?')
+    folders_search.add_argument('-fs', '--folder-separator', type=str, default='\\',
+                                help='folder separator for output file')
+    folders_search.add_argument('-mr', '--max-results', type=int, default=0,
+                                help='the search stops once this many results have been found, 0 for no limit')
+    folders_search.add_argument('-u', '--user', type=str, nargs=1, default=[], help='email address to be used')
+    folders_search.add_argument('-uq', '--user-qps', type=float, default=0,
+                                help='maximum requests per second (0: no limit)')
+    folders_search.add_argument('-o', '--output', type=str, default=None,
+                                help='Path to the output file. Supported formats: {}'
+                                .format(", ".join(sorted(supported_types))))
+    folders_search.add_argument('-ct', '--connect-timeout', type=float, default=10,
+                                help='Seconds to wait for a connection to Google before trying again')
+    folders_search.add_argument('-rt', '--read-timeout', type=float, default=60,
+                                help='Seconds to wait for every read of a Google response before trying again')
+    folders_search.add_argument('-bm', '--buffer-memory', type=int, default=256,
+                                help='Memory (in MB) used to buffer results before spilling them to disk')
+    folders_search.add_argument('-sd', '--spill-dir', type=str, default=None,
+                                help='Directory used to spill buffered results when the output is slow. '
+                                     'System temp directory by default')
+    folders_search.add_argument('-sf', '--stats-file', type=str, default=None,
+                                help='Path to a file where to save the search stats. JSON if the extension is .json, '
+                                     'Prometheus text format otherwise')
+    folders_search.add_argument('-cf', '--credential-file', type=str, default='client_id.json',
+                                help='Path to the JSON file containing the configuration in the Google client '
+                                     'secrets format')
+    folders_search.add_argument("-l", "--log", dest="log_level", help="Set the logging level", default=defaul_log_lvl,
+                                choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
+    folders_search.set_defaults(func=folder_searcher)
+
+    # folder work arguments
+    folders_work.add_argument('-ca', '--coordinator-address', type=str, required=True,
+                              help='host:port of the coordinator, started with folder explore -ca')
+    folders_work.add_argument('-ak', '--auth-key', type=str, required=True, help='Key shared with the coordinator')
+    folders_work.add_argument('-nw', '--num-workers', type=int, default=cpu_count()*2,
+                              help='number of parallel processes')
+    folders_work.add_argument('-tw', '--threads-per-worker', type=int, default=1,
+                              help='number of threads exploring folders in every process')
+    folders_work.add_argument('-u', '--user', type=str, nargs='+', default=[],
+                              help='email addresses to be used. With more than one, the folders are spread across '
+                                   'them and the ones that an identity can not read are explored with another one')
+    folders_work.add_argument('-uq', '--user-qps', type=float, default=0,
+                              help='maximum requests per second sent with every identity (0: no limit)')
+    folders_work.add_argument('-ct', '--connect-timeout', type=float, default=10,
+                              help='Seconds to wait for a connection to Google before trying again')
+    folders_work.add_argument('-rt', '--read-timeout', type=float, default=60,
+                              help='Seconds to wait for every read of a Google response before trying again')
+    folders_work.add_argument('-hp', '--hedge-percentile', type=float, default=0,
+                              help='a folder listing slower than this percentile of the latencies measured during '
+                                   'the exploration is sent a second time, the first response wins. E.g. 95, 0 to '
+                                   'disable hedging')
+    folders_work.add_argument('-cf', '--credential-file', type=str, default='client_id.json',
+                              help='Path to the JSON file containing the configuration in the Google client '
+                                   'secrets format')
+    folders_work.add_argument("-l", "--log", dest="log_level", help="Set the logging level", default=defaul_log_lvl,
+                              choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
+    folders_work.set_defaults(func=folder_worker)
+
     # sub parsers for the credential command
     subparsers_crendential = parser_credential.add_subparsers(help='credential commands help', dest='sub_command')
     credential_add = subparsers_crendential.add_parser('add', help='add a new credential',
@@ -183,7 +438,7 @@ if __name__ == '__main__':
     if hasattr(args, 'func'):
         try:
             args.func(args)
-        except googleapiclient.errors.HttpError as httpe:
+        except api_errors() as httpe:
             logger.error("Impossible to run command. APIs ended with the following error: {}".format(str(httpe)))
         except common.exceptions.InvalidIdentity as ie:
             logger.warning(ie)
@@ -193,6 +448,10 @@ if __name__ == '__main__':
             logger.warning("Detected Keboard interrupt by the user...")
         except common.exceptions.OutputException as oe:
             logger.warning(oe)
+        except common.exceptions.InvalidCoordinator as ice:
+            logger.error(ice)
+        except common.exceptions.InvalidSpillDir as isde:
+            logger.error(isde)
         except Exception as e:
             manage_generic_exception(e, sys.exc_info(), "drive_explorer")
     else:
@@ -206,6 +465,8 @@ if __name__ == '__main__':
                 folders_explore.print_help()
         elif args.sub_command == 'list':
                 folders_list.print_help()
+        elif args.sub_command == 'search':
+                folders_search.print_help()
         elif args.command == 'credential':
             if args.sub_command is None:
                 parser_credential.print_help()
@@ -2,13 +2,7 @@
 import pickle
 import sqlite3
 
-# third parties from imports
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-
 # libraries import
-from common.backoff import call_endpoint
 from common.exceptions import InvalidFlow, InvalidIdentity, AlreadyExistingIdentity
 from common.logging import get_logger
 
@@ -68,12 +62,17 @@ class GoogleCredential:
         self._conn.close()
 
     def _do_flow(self):
+        # the OAuth flow and the API clients are imported here, the other commands do not need them
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from common.api import build_service
+        from common.backoff import call_endpoint
+
         # where the authentication really takes place
         flow = InstalledAppFlow.from_client_secrets_file(self._client_secrets_file, self._scopes)
         self._credentials = flow.run_local_server()
 
         # to save the information in the sqlite database we use the email as a key, so we need to retrieve it
-        self._people_sdk = build('people', 'v1', credentials=self._credentials)
+        self._people_sdk = build_service('people', 'v1', self._credentials)
         people_get_params = {
             'resourceName': 'people/me',
             'personFields': 'emailAddresses',
@@ -87,7 +86,18 @@ class GoogleCredential:
         else:
             raise InvalidFlow("Impossible to find email address from Google API: {}".format(user_details))
 
-    def get_credentials(self):
+    def _refresh_credentials(self):
+        # requests is only imported when a token has to be renewed
+        from google.auth.transport.requests import Request
+        self._credentials.refresh(Request())
+
+    def get_credentials(self, refresh=True):
+        """
+        Gets the credentials of the user, or the default ones when no user has been specified
+
+        :param refresh: should expired credentials be renewed (and saved)?
+        :return: a tuple with the email and the credentials
+        """
         if not self._user:
             # if no user is present, we try to get the default credential
             sql_select = """SELECT email, credentials FROM credentials WHERE default_cred=?"""
@@ -98,9 +108,9 @@ class GoogleCredential:
                 self._email_address, credentials_str = row
                 self._credentials = pickle.loads(credentials_str)
 
-                if self._credentials.expired:
+                if self._credentials.expired and refresh:
                     # if the credential is expired, we update so that all the child processs can use it
-                    self._credentials.refresh(Request())
+                    self._refresh_credentials()
                     credentials_str = pickle.dumps(self._credentials)
 
                     sql_update = """UPDATE credentials SET credentials = ? WHERE default_cred=?"""
@@ -125,8 +135,8 @@ class GoogleCredential:
                 self._email_address = self._user
                 self._credentials = pickle.loads(credentials_str)
 
-                if self._credentials.expired:
-                    self._credentials.refresh(Request())
+                if self._credentials.expired and refresh:
+                    self._refresh_credentials()
                     credentials_str = pickle.dumps(self._credentials)
 
                     sql_update = """UPDATE credentials SET credentials = ? WHERE email=?"""
@@ -140,6 +150,16 @@ class GoogleCredential:
 
         return self._email_address, self._credentials
 
+    def update_credentials(self, email, credentials):
+        """
+        Saves credentials that have been renewed
+
+        :param email: the email of the credentials
+        :param credentials: the renewed credentials
+        """
+        sql_update = """UPDATE credentials SET credentials = ? WHERE email=?"""
+        self._cur.execute(sql_update, (pickle.dumps(credentials), email))
+
     def add_credentials(self, default=False):
         self._do_flow()
 
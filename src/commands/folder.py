@@ -2,28 +2,98 @@
 import multiprocessing
 import os.path
 import re
+import socket
+import threading
 
 # standard from imports
 from datetime import datetime
+from time import sleep
 
 # third parties libraries
 import googleapiclient.errors
 
-# third parties from imports
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
-
 # libraries import
-import output.writer
-from common.drive_utils import FolderConsumer
+from common.api import build_service
+from common.autoscale import Autoscaler, ConcurrencyLimiter
+from common.buffer import ResultBuffer
+from common.cassette import CassettePlayer, CassetteRecorder
+from common.drive_utils import SKELETON_PHASE, FolderConsumer
+from common.frontier import Frontier, FrontierConsumer, FrontierServer, connect_frontier, parse_address
 from common.backoff import call_endpoint
 from commands.credential import GoogleCredential
 from common.logging import get_logger
-from common.exceptions import UnkwonOutputType, NoOuputhPath
+from common import progress
+from common.profiling import create_run_dir, merge_profiles
+from common.progress import ProgressCounters, ProgressReporter
+from common.scheduler import SchedulerServer, TaskScheduler, create_policy
+from common.search import DriveSearch, build_query
+from common.skeleton import ROOT_KEY, SkeletonCache, folder_key
+from common.stats import QueueSampler, StatsCollector
+from common.identities import IdentityPool
+from common.token_broker import TokenBroker
+from common.supervisor import WorkerSupervisor
+from common.tracing import TraceCollector
+from common.transport import CONNECT_TIMEOUT, READ_TIMEOUT, RequestPolicy
+from common.exceptions import InvalidCoordinator, UnkwonOutputType, NoOuputhPath
+from output.duplicates import DuplicateFinder
+from output.rollup import FolderRollup
+from output.types import supported_types
 from output.writer import OutputWriter
 
 logger = get_logger(__name__)
 
+# seconds the coordinator keeps answering once the exploration is over, so that the worker nodes learn it and exit
+COORDINATOR_GRACE_SECONDS = 3
+# the items found by every files.list request of a search, the most allowed by Drive
+SEARCH_PAGE_SIZE = 1000
+
+
+def load_identities(args, refresh=True):
+    """
+    Loads the credentials of the users required by the command line parameters
+
+    :param args: the command line parameters
+    :param refresh: should the access tokens be renewed?
+    :return: an IdentityPool with one TokenBroker per user, not started
+    """
+    # credentials are renewed only in the main process, the childs get the access tokens from the brokers. With more
+    # than one user, the folders are spread across all of them, the first one is used for everything else
+    token_brokers = []
+    for user in dict.fromkeys(args.user or [None]):
+        with GoogleCredential(args.credential_file, user, log_level=args.log_level) as google_cred:
+            email, credentials = google_cred.get_credentials(refresh=refresh)
+        token_brokers.append(TokenBroker(email, credentials, args.log_level, refresh=refresh))
+    return IdentityPool(token_brokers, args.log_level, args.user_qps)
+
+
+def output_extension(output):
+    """
+    Checks the output file required by the user
+
+    :param output: the path of the output file
+    :return: the extension of the output file, that tells its format
+    """
+    # sanity check on the output format. It has to be declared and it has to be supported
+    if output is None:
+        raise NoOuputhPath("No output path specified. Please refer to the -o/--output parameter")
+
+    _, extension = os.path.splitext(output)
+    if extension not in supported_types:
+        raise UnkwonOutputType("Output format not supported: {}. Use one of the following ones: {}."
+                               .format(extension, ", ".join(supported_types)))
+    return extension
+
+
+def create_request_policy(args):
+    """
+    Creates the RequestPolicy of the API requests from the command line parameters
+
+    :param args: the command line parameters
+    :return: the RequestPolicy
+    """
+    return RequestPolicy(getattr(args, 'connect_timeout', CONNECT_TIMEOUT), getattr(args, 'read_timeout', READ_TIMEOUT),
+                         getattr(args, 'hedge_percentile', 0), args.log_level)
+
 
 class FolderExplorer:
     def __init__(self, args, recursive=True):
@@ -40,65 +110,237 @@ class FolderExplorer:
         else:
             self._file_re = re.compile(args.file_match, re.IGNORECASE | re.DOTALL)
 
-        # sanity check on the output format. It has to be declared and it has to be supported
-        if args.output is None:
-            raise NoOuputhPath("No output path specified. Please refer to the -o/--output parameter")
-        else:
-            _, self._output_extension = os.path.splitext(args.output)
-            if self._output_extension not in output.writer.supported_types:
-                raise UnkwonOutputType("Output format not supported: {}. Use one of the following ones: {}."
-                                       .format(self._output_extension, ", ".join(output.writer.supported_types)))
+        self._output_extension = output_extension(args.output)
 
         # file type search pattern
         self._type_re = re.compile(args.type_match, re.DOTALL)
 
-        # queue used to manage folders to be explored between processes
-        self._unsearched = multiprocessing.JoinableQueue()
+        # to manage the results of the exploration process we use a bounded buffer that spills to disk
+        self._results = ResultBuffer(args.buffer_memory * 1024 * 1024, args.spill_dir, args.log_level)
+        self._child_errors = multiprocessing.Value('B', 0)
+
+        # stats collected from all the processes, only when required by the user
+        self._stats = StatsCollector(args.stats_file, args.log_level) if args.stats_file else None
+
+        # counters used to report the progress to the user, one slot for the main process, one for the writer and one
+        # for each worker. They are also the measures used by the autoscaling
+        self._progress = None
+        if args.progress_interval > 0 or getattr(args, 'autoscale', 0) > 0:
+            num_workers = self._args.num_workers if self._recursive else 1
+            self._progress = ProgressCounters(progress.FIRST_WORKER_SLOT + num_workers)
 
-        # to manage the results of the exploration process we use a shared list
-        manager = multiprocessing.Manager()
-        self._results = manager.list()
-        self._results_lock = manager.Lock()
-        self._child_errors = manager.Value('B', 0)
-        # used to signal to the output writing process that all the workers are done with exploring folders
-        self._results_finished = multiprocessing.Event()
+        # profiling of the child processes, only when required by the user. Every exploration saves its profiles in
+        # a new sub directory
+        self._profile_dir = None
+        if args.profile is not None:
+            self._profile_dir = create_run_dir(args.profile, args.log_level)
 
-        # list used hold all the child workers
+        # timeline of the exploration, only when required by the user
+        self._trace = TraceCollector(args.trace, args.log_level) if args.trace else None
+
+        # Drive responses recorded to a cassette or replayed from one, only when required by the user
+        self._cassette = None
+        if args.record:
+            self._cassette = CassetteRecorder(args.record, args.log_level, args.anonymize)
+        elif args.replay:
+            self._cassette = CassettePlayer(args.replay, args.log_level, args.replay_speed)
+
+        # the order in which the folders are explored (see common.scheduler). Only the explore command has the
+        # schedule parameter
+        schedule = getattr(args, 'schedule', 'bfs')
+
+        # the exploration can stop early: below a depth, or once enough results have been found. Only the explore
+        # command has these parameters
+        self._max_depth = getattr(args, 'max_depth', None)
+        self._max_results = 1 if getattr(args, 'first_match', False) else getattr(args, 'max_results', 0)
+
+        # the writer can write the recursive totals of every folder instead of the rows of the files. Only the explore
+        # command has the rollup parameter
+        self._rollup = None
+        if getattr(args, 'rollup', False):
+            if self._max_results > 0:
+                logger.warning("The results are not limited when computing the totals of the folders")
+                self._max_results = 0
+            self._rollup = FolderRollup(args.log_level)
+
+        # or only the rows of the files with the same content, the files are listed with their checksums. Only the
+        # explore command has the duplicates parameter
+        self._checksums = getattr(args, 'duplicates', False)
+        self._duplicates = None
+        if self._checksums:
+            if self._max_results > 0:
+                logger.warning("The results are not limited when looking for duplicates")
+                self._max_results = 0
+            self._duplicates = DuplicateFinder(args.log_level, args.buffer_memory * 1024 * 1024, args.spill_dir)
+
+        # when the exploration is distributed, the folders to explore are leased to the worker nodes by a frontier.
+        # Only the explore command has the coordinator parameters
+        self._frontier = None
+        self._frontier_server = None
+        coordinator_address = getattr(args, 'coordinator_address', None)
+        if coordinator_address is not None:
+            if not args.auth_key:
+                raise InvalidCoordinator("An authentication key is required to coordinate worker nodes, please refer "
+                                         "to the -ak/--auth-key parameter")
+            settings = {
+                'file_match': self._file_re,
+                'type_match': self._type_re,
+                'folder_separator': args.folder_separator,
+                'include_trashed': args.include_trashed,
+                'recursive': self._recursive,
+                'split_pages': args.split_pages,
+                'max_depth': self._max_depth,
+                'checksums': self._checksums,
+                'folder_rows': self._rollup is not None,
+            }
+            self._frontier = Frontier(settings, self._results, args.lease_timeout, args.log_level,
+                                      create_policy(schedule))
+            self._frontier_server = FrontierServer(self._frontier, parse_address(coordinator_address),
+                                                   args.auth_key.encode('utf-8'), args.log_level)
+
+        # folders found by the previous exploration, queued at the start. Only the explore command has the cache
+        # parameter, it is not used by coordinators: the rows of the nodes go straight to the writer
+        self._skeleton_cache = None
+        if getattr(args, 'skeleton_cache', None) is not None:
+            if self._frontier is not None:
+                logger.warning("The skeleton cache is not used when coordinating worker nodes")
+            elif self._max_depth is not None or self._max_results > 0:
+                logger.warning("The skeleton cache is not used when the exploration can stop early")
+            else:
+                self._skeleton_cache = SkeletonCache(args.skeleton_cache, args.folder_id, args.folder_separator,
+                                                     args.include_trashed, args.log_level)
+
+        # queue used to manage folders to be explored between processes. Without a coordinator, the folders are
+        # served to the processes by a scheduler living in the main process, that knows what every worker is holding
+        self._scheduler_server = None
+        if self._frontier is not None:
+            self._unsearched = multiprocessing.JoinableQueue()
+        else:
+            # the sizes of the folders come from the previous exploration
+            sizes = self._skeleton_cache.sizes if self._skeleton_cache is not None else {}
+            if schedule == 'largest' and not sizes:
+                logger.warning("No folder sizes found in the skeleton cache, the largest folders can not be explored "
+                               "first. Please refer to the -sk/--skeleton-cache parameter")
+            self._unsearched = TaskScheduler(create_policy(schedule, sizes), args.log_level)
+            self._scheduler_server = SchedulerServer(self._unsearched, args.log_level)
+
+        # list used hold all the child workers, and the thread replacing the ones that die
         self._workers = []
         self._writer = None
+        self._supervisor = None
 
         logger.setLevel(args.log_level)
 
-        with GoogleCredential(args.credential_file, self._args.user, log_level=args.log_level) as google_cred:
-            self._email, self._credentials = google_cred.get_credentials()
+        # when replaying a cassette Google is never called, so there is nothing to renew
+        self._identities = load_identities(args, refresh=not args.replay)
+        self._identities.start()
+
+        # the cassette is started before calling any API, so that the root folders are also recorded/replayed
+        if self._cassette is not None:
+            self._cassette.start()
 
-        # we renew the credentials in the main process so that the childs do not need to do it
-        if self._credentials.expired:
-            self._credentials.refresh(Request())
+        # the timeouts and the hedging of the API requests, used by all the processes
+        self._request_policy = create_request_policy(args)
+        self._request_policy.attach()
 
-        self._drive_sdk = build('drive', 'v3', credentials=self._credentials)
+        self._drive_sdks = [build_service('drive', 'v3', self._identities.credentials(identity))
+                            for identity in range(len(self._identities))]
 
     def __call__(self):
 
         # folder list command olny requires one worker
         num_workers = self._args.num_workers if self._recursive else 1
+        threads_per_worker = getattr(self._args, 'threads_per_worker', 1) if self._recursive else 1
+        split_pages = getattr(self._args, 'split_pages', 0) if self._recursive else 0
+        strategy = getattr(self._args, 'strategy', 'mixed') if self._recursive else 'mixed'
+        min_slots = getattr(self._args, 'autoscale', 0) if self._recursive else 0
+
+        # the folders explored at the same time are adapted between the minimum and all the threads of all the workers
+        concurrency_limiter = None
+        autoscaler = None
+        if min_slots > 0:
+            max_slots = num_workers * threads_per_worker
+            if self._frontier is not None:
+                logger.warning("Autoscaling is not used when coordinating worker nodes")
+            elif min_slots >= max_slots:
+                logger.warning("The autoscaling minimum ({}) is not lower than the threads of all the workers ({}), "
+                               "please refer to the -nw and -tw parameters".format(min_slots, max_slots))
+            else:
+                # the slots are owned by the progress slot of every worker
+                concurrency_limiter = ConcurrencyLimiter(min_slots, progress.FIRST_WORKER_SLOT + num_workers)
+                autoscaler = Autoscaler(concurrency_limiter, self._progress, self._unsearched, min_slots, max_slots,
+                                        self._args.log_level)
+
+        # the writer tells when it has all the results required
+        limit_reached = None
+        if self._max_results > 0:
+            if self._frontier is not None:
+                logger.warning("The results are not limited when coordinating worker nodes")
+            else:
+                limit_reached = multiprocessing.Event()
 
         dt_start = datetime.now()
-        logger.debug("Starting {} processes...".format(num_workers))
-        # child processes that will explore the folder tree
-        self._workers = [
-            FolderConsumer(self._unsearched, self._results, self._results_lock, self._email,
-                           self._args.credential_file, self._file_re, self._type_re, self._args.log_level,
-                           self._args.folder_separator, self._args.include_trashed, self._recursive)
-            for _ in range(num_workers)]
+        queue_sampler = None
+        if self._stats is not None:
+            self._stats.start()
+            # the workers are saturated once every thread has a folder waiting for it
+            queue_sampler = QueueSampler(self._unsearched, saturation=num_workers * threads_per_worker)
+            queue_sampler.start()
+
+        if self._trace is not None:
+            self._trace.start()
+
+        progress_reporter = None
+        if self._progress is not None:
+            self._progress.attach(progress.MAIN_SLOT)
+        if self._args.progress_interval > 0:
+            progress_reporter = ProgressReporter(self._progress, self._args.log_level, self._args.progress_interval)
+
+        logger.debug("Starting {} processes with {} threads each...".format(num_workers, threads_per_worker))
+        # child processes that will explore the folder tree. When coordinating, they are worker nodes like the remote
+        # ones, leasing the folders from the frontier
+        if self._frontier is not None:
+            host, port = self._frontier_server.address
+            local_address = ('127.0.0.1' if host in ('', '0.0.0.0') else host, port)
+            self._workers = [
+                FrontierConsumer(local_address, self._args.auth_key.encode('utf-8'), self._identities,
+                                 self._args.log_level, 'coordinator', self._cassette, threads=threads_per_worker,
+                                 request_policy=self._request_policy)
+                for _ in range(num_workers)]
+        else:
+            task_queue = self._scheduler_server.client()
+
+            def create_worker(worker_i):
+                return FolderConsumer(task_queue, self._results, self._identities, self._file_re, self._type_re,
+                                      self._args.log_level, self._args.folder_separator, self._args.include_trashed,
+                                      self._recursive, self._stats, self._progress,
+                                      progress.FIRST_WORKER_SLOT + worker_i, self._profile_dir,
+                                      self._args.profile_sample_interval, self._trace, self._cassette,
+                                      threads=threads_per_worker, split_pages=split_pages,
+                                      skeleton_cache=self._skeleton_cache, concurrency_limiter=concurrency_limiter,
+                                      request_policy=self._request_policy, max_depth=self._max_depth,
+                                      limit_reached=limit_reached, checksums=self._checksums,
+                                      folder_rows=self._rollup is not None)
+
+            self._workers = [create_worker(worker_i) for worker_i in range(num_workers)]
+            # dead or stuck workers are replaced, their folders are explored again
+            self._supervisor = WorkerSupervisor(self._unsearched, self._workers, create_worker, self._args.log_level,
+                                                concurrency_limiter, getattr(self._args, 'worker_timeout', 0))
 
         # one more child process that will take care of writing the output to the desired targed while the exploring
         # workers are traversing the folders
-        self._writer = OutputWriter(self._results, self._results_lock, self._results_finished, self._args.output,
-                                    self._output_extension, self._args.log_level, self._email,
-                                    self._args.credential_file)
+        self._writer = OutputWriter(self._results, self._args.output, self._output_extension, self._args.log_level,
+                                    self._identities.primary, stats_collector=self._stats,
+                                    progress_counters=self._progress, profile_dir=self._profile_dir,
+                                    profile_sample_interval=self._args.profile_sample_interval,
+                                    trace_collector=self._trace, skeleton_cache=self._skeleton_cache,
+                                    request_policy=self._request_policy,
+                                    max_results=self._max_results if limit_reached is not None else 0,
+                                    limit_reached=limit_reached, rollup=self._rollup,
+                                    duplicates=self._duplicates)
 
         # for all the folders to explore, we get info
+        root_folders = []
         for drive_folder in self._args.folder_id:
             drive_get_params = {
                 'fileId': drive_folder,
@@ -106,46 +348,134 @@ class FolderExplorer:
                 'fields': 'id,name',
             }
 
-            # we make sure that all the folders can be browsed
-            try:
-                root_folder_details = call_endpoint(self._drive_sdk.files().get, drive_get_params)
-                self._unsearched.put(root_folder_details)
-            except googleapiclient.errors.HttpError as httpe:
-                httpe_str = str(httpe)
-                # we manage the file not found error and rise the others
-                if "File not found:" in httpe_str:
-                    logger.error("Folder not found: {}".format(drive_folder))
+            # we make sure that all the folders can be browsed, by at least one of the identities
+            for identity, drive_sdk in enumerate(self._drive_sdks):
+                try:
+                    root_folder_details = call_endpoint(drive_sdk.files().get, drive_get_params)
+                    if strategy == 'skeleton':
+                        root_folder_details['phase'] = SKELETON_PHASE
+                    if self._frontier is not None:
+                        self._frontier.add(root_folder_details)
+                    else:
+                        self._unsearched.put(root_folder_details)
+                    root_folders.append(folder_key(root_folder_details))
+                    if self._rollup is not None:
+                        self._rollup.add_top_folder(root_folder_details['id'], root_folder_details['name'])
+                    progress.add('folders_queued')
+                    break
+                except googleapiclient.errors.HttpError as httpe:
+                    httpe_str = str(httpe)
+                    # we manage the file not found error and rise the others
+                    if "File not found:" in httpe_str:
+                        logger.debug("Folder {} not found by {}".format(drive_folder,
+                                                                         self._identities.email(identity)))
+                        continue
+                    else:
+                        raise httpe
+            else:
+                logger.error("Folder not found: {}".format(drive_folder))
+
+        if self._skeleton_cache is not None:
+            # the folders we start from are always in the tree, the writer confirms the others as they are found
+            self._results.put([(ROOT_KEY, [], root_folders)])
+            for folder in self._skeleton_cache.folders:
+                if folder_key(folder) in root_folders:
                     continue
-                else:
-                    raise httpe
+                cached_task = {'id': folder['id'], 'name': folder['name'], 'cached': True}
+                if strategy == 'skeleton':
+                    cached_task['phase'] = SKELETON_PHASE
+                self._unsearched.put(cached_task)
+                progress.add('folders_queued')
 
         # we start the output writer and then the child processes
+        if self._frontier_server is not None:
+            self._frontier_server.start()
+        if self._scheduler_server is not None:
+            self._scheduler_server.start()
         self._writer.start()
         for worker in self._workers:
             worker.start()
 
-        # we wait for all the folders to be explored
-        self._unsearched.join()
+        if progress_reporter is not None:
+            progress_reporter.start()
+        if autoscaler is not None:
+            autoscaler.start()
+        if self._supervisor is not None:
+            self._supervisor.start()
+        if limit_reached is not None:
+            threading.Thread(target=self._stop_at_limit, args=(limit_reached,), daemon=True).start()
 
-        # poison pill to make the child processes break
-        # sometime one or more childs may chrash, so we only create poison pills for alive processes
-        for worker in self._workers:
-            if worker.is_alive():
-                self._unsearched.put(None)
+        if self._frontier is not None:
+            # we wait for all the folders to be explored by the nodes, then we tell them to exit
+            self._frontier.wait()
+            self._frontier.close()
+            for worker in self._workers:
+                worker.join()
+            sleep(COORDINATOR_GRACE_SECONDS)
+            self._frontier_server.stop()
+        else:
+            # we wait for all the folders to be explored
+            self._unsearched.join()
+            self._supervisor.drain()
+            if autoscaler is not None:
+                autoscaler.stop()
 
-        # we wair for all the child processes to actually break
-        self._unsearched.join()
-        for worker in self._workers:
-            worker.join()
+            # poison pill to make the child processes break
+            # sometime one or more childs may chrash, so we only create poison pills for alive processes, one for
+            # every thread
+            for worker in self._workers:
+                if worker.is_alive():
+                    for _ in range(threads_per_worker):
+                        self._unsearched.put(None)
+
+            # we wair for all the child processes to actually break
+            for worker in self._workers:
+                worker.join()
+            self._supervisor.stop()
+            self._scheduler_server.stop()
+
+        # the end of the exploration, the writer may still be busy
+        if queue_sampler is not None:
+            queue_sampler.stop()
 
         # we send the signal to the writer proces
-        self._results_finished.set()
+        self._results.close()
         self._writer.join()
 
-        logger.info("Elapsed time: {}".format(datetime.now() - dt_start))
+        if progress_reporter is not None:
+            progress_reporter.stop()
+
+        self._identities.stop()
+        self._results.log_summary()
+        self._results.cleanup()
+
+        elapsed = datetime.now() - dt_start
+        if self._stats is not None:
+            self._stats.finish(elapsed.total_seconds())
+
+        if self._profile_dir is not None:
+            merge_profiles(self._profile_dir, self._args.log_level)
+
+        if self._trace is not None:
+            self._trace.finish()
+
+        if self._cassette is not None:
+            self._cassette.finish()
+
+        logger.info("Elapsed time: {}".format(elapsed))
+
+    def _stop_at_limit(self, limit_reached):
+        # the folders waiting are dropped, the workers leave the ones they are exploring and get their poison pills
+        limit_reached.wait()
+        dropped = self._unsearched.clear()
+        logger.info("Stopping the exploration, {} folders not explored".format(dropped))
 
     def clean(self):
         """Used to clean pending processes."""
+        # the workers terminated must not be replaced
+        if self._supervisor is not None and self._supervisor.is_alive():
+            self._supervisor.stop()
+
         for worker in self._workers:
             if worker is not None:
                 try:
@@ -162,3 +492,145 @@ class FolderExplorer:
                 pass
             finally:
                 self._writer.join()
+
+        self._identities.stop()
+        self._results.cleanup()
+
+
+class FolderSearcher:
+    def __init__(self, args):
+        """
+        This class is used to search Google Drive items by name, content or type. Instead of exploring the folder
+        tree, a single query is sent on the whole corpus: the full names of the items found are rebuilt reading
+        their parent folders, so the rows are the same as the ones of the folder explore command
+        """
+        self._args = args
+        self._output_extension = output_extension(args.output)
+
+        self._query = build_query(args.name, args.full_text, args.mime_type, args.include_trashed)
+
+        # to manage the results of the search we use a bounded buffer that spills to disk
+        self._results = ResultBuffer(args.buffer_memory * 1024 * 1024, args.spill_dir, args.log_level)
+
+        # stats collected from the main process and the writer, only when required by the user
+        self._stats = StatsCollector(args.stats_file, args.log_level) if args.stats_file else None
+
+        self._writer = None
+
+        logger.setLevel(args.log_level)
+
+        self._identities = load_identities(args)
+        self._identities.start()
+
+        self._request_policy = create_request_policy(args)
+        self._request_policy.attach()
+
+    def __call__(self):
+        dt_start = datetime.now()
+        if self._stats is not None:
+            self._stats.start()
+
+        # the writer tells when it has all the results required
+        limit_reached = multiprocessing.Event() if self._args.max_results > 0 else None
+
+        self._writer = OutputWriter(self._results, self._args.output, self._output_extension, self._args.log_level,
+                                    self._identities.primary, stats_collector=self._stats,
+                                    request_policy=self._request_policy, max_results=self._args.max_results,
+                                    limit_reached=limit_reached)
+        self._writer.start()
+
+        logger.debug("Searching {}".format(self._query))
+        drive_search = DriveSearch(build_service('drive', 'v3', self._identities.credentials(0)), self._query,
+                                   self._args.folder_separator, self._args.corpora, self._args.drive_id,
+                                   throttle=lambda: self._identities.throttle(0),
+                                   page_size=min(SEARCH_PAGE_SIZE, self._args.max_results or SEARCH_PAGE_SIZE))
+        found = 0
+        try:
+            for rows in drive_search.pages():
+                if rows:
+                    self._results.put(rows)
+                found += len(rows)
+                if limit_reached is not None and found >= self._args.max_results:
+                    logger.debug("Result limit reached, stopping the search")
+                    break
+            logger.info("Search over, {} rows found".format(found))
+        finally:
+            # we send the signal to the writer proces, the rows found are written even when the search fails
+            self._results.close()
+            self._writer.join()
+
+        self._identities.stop()
+        self._results.log_summary()
+        self._results.cleanup()
+
+        elapsed = datetime.now() - dt_start
+        if self._stats is not None:
+            self._stats.finish(elapsed.total_seconds())
+
+        logger.info("Elapsed time: {}".format(elapsed))
+
+    def clean(self):
+        """Used to clean pending processes."""
+        if self._writer is not None:
+            try:
+                self._writer.terminate()
+            except (OSError, AttributeError):
+                pass
+            finally:
+                self._writer.join()
+
+        self._identities.stop()
+        self._results.cleanup()
+
+
+class FolderWorkerNode:
+    def __init__(self, args):
+        """
+        A worker node of a distributed exploration: its processes lease the folders from the coordinator, started
+        with the folder explore command, and send back the rows and the sub folders. The node uses its own stored
+        credentials, all the other settings of the exploration come from the coordinator
+        """
+        self._args = args
+        self._address = parse_address(args.coordinator_address)
+        self._authkey = args.auth_key.encode('utf-8')
+        self._workers = []
+
+        logger.setLevel(args.log_level)
+
+        self._identities = load_identities(args)
+        self._identities.start()
+
+        self._request_policy = create_request_policy(args)
+        self._request_policy.attach()
+
+    def __call__(self):
+        dt_start = datetime.now()
+
+        # we make sure that the coordinator can be reached before starting the processes
+        settings = connect_frontier(self._address, self._authkey).settings()
+        logger.info("Connected to the coordinator {}:{}, lease timeout {} seconds".format(*self._address,
+                                                                                        settings['lease_timeout']))
+
+        self._workers = [FrontierConsumer(self._address, self._authkey, self._identities, self._args.log_level,
+                                          socket.gethostname(), threads=self._args.threads_per_worker,
+                                          request_policy=self._request_policy)
+                         for _ in range(self._args.num_workers)]
+        for worker in self._workers:
+            worker.start()
+        for worker in self._workers:
+            worker.join()
+
+        self._identities.stop()
+        logger.info("Elapsed time: {}".format(datetime.now() - dt_start))
+
+    def clean(self):
+        """Used to clean pending processes."""
+        for worker in self._workers:
+            try:
+                worker.terminate()
+            except (OSError, AttributeError):
+                pass
+            finally:
+                worker.join()
+
+        self._identities.stop()
@@ -0,0 +1,58 @@
+# standard imports
+import os
+
+# libraries import
+from common import cassette, transport
+
+# when set, all the Google APIs are called on this endpoint instead of the real one. It is used to run the explorer
+# against a local fake server (see the benchmarks folder)
+API_ENDPOINT_ENV = 'DRIVE_EXPLORER_API_ENDPOINT'
+
+
+def build_service(service_name, version, credentials):
+    """
+    Builds a client for one of the Google APIs. All the clients used by the explorer are created here.
+
+    :param service_name: the name of the service (e.g. drive)
+    :param version: the version of the service (e.g. v3)
+    :param credentials: the credentials used to call the APIs
+    :return: the service client
+    """
+    # the discovery module is slow to import, only the commands calling the APIs need it
+    from googleapiclient.discovery import build
+
+    client_options = None
+    api_endpoint = os.environ.get(API_ENDPOINT_ENV)
+    if api_endpoint:
+        client_options = {'api_endpoint': api_endpoint}
+
+    # Drive responses are recorded or replayed when a cassette is attached to the current process, otherwise the
+    # requests are sent with the timeouts of the RequestPolicy of the process, if any
+    http = cassette.http_for(credentials) if service_name == 'drive' else None
+    if http is None:
+        http = transport.http_for(credentials)
+    if http is not None:
+        return build(service_name, version, http=http, client_options=client_options)
+
+    return build(service_name, version, credentials=credentials, client_options=client_options)
+
+
+def new_batch_request(service, service_name, version, callback=None):
+    """
+    Creates a batch of requests to one of the Google APIs, sent with a single HTTP request
+
+    :param service: the service client of the requests (see build_service)
+    :param service_name: the name of the service (e.g. drive)
+    :param version: the version of the service (e.g. v3)
+    :param callback: called with the id, the response and the error of every request of the batch
+    :return: the googleapiclient BatchHttpRequest
+    """
+    api_endpoint = os.environ.get(API_ENDPOINT_ENV)
+    if not api_endpoint:
+        return service.new_batch_http_request(callback=callback)
+
+    # the batch endpoint comes from the discovery document, not from the API endpoint of the client
+    from googleapiclient.http import BatchHttpRequest
+
+    return BatchHttpRequest(callback=callback,
+                            batch_uri='{}/batch/{}/{}'.format(api_endpoint.rstrip('/'), service_name, version))
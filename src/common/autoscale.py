@@ -0,0 +1,167 @@
+# standard imports
+import multiprocessing
+import threading
+
+# libraries import
+from common import stats
+from common.logging import get_logger
+
+logger = get_logger(__name__)
+
+# seconds between two scaling decisions
+AUTOSCALE_INTERVAL = 1
+# fraction of the API calls throttled by Google above which the folders explored at the same time are reduced
+MAX_THROTTLED_RATIO = 0.02
+# the API latency is considered degraded when it is this many times the lowest one measured
+LATENCY_TOLERANCE = 2
+# minimum number of API calls in an interval for its latency to be meaningful
+MIN_CALLS = 5
+
+
+class ConcurrencyLimiter:
+    def __init__(self, limit, owners):
+        """
+        Limits the number of folders explored at the same time by all the threads of all the worker processes: every
+        thread takes a slot before taking a folder and gives it back once the folder is explored. The limit can be
+        changed at any time by the main process (see Autoscaler). The slots are counted per owner, a worker process, so
+        that the slots of a worker that died can be given back (see reset). It is created in the main process and
+        passed to the child processes
+
+        :param limit: the initial number of slots
+        :param owners: the number of owners, owners are numbered from 0
+        """
+        self._condition = multiprocessing.Condition()
+        self._limit = multiprocessing.RawValue('i', limit)
+        self._active = multiprocessing.RawArray('i', owners)
+
+    @property
+    def limit(self):
+        """The number of slots."""
+        return self._limit.value
+
+    def set_limit(self, limit):
+        """
+        Changes the number of slots, the threads holding a slot above the new limit keep it until their folder is
+        explored
+
+        :param limit: the new number of slots
+        """
+        with self._condition:
+            self._limit.value = limit
+            self._condition.notify_all()
+
+    def acquire(self, owner):
+        """
+        Waits for a free slot and takes it
+
+        :param owner: the owner taking the slot
+        """
+        with self._condition:
+            while sum(self._active) >= self._limit.value:
+                self._condition.wait()
+            self._active[owner] += 1
+
+    def release(self, owner):
+        """
+        Gives a slot back
+
+        :param owner: the owner of the slot
+        """
+        with self._condition:
+            self._active[owner] -= 1
+            self._condition.notify()
+
+    def reset(self, owner):
+        """
+        Gives back all the slots of an owner, used when a worker process died
+
+        :param owner: the owner
+        """
+        with self._condition:
+            self._active[owner] = 0
+            self._condition.notify_all()
+
+
+class Autoscaler(threading.Thread):
+    def __init__(self, limiter, progress_counters, task_queue, min_slots, max_slots, log_level,
+                 interval=AUTOSCALE_INTERVAL):
+        """
+        Thread used in the main process to adapt the number of folders explored at the same time. The slots are
+        reduced when Google throttles the requests or when the API latency degrades, they are increased while folders
+        are waiting to be explored. Until the first reduction the slots grow by half at every step, like a TCP slow
+        start, then by an eighth. Every decision is logged
+
+        :param limiter: the ConcurrencyLimiter shared with the workers
+        :param progress_counters: the ProgressCounters where the workers count the API calls, their latency and the
+        throttled ones
+        :param task_queue: the folders waiting to be explored
+        :param min_slots: the minimum number of slots, the initial one
+        :param max_slots: the maximum number of slots, the number of threads of all the workers
+        :param log_level: the logging level (see the standar python logging module)
+        :param interval: seconds between two decisions
+        """
+        super().__init__(daemon=True)
+        self._limiter = limiter
+        self._progress_counters = progress_counters
+        self._task_queue = task_queue
+        self._min_slots = min_slots
+        self._max_slots = max_slots
+        self._interval = interval
+        self._stopped = threading.Event()
+
+        self._last_totals = None
+        self._best_latency = None
+        self._slow_start = True
+
+        logger.setLevel(log_level)
+
+    def run(self):
+        self._last_totals = self._progress_counters.totals()
+        while not self._stopped.wait(self._interval):
+            self._scale()
+
+    def _scale(self):
+        totals = self._progress_counters.totals()
+        calls = totals['api_calls'] - self._last_totals['api_calls']
+        throttled = totals['throttle_events'] - self._last_totals['throttle_events']
+        call_seconds = (totals['api_call_microseconds'] - self._last_totals['api_call_microseconds']) / 1e6
+        self._last_totals = totals
+
+        try:
+            waiting = self._task_queue.qsize()
+        except NotImplementedError:
+            # qsize() is not available on every platform (e.g. macOS), we assume that there is always work
+            waiting = self._limiter.limit
+
+        latency = call_seconds / calls if calls >= MIN_CALLS else None
+        if latency is not None and (self._best_latency is None or latency < self._best_latency):
+            self._best_latency = latency
+
+        limit = self._limiter.limit
+        if calls and throttled / calls > MAX_THROTTLED_RATIO:
+            new_limit, reason = max(self._min_slots, min(limit * 3 // 4, limit - 1)), 'throttled'
+        elif latency is not None and latency > self._best_latency * LATENCY_TOLERANCE:
+            new_limit, reason = max(self._min_slots, limit - max(1, limit // 8)), 'latency degraded'
+        elif waiting > 0:
+            step = limit // 2 if self._slow_start else limit // 8
+            new_limit, reason = min(self._max_slots, limit + max(1, step)), 'folders waiting'
+        else:
+            new_limit, reason = limit, 'no folder waiting'
+
+        description = "{} folders waiting, {} API calls, latency {}, {} throttled".format(
+            waiting, calls, '{:.3f}s'.format(latency) if latency is not None else '-', throttled)
+        if new_limit == limit:
+            logger.debug("Autoscaling: keeping {} folders at a time ({}): {}".format(limit, reason, description))
+            return
+
+        if new_limit < limit:
+            self._slow_start = False
+        logger.info("Autoscaling: {} -> {} folders at a time ({}): {}".format(limit, new_limit, reason, description))
+        stats.inc('autoscale_decisions_total', direction='up' if new_limit > limit else 'down')
+        self._limiter.set_limit(new_limit)
+
+    def stop(self):
+        """Stops scaling and frees all the slots, so that every thread can take its poison pill."""
+        self._stopped.set()
+        self.join()
+        self._limiter.set_limit(self._max_slots)
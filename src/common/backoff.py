@@ -1,31 +1,143 @@
+# standard imports
+import socket
+
+# standard from imports
+from time import perf_counter_ns
+
 # third parties libraries
+import googleapiclient.errors
 import tenacity
 
+# libraries import
+from common import progress, stats, tracing, transport
+
 # whre all the bad requests are tried again...
 # https://developers.google.com/drive/api/v3/handle-errors#exponential-backoff
 MAX_ATTEMPTS = 30
 EXP_MULTIPLIER = 0.5
 EXP_MAX_WAIT = 60
 
+# the endpoint of the batches of requests in the stats, the requests of a batch are not counted one by one
+BATCH_ENDPOINT = 'batch'
+
 
 # In what case should tenacity try again?
 retry_exceptions = (
     # https://developers.google.com/drive/api/v3/handle-errors#403_user_rate_limit_exceeded
     tenacity.retry_if_exception_message(match=r".+?User Rate Limit Exceeded\.") |
+    # https://developers.google.com/drive/api/v3/handle-errors#429_too_many_requests
+    tenacity.retry_if_exception(lambda e: isinstance(e, googleapiclient.errors.HttpError) and e.resp.status == 429) |
     # https://developers.google.com/drive/api/v3/handle-errors#500_backend_error
-    tenacity.retry_if_exception_message(match=r".+?Internal Error")
+    tenacity.retry_if_exception_message(match=r".+?Internal Error") |
+    # the connect and read timeouts (see common.transport)
+    tenacity.retry_if_exception_type(socket.timeout)
 )
 
 
+def _before_sleep(retry_state):
+    """Called by tenacity before waiting to retry a request"""
+    exception = retry_state.outcome.exception()
+    if 'Rate Limit Exceeded' in str(exception) or getattr(getattr(exception, 'resp', None), 'status', None) == 429:
+        progress.add('throttle_events')
+
+    stats.inc('api_retries_total')
+    stats.inc('api_retry_wait_seconds_total', retry_state.next_action.sleep)
+    tracing.add_span('retry wait', 'retry', perf_counter_ns(), int(retry_state.next_action.sleep * 1e9),
+                     attempt=retry_state.attempt_number, error=str(retry_state.outcome.exception())[:200])
+
+
+def _execute(request):
+    """
+    Executes an API request, counting it in the progress counters, with its latency (see common.autoscale)
+
+    :param request: a googleapiclient HttpRequest
+    :return: the API response
+    """
+    progress.add('api_calls')
+    dt_start = perf_counter_ns()
+    try:
+        return _execute_with_stats(request)
+    finally:
+        progress.add('api_call_microseconds', (perf_counter_ns() - dt_start) // 1000)
+
+
+def _execute_with_stats(request):
+    """
+    Executes an API request, collecting the stats about it when they are enabled
+
+    :param request: a googleapiclient HttpRequest
+    :return: the API response
+    """
+    if not stats.enabled():
+        return transport.execute(request)
+
+    endpoint = getattr(request, 'methodId', None) or 'unknown'
+
+    # postproc receives the raw content of the response, so this is the cheapest place to count the bytes
+    postproc = request.postproc
+
+    def counting_postproc(resp, content):
+        stats.inc('api_bytes_received_total', len(content), endpoint=endpoint)
+        return postproc(resp, content)
+
+    request.postproc = counting_postproc
+    stats.inc('api_calls_total', endpoint=endpoint)
+    try:
+        with stats.timer('api_call_seconds', endpoint=endpoint):
+            return transport.execute(request)
+    except googleapiclient.errors.HttpError as httpe:
+        stats.inc('api_errors_total', endpoint=endpoint, status=httpe.resp.status)
+        raise
+    except socket.timeout:
+        stats.inc('api_timeouts_total', endpoint=endpoint)
+        raise
+    finally:
+        # the same request object is executed again when retried
+        request.postproc = postproc
+
+
 @tenacity.retry(stop=tenacity.stop_after_attempt(MAX_ATTEMPTS),
                 wait=tenacity.wait_exponential(multiplier=EXP_MULTIPLIER, max=EXP_MAX_WAIT),
-                retry=retry_exceptions)
+                retry=retry_exceptions,
+                before_sleep=_before_sleep)
 def call_endpoint(endpoint, params):
-    return endpoint(**params).execute()
+    return _execute(endpoint(**params))
 
 
 @tenacity.retry(stop=tenacity.stop_after_attempt(MAX_ATTEMPTS),
                 wait=tenacity.wait_exponential(multiplier=EXP_MULTIPLIER, max=EXP_MAX_WAIT),
-                retry=retry_exceptions)
+                retry=retry_exceptions,
+                before_sleep=_before_sleep)
 def execute_request(request):
-    return request.execute()
+    return _execute(request)
+
+
+@tenacity.retry(stop=tenacity.stop_after_attempt(MAX_ATTEMPTS),
+                wait=tenacity.wait_exponential(multiplier=EXP_MULTIPLIER, max=EXP_MAX_WAIT),
+                retry=retry_exceptions,
+                before_sleep=_before_sleep)
+def execute_batch(batch):
+    """
+    Executes a batch of API requests (see common.api.new_batch_request). Only the errors of the whole batch are
+    retried, the ones of every request are passed to the callback of the batch
+
+    :param batch: a googleapiclient BatchHttpRequest
+    """
+    progress.add('api_calls')
+    dt_start = perf_counter_ns()
+    try:
+        if not stats.enabled():
+            return transport.execute(batch)
+
+        stats.inc('api_calls_total', endpoint=BATCH_ENDPOINT)
+        try:
+            with stats.timer('api_call_seconds', endpoint=BATCH_ENDPOINT):
+                return transport.execute(batch)
+        except googleapiclient.errors.HttpError as httpe:
+            stats.inc('api_errors_total', endpoint=BATCH_ENDPOINT, status=httpe.resp.status)
+            raise
+        except socket.timeout:
+            stats.inc('api_timeouts_total', endpoint=BATCH_ENDPOINT)
+            raise
+    finally:
+        progress.add('api_call_microseconds', (perf_counter_ns() - dt_start) // 1000)
@@ -0,0 +1,281 @@
+# standard imports
+import errno
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import zlib
+
+# standard from imports
+from time import monotonic, sleep
+
+# libraries import
+from common.exceptions import InvalidSpillDir
+from common.logging import get_logger
+
+logger = get_logger(__name__)
+
+# when the free space on the spill disk goes below this threshold we stop spilling and we start to slow down
+MIN_FREE_DISK = 64 * 1024 * 1024
+
+
+def format_bytes(num_bytes):
+    """
+    Human readable version of a byte count, used in the log messages
+
+    :param num_bytes: the number of bytes
+    :return: a string like '12.3 MB'
+    """
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(num_bytes) < 1024:
+            return '{:.1f} {}'.format(num_bytes, unit)
+        num_bytes /= 1024
+
+    return '{:.1f} TB'.format(num_bytes)
+
+
+class ResultBuffer:
+    def __init__(self, memory_limit=256 * 1024 * 1024, spill_dir=None, log_level='INFO', min_free_disk=MIN_FREE_DISK):
+        """
+        Bounded buffer used to move the results from the FolderConsumer processes to the OutputWriter one.
+
+        Batches are pickled by the producers and kept in memory until memory_limit bytes are waiting to be written.
+        Above that limit batches are compressed and spilled to temporary files that are replayed by the consumer in
+        the same order they have been produced. Producers only slow down when the disk is also full.
+
+        :param memory_limit: maximum number of bytes waiting in memory before spilling to disk
+        :param spill_dir: the directory where the temporary spill folder is created (defaults to the system temp)
+        :param log_level: the logging level (see the standar python logging module)
+        :param min_free_disk: the free disk space, in bytes, below which batches are no longer spilled
+        :raises InvalidSpillDir: if the spill directory can not be created or written
+        """
+        self._memory_limit = memory_limit
+        self._log_level = log_level
+        self._min_free_disk = min_free_disk
+        # the spill folder is only created the first time a batch needs to be spilled
+        self._spill_root = spill_dir if spill_dir is not None else tempfile.gettempdir()
+        self._spill_dir = os.path.join(self._spill_root, 'drive-explorer-{}-{}'.format(os.getpid(), id(self)))
+        # the workers would only find out the first time they need to spill
+        try:
+            os.makedirs(self._spill_root, exist_ok=True)
+        except OSError as oe:
+            raise InvalidSpillDir("Impossible to create the spill directory {}: {}. Please refer to the "
+                                  "-sd/--spill-dir parameter".format(self._spill_root, oe.strerror))
+        if not os.access(self._spill_root, os.W_OK | os.X_OK):
+            raise InvalidSpillDir("The spill directory {} is not writable. Please refer to the -sd/--spill-dir "
+                                  "parameter".format(self._spill_root))
+
+        self._queue = multiprocessing.Queue()
+
+        # shared counters, they are also used to report the state of the buffer in the logs
+        self._memory_bytes = multiprocessing.Value('q', 0)
+        self._depth = multiprocessing.Value('q', 0)
+        self._peak_depth = multiprocessing.Value('q', 0)
+        self._peak_memory_bytes = multiprocessing.Value('q', 0)
+        self._spilled_batches = multiprocessing.Value('q', 0)
+        self._spilled_bytes = multiprocessing.Value('q', 0)
+
+        # per process state, it is reinitialized in every child process when the buffer is unpickled
+        self._spill_sequence = 0
+        self._spill_warned = False
+        self._throttle_warned = False
+        self._closed = False
+
+        logger.setLevel(self._log_level)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_spill_sequence'] = 0
+        state['_spill_warned'] = False
+        state['_throttle_warned'] = False
+        state['_closed'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        logger.setLevel(self._log_level)
+
+    @property
+    def depth(self):
+        """Number of batches waiting to be consumed."""
+        return self._depth.value
+
+    @property
+    def memory_bytes(self):
+        """Number of bytes waiting in memory to be consumed."""
+        return self._memory_bytes.value
+
+    @property
+    def spilled_batches(self):
+        """Total number of batches that have been spilled to disk."""
+        return self._spilled_batches.value
+
+    @property
+    def spilled_bytes(self):
+        """Total number of (compressed) bytes that have been spilled to disk."""
+        return self._spilled_bytes.value
+
+    def _reserve_memory(self, size, force=False):
+        """
+        Tries to reserve size bytes of memory for a new batch
+
+        :param size: the size of the batch
+        :param force: when True the memory is reserved even if above the limit
+        :return: True if the memory has been reserved
+        """
+        with self._memory_bytes.get_lock():
+            # an empty buffer always accepts a batch, no matter how big it is
+            if not force and self._memory_bytes.value > 0 and self._memory_bytes.value + size > self._memory_limit:
+                return False
+
+            self._memory_bytes.value += size
+            if self._memory_bytes.value > self._peak_memory_bytes.value:
+                self._peak_memory_bytes.value = self._memory_bytes.value
+
+        return True
+
+    def _increase_depth(self):
+        with self._depth.get_lock():
+            self._depth.value += 1
+            if self._depth.value > self._peak_depth.value:
+                self._peak_depth.value = self._depth.value
+
+    def _spill(self, payload):
+        """
+        Writes a batch to a temporary file
+
+        :param payload: the pickled batch
+        :return: the path of the spill file and its size or None if no disk space is available
+        """
+        try:
+            os.makedirs(self._spill_dir, exist_ok=True)
+            free_disk = shutil.disk_usage(self._spill_dir).free
+        except OSError as oe:
+            # e.g. the spill directory has been removed, the producers slow down as if the disk was full
+            if not self._throttle_warned:
+                logger.warning("Impossible to spill to {}: {}".format(self._spill_dir, oe))
+            return None
+
+        if free_disk < self._min_free_disk + len(payload):
+            return None
+
+        self._spill_sequence += 1
+        spill_path = os.path.join(self._spill_dir, '{}-{}.bin'.format(os.getpid(), self._spill_sequence))
+        compressed = zlib.compress(payload, 1)
+
+        try:
+            with open(spill_path, 'wb') as spill_file:
+                spill_file.write(compressed)
+        except OSError as oe:
+            if oe.errno not in (errno.ENOSPC, errno.EDQUOT):
+                raise
+
+            # we make sure not to leave partial files behind
+            try:
+                os.remove(spill_path)
+            except OSError:
+                pass
+            return None
+
+        return spill_path, len(compressed)
+
+    def put(self, rows, timeout=None):
+        """
+        Adds a batch of rows to the buffer. The call only blocks when both the memory and the disk are full.
+
+        :param rows: a list of rows
+        :param timeout: seconds after which a TimeoutError is raised if the batch is still waiting, None to wait forever
+        """
+        payload = pickle.dumps(rows, pickle.HIGHEST_PROTOCOL)
+        size = len(payload)
+
+        deadline = monotonic() + timeout if timeout is not None else None
+        wait_time = 0.05
+        while True:
+            if self._reserve_memory(size):
+                self._increase_depth()
+                self._queue.put(('m', payload))
+                return
+
+            spilled = self._spill(payload)
+            if spilled is not None:
+                spill_path, spill_size = spilled
+                if not self._spill_warned:
+                    logger.info("Result buffer above {}, spilling batches to {}"
+                                .format(format_bytes(self._memory_limit), self._spill_dir))
+                    self._spill_warned = True
+
+                with self._spilled_batches.get_lock():
+                    self._spilled_batches.value += 1
+                with self._spilled_bytes.get_lock():
+                    self._spilled_bytes.value += spill_size
+
+                self._increase_depth()
+                self._queue.put(('d', spill_path, spill_size))
+                return
+
+            # memory and disk are both full, the only option left is to slow down the producers
+            if not self._throttle_warned:
+                logger.warning("Result buffer full and no disk space left in {}, slowing down..."
+                               .format(self._spill_dir))
+                self._throttle_warned = True
+
+            if deadline is not None and monotonic() > deadline:
+                raise TimeoutError("No room left in the result buffer for {} seconds".format(timeout))
+            sleep(wait_time)
+            wait_time = min(wait_time * 2, 2)
+
+    def get(self):
+        """
+        Gets the next batch of rows, blocking until one is available
+
+        :return: a list of rows or None once the buffer has been closed
+        """
+        if self._closed:
+            return None
+
+        entry = self._queue.get()
+        if entry is None:
+            # we remember it, the sentinel is sent only once
+            self._closed = True
+            return None
+
+        with self._depth.get_lock():
+            self._depth.value -= 1
+
+        if entry[0] == 'm':
+            payload = entry[1]
+            with self._memory_bytes.get_lock():
+                self._memory_bytes.value -= len(payload)
+        else:
+            _, spill_path, _ = entry
+            with open(spill_path, 'rb') as spill_file:
+                payload = zlib.decompress(spill_file.read())
+            os.remove(spill_path)
+
+        return pickle.loads(payload)
+
+    def drain(self):
+        """
+        Discards all the batches until the buffer is closed. Used when the consumer fails, so that the producers are
+        not stuck waiting for someone to read their batches.
+        """
+        while self.get() is not None:
+            pass
+
+    def close(self):
+        """
+        Signals the consumer that no more batches will be added. It must be called once all the producers are done.
+        """
+        self._queue.put(None)
+
+    def log_summary(self):
+        """Logs some statistics about how the buffer has been used."""
+        logger.info("Result buffer: peak depth {} batches, peak memory {}, {} batches spilled to disk ({})"
+                    .format(self._peak_depth.value, format_bytes(self._peak_memory_bytes.value),
+                            self._spilled_batches.value, format_bytes(self._spilled_bytes.value)))
+
+    def cleanup(self):
+        """Removes any spill file left on disk."""
+        shutil.rmtree(self._spill_dir, ignore_errors=True)
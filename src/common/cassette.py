@@ -0,0 +1,351 @@
+# standard imports
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import threading
+
+# standard from imports
+from datetime import datetime
+from time import perf_counter, sleep
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+# third parties libraries
+import httplib2
+
+# libraries import
+from common.exceptions import CassetteMissingResponse
+from common.logging import get_logger
+from common import transport
+
+logger = get_logger(__name__)
+
+CASSETTE_VERSION = 1
+
+# the request paths are saved without this prefix, so that a cassette recorded against the real API can be replayed
+# against a local endpoint (see common.api) and vice versa
+DRIVE_PATH_PREFIX = '/drive/v3'
+
+# keys of the Drive resources whose values are anonymized when required
+NAME_KEYS = ('name', 'displayName', 'originalFilename')
+EMAIL_KEYS = ('emailAddress',)
+DOMAIN_KEYS = ('domain',)
+DROPPED_KEYS = ('photoLink',)
+
+# the cassette used by the current process: when None the Drive APIs are called as usual
+_cassette = None
+
+
+def http_for(credentials):
+    """
+    Gets the http object to be used by a Drive client in the current process
+
+    :param credentials: the credentials used to call the APIs
+    :return: the http object, None when no cassette is attached to the current process
+    """
+    if _cassette is None:
+        return None
+
+    return _cassette.http(credentials)
+
+
+def request_key(method, uri):
+    """
+    The key used to match a request with the recorded responses: the method, the path and the sorted query parameters
+
+    :param method: the HTTP method
+    :param uri: the full URI of the request
+    :return: the key as a string
+    """
+    split_uri = urlsplit(uri)
+    path = split_uri.path
+    if DRIVE_PATH_PREFIX in path:
+        path = path.split(DRIVE_PATH_PREFIX, 1)[1]
+    query = urlencode(sorted(parse_qsl(split_uri.query, keep_blank_values=True)))
+    return '{} {}?{}'.format(method, path, query)
+
+
+class _RecordingHttp:
+    def __init__(self, http, recorder):
+        self._http = http
+        self._recorder = recorder
+
+    def __getattr__(self, item):
+        return getattr(self._http, item)
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        dt_start = perf_counter()
+        response, content = self._http.request(uri, method=method, body=body, headers=headers, **kwargs)
+        self._recorder.record(method, uri, response, content, perf_counter() - dt_start)
+        return response, content
+
+
+class CassetteRecorder:
+    def __init__(self, cassette_file, log_level, anonymize=False):
+        """
+        Records all the Drive responses received by the processes in a cassette file, that can be replayed later with
+        a CassettePlayer. It is created in the main process and passed to the child processes that call attach() when
+        they start and detach() when they are done.
+
+        :param cassette_file: the output file, one JSON document per line
+        :param log_level: the logging level (see the standar python logging module)
+        :param anonymize: when True, names, emails and domains are replaced by pseudonyms before being saved. The same
+        value always gets the same pseudonym, so that the shape of the tree is preserved
+        """
+        self._cassette_file = cassette_file
+        self._log_level = log_level
+        self._anonymize = anonymize
+        self._queue = multiprocessing.Queue()
+
+        # the pseudonyms are keyed with a random secret that is never saved, so that they can not be reversed
+        self._secret = os.urandom(16)
+
+        # only used in the main process
+        self._writer_thread = None
+        self._response_count = 0
+
+        logger.setLevel(self._log_level)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_writer_thread'] = None
+        return state
+
+    def attach(self):
+        """Records the Drive responses received by the current process."""
+        global _cassette
+        _cassette = self
+
+    def detach(self):
+        """Stops recording in the current process."""
+        global _cassette
+        _cassette = None
+
+    def http(self, credentials):
+        """
+        Creates the http object used by the Drive clients while recording
+
+        :param credentials: the credentials used to call the APIs
+        :return: the http object
+        """
+        from google_auth_httplib2 import AuthorizedHttp
+
+        return _RecordingHttp(AuthorizedHttp(credentials, http=transport.build_http()), self)
+
+    def _pseudonym(self, value):
+        return hmac.new(self._secret, value.encode('utf-8'), hashlib.sha1).hexdigest()[:12]
+
+    def _anonymize_name(self, name):
+        # the extension is kept, it is a useful hint of the file type
+        root, extension = os.path.splitext(name)
+        if len(extension) > 6:
+            extension = ''
+        return 'name-{}{}'.format(self._pseudonym(name), extension)
+
+    def _anonymize_domain(self, domain):
+        return '{}.invalid'.format(self._pseudonym(domain)[:8])
+
+    def _anonymize_email(self, email):
+        local, _, domain = email.partition('@')
+        return '{}@{}'.format(self._pseudonym(local), self._anonymize_domain(domain))
+
+    def _anonymize_item(self, item):
+        if isinstance(item, list):
+            return [self._anonymize_item(value) for value in item]
+        if not isinstance(item, dict):
+            return item
+
+        anonymized = {}
+        for key, value in item.items():
+            if key in DROPPED_KEYS:
+                continue
+            if isinstance(value, str) and key in NAME_KEYS:
+                value = self._anonymize_name(value)
+            elif isinstance(value, str) and key in EMAIL_KEYS:
+                value = self._anonymize_email(value)
+            elif isinstance(value, str) and key in DOMAIN_KEYS:
+                value = self._anonymize_domain(value)
+            else:
+                value = self._anonymize_item(value)
+            anonymized[key] = value
+        return anonymized
+
+    def record(self, method, uri, response, content, elapsed):
+        """
+        Sends a response received by the current process to the main one, where it is saved
+
+        :param method: the HTTP method of the request
+        :param uri: the URI of the request
+        :param response: the httplib2 response
+        :param content: the body of the response
+        :param elapsed: seconds it took to get the response
+        """
+        content = content.decode('utf-8') if isinstance(content, bytes) else content
+        if self._anonymize:
+            try:
+                content = json.dumps(self._anonymize_item(json.loads(content)))
+            except ValueError:
+                # we never save what we are not able to anonymize
+                content = ''
+
+        self._queue.put({
+            'key': request_key(method, uri),
+            'status': response.status,
+            'content_type': response.get('content-type', 'application/json; charset=UTF-8'),
+            'content': content,
+            'elapsed': elapsed,
+        })
+
+    def start(self):
+        """Starts recording in the main process and writing the responses sent by all the processes."""
+        self.attach()
+        self._writer_thread = threading.Thread(target=self._write, daemon=True)
+        self._writer_thread.start()
+
+    def _write(self):
+        with open(self._cassette_file, 'w') as cassette_file:
+            cassette_file.write(json.dumps({'version': CASSETTE_VERSION, 'anonymized': self._anonymize,
+                                            'created': datetime.now().isoformat(timespec='seconds')}) + '\n')
+            while True:
+                response = self._queue.get()
+                if response is None:
+                    break
+
+                cassette_file.write(json.dumps(response) + '\n')
+                self._response_count += 1
+
+    def finish(self):
+        """Saves the remaining responses and closes the cassette. To be called once all the child processes are over."""
+        self.detach()
+        self._queue.put(None)
+        self._writer_thread.join()
+        logger.info("Recorded {} responses in {}".format(self._response_count, self._cassette_file))
+
+
+class _ReplayHttp:
+    def __init__(self, player):
+        self._player = player
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        return self._player.play(method, uri)
+
+    def close(self):
+        pass
+
+
+class CassettePlayer:
+    def __init__(self, cassette_file, log_level, speed=0):
+        """
+        Serves the Drive responses saved by a CassetteRecorder, so that an exploration can be repeated offline. The
+        cassette is indexed in the main process, the child processes only read the responses they need. It is passed
+        to the child processes that call attach() when they start and detach() when they are done.
+
+        :param cassette_file: the cassette to replay
+        :param log_level: the logging level (see the standar python logging module)
+        :param speed: 0 to serve the responses as fast as possible, 1 to wait as long as the original requests took, 2
+        to wait half of it and so on
+        """
+        self._cassette_file = cassette_file
+        self._log_level = log_level
+        self._speed = speed
+
+        logger.setLevel(self._log_level)
+
+        # we only keep the position of every response in the file, the same request may have been answered more
+        # than once (e.g. an error followed by a successful retry), the responses are served in the same order
+        self._index = {}
+        with open(self._cassette_file, 'rb') as cassette_file:
+            header = json.loads(cassette_file.readline())
+            if header.get('version') != CASSETTE_VERSION:
+                raise ValueError("Unsupported cassette version: {}".format(header.get('version')))
+
+            while True:
+                offset = cassette_file.tell()
+                line = cassette_file.readline()
+                if not line:
+                    break
+                self._index.setdefault(json.loads(line)['key'], []).append(offset)
+
+        # per process state, it is reinitialized in every child process (see _reset)
+        self._pid = None
+        self._file = None
+        self._played = None
+        self._lock = None
+
+        logger.info("Replaying {} requests from {}".format(len(self._index), self._cassette_file))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pid'] = None
+        state['_file'] = None
+        state['_played'] = None
+        state['_lock'] = None
+        return state
+
+    def _reset(self):
+        # forked processes inherit the open file of the parent, sharing its position, so every process opens its own
+        self._pid = os.getpid()
+        self._file = open(self._cassette_file, 'rb')
+        self._played = {}
+        self._lock = threading.Lock()
+
+    def attach(self):
+        """Serves the Drive responses of the current process from the cassette."""
+        global _cassette
+        _cassette = self
+
+    def detach(self):
+        """Stops replaying in the current process."""
+        global _cassette
+        _cassette = None
+        if self._pid == os.getpid():
+            self._file.close()
+            self._pid = None
+
+    def http(self, credentials):
+        """
+        Creates the http object used by the Drive clients while replaying, credentials are not used
+
+        :param credentials: the credentials used to call the APIs
+        :return: the http object
+        """
+        return _ReplayHttp(self)
+
+    def play(self, method, uri):
+        """
+        Gets the next recorded response for a request
+
+        :param method: the HTTP method of the request
+        :param uri: the URI of the request
+        :return: the httplib2 response and its content
+        """
+        key = request_key(method, uri)
+        offsets = self._index.get(key)
+        if offsets is None:
+            raise CassetteMissingResponse("No response recorded in {} for {}".format(self._cassette_file, key))
+
+        if self._pid != os.getpid():
+            self._reset()
+
+        with self._lock:
+            # once all the responses have been served, the last one is repeated
+            played = self._played.get(key, 0)
+            self._played[key] = played + 1
+
+            self._file.seek(offsets[min(played, len(offsets) - 1)])
+            recorded = json.loads(self._file.readline())
+
+        if self._speed > 0:
+            sleep(recorded['elapsed'] / self._speed)
+
+        response = httplib2.Response({'status': recorded['status'], 'content-type': recorded['content_type']})
+        return response, recorded['content'].encode('utf-8')
+
+    def start(self):
+        """Starts replaying in the main process."""
+        self.attach()
+
+    def finish(self):
+        """Stops replaying in the main process."""
+        self.detach()
@@ -2,19 +2,90 @@
 import multiprocessing
 import os
 import sys
+import threading
 
-# third parties from imports
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
+# standard from imports
+from datetime import datetime, timedelta, timezone
+from time import monotonic
+
+# third parties libraries
+import googleapiclient.errors
 
 # libraries import
+from common.api import build_service
+from common import progress, stats, tracing
 from common.backoff import execute_request
 from common.exceptions import manage_generic_exception
-from commands.credential import GoogleCredential
+from common.identities import FAILOVER_STATUSES
 from common.logging import get_logger
+from common.profiling import run_profiled
+from common.scheduler import subtask_marker
+from common.skeleton import folder_key
 
 logger = get_logger(__name__)
 
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# phases of the tasks of the skeleton strategy: the folder tree is expanded first listing only the sub folders, every
+# folder found gets a second task that lists its files (see DriveWorker)
+SKELETON_PHASE = 'skeleton'
+FILES_PHASE = 'files'
+
+# the rest of a folder listed for too many pages is split in this many createdTime ranges, listed in parallel
+PARTITIONS_PER_SPLIT = 4
+# createdTime ranges shorter than this are not split anymore, their items are listed one page after another
+MIN_PARTITION_DURATION = timedelta(seconds=1)
+
+# the fields of the items listed, the ones written in the rows (see file_row)
+FILE_FIELDS = 'id,mimeType,name,size,trashed,teamDriveId,createdTime,modifiedTime,parents,webViewLink,' \
+              'permissions(allowFileDiscovery,domain,emailAddress,role,type)'
+# the checksum of the content, only listed when looking for duplicates: Google documents have none
+CHECKSUM_FIELD = 'md5Checksum'
+
+# a consumer thread starts over after an exception at most this many times
+MAX_CONSUMER_RESTARTS = 5
+# seconds between two messages telling the scheduler that a thread is still exploring its folder
+HEARTBEAT_INTERVAL = 10
+# seconds the last rows of a thread that is exiting wait for room in the result buffer
+FINAL_FLUSH_TIMEOUT = 600
+
+
+def _parse_time(value):
+    # Drive returns RFC 3339 timestamps in UTC, like 2019-02-14T10:21:43.459Z
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def _format_time(value):
+    return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}Z'.format(value.microsecond // 1000)
+
+
+def file_row(gdrive_file, full_name, checksums=False):
+    """
+    Transforms an item returned by the Google API in the row written by the output writers
+
+    :param gdrive_file: the item, with the FILE_FIELDS
+    :param full_name: the full name of the item, with the names of its parent folders
+    :param checksums: has the item been listed with its CHECKSUM_FIELD?
+    :return: the row as a dictionary
+    """
+    row = {
+        'id': gdrive_file.get('id', ''),
+        'mimeType': gdrive_file.get('mimeType'),
+        'name': full_name,
+        'size': gdrive_file.get('size'),
+        'trashed': gdrive_file.get('trashed'),
+        'teamDriveId': gdrive_file.get('teamDriveId'),
+        'createdTime': gdrive_file.get('createdTime'),
+        'modifiedTime': gdrive_file.get('modifiedTime'),
+        'parents': gdrive_file.get('parents'),
+        'url': gdrive_file.get('webViewLink'),
+        'permissions': gdrive_file.get('permissions', {}),
+    }
+    # the writers take their columns from the first row, every row has the checksum even when the item has none
+    if checksums:
+        row[CHECKSUM_FIELD] = gdrive_file.get(CHECKSUM_FIELD)
+    return row
+
 
 def permissions_to_string(file_id, drive_permissions):
     """
@@ -68,39 +139,82 @@ def permissions_to_string(file_id, drive_permissions):
 
 
 class FolderConsumer(multiprocessing.Process):
-    def __init__(self, task_queue, results_list, results_lock, email, credential_file, file_match,
-                 type_match, log_level, folder_separator=os.sep, include_trashed=False, recursive=True):
+    def __init__(self, task_queue, results_buffer, identities, file_match, type_match, log_level,
+                 folder_separator=os.sep, include_trashed=False, recursive=True, stats_collector=None,
+                 progress_counters=None, progress_slot=None, profile_dir=None, profile_sample_interval=0,
+                 trace_collector=None, drive_cassette=None, threads=1, split_pages=0, skeleton_cache=None,
+                 concurrency_limiter=None, request_policy=None, max_depth=None, limit_reached=None, checksums=False,
+                 folder_rows=False):
         """
-        This is the class used by the child processes to explore the Google Drive folders
-
-        :param task_queue: the queue from which the processes take the folders to be explored
-        :param results_list: once the exploration is over, the data to be extracted is saved in this list
-        :param results_lock: lock used to access the result_list
-        :param email: the email address of the current credeltials
-        :param credential_file: the credential file of the project
+        This is the class used by the child processes to explore the Google Drive folders. With more than one thread,
+        every thread takes folders from the queue on its own, with its own Drive client
+
+        :param task_queue: the SchedulerClient from which the processes take the folders to be explored, it is told
+        what every thread hands over, so that the folders of a thread or a process that dies can be explored again
+        (see common.scheduler)
+        :param results_buffer: once the exploration is over, the data to be extracted is saved in this buffer
+        :param identities: the IdentityPool used to call the APIs, sharing the access tokens of the main process
         :param file_match: the regex to look for files
         :param type_match: the regex to look for file types
         :param log_level: the logging level (see the standar python logging module)
         :param folder_separator: the character used as folder separator (defaults to os.sep)
         :param include_trashed: should trashed items be included in the research?
         :param recursive: should the explore work recursevly on folders?
+        :param stats_collector: the StatsCollector used to send the stats to the main process, None if disabled
+        :param progress_counters: the ProgressCounters shared with the main process, None if disabled
+        :param progress_slot: the slot of progress_counters owned by this process
+        :param profile_dir: when set, every thread of the process runs under cProfile and the stats are saved in this
+        directory
+        :param profile_sample_interval: milliseconds between two wall-clock samples when profiling, 0 to disable them
+        :param trace_collector: the TraceCollector used to send trace events to the main process, None if disabled
+        :param drive_cassette: the CassetteRecorder or CassettePlayer used for the Drive responses, None if disabled
+        :param threads: the number of threads exploring folders in the process, the main process puts one poison pill
+        per thread in the queue
+        :param split_pages: number of pages after which the rest of a folder is split in partitions (see DriveWorker)
+        :param skeleton_cache: the SkeletonCache of the folders already queued, None if disabled. When enabled, the rows
+        are sent to the writer with their folder and its sub folders, so that the writer can reconcile them
+        :param concurrency_limiter: the ConcurrencyLimiter shared by all the threads of all the workers, None if the
+        number of folders explored at the same time is not limited (see common.autoscale)
+        :param request_policy: the RequestPolicy with the timeouts and the hedging of the API requests, None for the
+        defaults of googleapiclient (see common.transport)
+        :param max_depth: the sub folders deeper than this are not explored, None for no limit (see DriveWorker)
+        :param limit_reached: the multiprocessing Event set by the writer once it has all the results required, the
+        folder being explored is abandoned. None if the results are not limited
+        :param checksums: are the files listed with their checksums? (see DriveWorker)
+        :param folder_rows: are the rows of the folders sent whatever the filters? (see DriveWorker)
         """
 
         super().__init__(daemon=False)
 
         self._task_queue = task_queue
-        self._result_list = results_list
-        self._result_lock = results_lock
-        self._user = email
-        self._credential_file = credential_file
+        self._result_buffer = results_buffer
+        self._identities = identities
         self._file_match = file_match
         self._type_match = type_match
         self._log_level = log_level
         self._folder_separator = folder_separator
         self._include_trashed = include_trashed
         self._recursive = recursive
-
-        self._credentials = None
+        self._stats_collector = stats_collector
+        self._progress_counters = progress_counters
+        self._progress_slot = progress_slot
+        self._profile_dir = profile_dir
+        self._profile_sample_interval = profile_sample_interval
+        self._trace_collector = trace_collector
+        self._drive_cassette = drive_cassette
+        self._threads = threads
+        self._split_pages = split_pages
+        self._skeleton_cache = skeleton_cache
+        self._concurrency_limiter = concurrency_limiter
+        self._request_policy = request_policy
+        self._max_depth = max_depth
+        self._limit_reached = limit_reached
+        self._checksums = checksums
+        self._folder_rows = folder_rows
+
+        # per process state, created in the child process
+        self._drive_clients = None
+        self._thread_state = None
 
     def run(self):
         """
@@ -109,12 +223,32 @@ class FolderConsumer(multiprocessing.Process):
         :return: None
         """
         logger.setLevel(self._log_level)
+        if self._stats_collector is not None:
+            self._stats_collector.attach()
+        if self._progress_counters is not None:
+            self._progress_counters.attach(self._progress_slot)
+        if self._trace_collector is not None:
+            self._trace_collector.attach(self.name)
+        if self._drive_cassette is not None:
+            self._drive_cassette.attach()
+        if self._request_policy is not None:
+            self._request_policy.attach()
+
         try:
             self._safe_run()
         except KeyboardInterrupt as ke:
             logger.debug("KeyboardInterrupt in FolderConsumer.run".format(ke))
         except Exception as e:
             manage_generic_exception(e, sys.exc_info(), "FolderConsume.run")
+        finally:
+            if self._stats_collector is not None:
+                self._stats_collector.detach()
+            if self._trace_collector is not None:
+                self._trace_collector.detach()
+            if self._drive_cassette is not None:
+                self._drive_cassette.detach()
+            if self._request_policy is not None:
+                self._request_policy.detach()
 
     def _safe_run(self):
         """
@@ -122,61 +256,255 @@ class FolderConsumer(multiprocessing.Process):
 
         :return: None
         """
+        self._drive_clients = DriveClients(self._identities)
+        # by thread: whether it holds a slot of the concurrency limiter and whether it has taken its poison pill
+        self._thread_state = threading.local()
+        if self._threads == 1:
+            self._profiled_consume('{}-{}'.format(self.name, os.getpid()))
+            return
+
+        threads = [threading.Thread(target=self._profiled_consume,
+                                    args=('{}-{}-{}'.format(self.name, os.getpid(), thread_i),),
+                                    name='{}-{}'.format(self.name, thread_i))
+                   for thread_i in range(self._threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _profiled_consume(self, profile_name):
+        # cProfile and the wall-clock sampler only see the thread they are started in, every thread is profiled on its
+        # own and the profiles are merged at the end with the ones of the other processes
+        if self._profile_dir is None:
+            self._safe_consume()
+        else:
+            run_profiled(self._safe_consume, self._profile_dir, profile_name, self._profile_sample_interval)
+
+    def _safe_consume(self):
+        # after an exception the thread starts over, the folders it was holding are queued again by the scheduler. An
+        # exception after the poison pill, while sending the last rows, would leave the thread waiting for a folder
+        # forever: the pill is queued again, the thread explores the folders queued again and then exits
+        self._thread_state.holds_slot = False
+        self._thread_state.pill_taken = False
+        for restart in range(MAX_CONSUMER_RESTARTS + 1):
+            try:
+                self._consume()
+                return
+            except Exception as e:
+                manage_generic_exception(e, sys.exc_info(), "FolderConsume thread")
+                self._release_slot()
+                queued, given_up = self._task_queue.release_thread()
+                if restart == MAX_CONSUMER_RESTARTS:
+                    logger.error("{}: too many errors, exiting, {} folders queued again, {} given up"
+                                 .format(threading.current_thread().name, queued, given_up))
+                    return
+
+                if self._thread_state.pill_taken:
+                    self._thread_state.pill_taken = False
+                    self._task_queue.put(None)
+                logger.warning("{}: starting over, {} folders queued again, {} given up"
+                               .format(threading.current_thread().name, queued, given_up))
+
+    def _consume(self):
+        """
+        Explores the folders taken from the queue until a poison pill is received
 
-        # we get the credentials
-        with GoogleCredential(self._credential_file, self._user, log_level=self._log_level) as google_cred:
-            email, self._credentials = google_cred.get_credentials()
-
-        # we renew the credentials if required
-        if self._credentials.expired:
-            self._credentials.refresh(Request())
+        :return: None
+        """
 
-        # used to hold results before synching them to the result shared list()
+        # used to hold results before synching them to the shared result buffer, one per thread. With a skeleton
+        # cache it holds (folder, rows, sub folders) tuples
         result_buffer = []
+        buffered_rows = 0
+        # the ids of the buffered rows of the folder being explored, the scheduler is told when they are synched
+        folder_rows = []
 
         while True:
 
-            next_task = self._task_queue.get()
+            next_task = self._get_task()
             logger.debug("Next task is: {}".format(next_task))
 
             if next_task is None:
                 # Poison pill means shutdown
-                logger.debug('{}: Exiting'.format(self.name))
+                logger.debug('{}: Exiting'.format(threading.current_thread().name))
 
-                self._task_queue.task_done()
+                self._task_done()
                 if len(result_buffer) > 0:
-                    with self._result_lock:
-                        self._result_list.extend(result_buffer)
-                    result_buffer.clear()
+                    with stats.timer('result_buffer_put_seconds'):
+                        self._result_buffer.put(result_buffer, timeout=FINAL_FLUSH_TIMEOUT)
+                    self._task_queue.flushed([])
+                    result_buffer = []
                 break
 
-            if len(result_buffer) > 1_000:
-                # we dump everything to the sared results
-                with self._result_lock:
-                    self._result_list.extend(result_buffer)
-                logger.debug("self._result_list size from drive_utils: {}".format(len(self._result_list)))
-                result_buffer.clear()
+            # we explore the folder, every page is handed over as soon as it is received
+            identity = self._identities.choose(next_task)
+            pages = 0
+            folder_rows = []
+            # the sub folders already queued by a worker that died exploring the folder
+            handed_folders = set(next_task.get('handed_over', {}).get('folders', ()))
+            heartbeat = monotonic()
+            try:
+                with stats.timer('folder_seconds'), tracing.span('folder', 'worker', folder=next_task.get('id'),
+                                                                 path=next_task.get('name')):
+                    drive_worker = DriveWorker(next_task, self._drive_clients.credentials(identity), self._file_match,
+                                               self._type_match, self._folder_separator, self._include_trashed,
+                                               self._recursive, throttle=lambda: self._identities.throttle(identity),
+                                               drive_sdk=self._drive_clients.get(identity),
+                                               split_pages=self._split_pages, max_depth=self._max_depth,
+                                               checksums=self._checksums, folder_rows=self._folder_rows)
+                    for files_and_folders in drive_worker.pages():
+                        if self._limit_reached is not None and self._limit_reached.is_set():
+                            logger.debug("{}: result limit reached, leaving folder {}"
+                                         .format(threading.current_thread().name, next_task.get('name')))
+                            break
+                        pages += 1
+
+                        # folders are queued to be explored, but the ones of the skeleton cache that have been queued
+                        # at the start. The same folder comes back for partitions and files listings
+                        sub_folders = []
+                        for folder in files_and_folders.get('folders', []):
+                            if self._skeleton_cache is not None and folder.get('id') != next_task.get('id'):
+                                sub_folders.append(folder_key(folder))
+                                if sub_folders[-1] in self._skeleton_cache:
+                                    continue
+                            if folder.get('id') in handed_folders:
+                                continue
+                            logger.debug("Process {} Added child folder {} form task: {}".format(self, folder,
+                                                                                                  next_task))
+                            self._task_queue.put(folder)
+                            progress.add('folders_queued')
+
+                        # files are appended to the results
+                        files = files_and_folders.get('files', [])
+                        if self._skeleton_cache is None:
+                            result_buffer.extend(files)
+                        else:
+                            result_buffer.append((folder_key(next_task), files, sub_folders))
+                        buffered_rows += len(files)
+                        folder_rows.extend(row['id'] for row in files)
+                        stats.inc('files_emitted_total', len(files))
+                        progress.add('files_emitted', len(files))
+
+                        # the folders are also confirmed in batches, not to hold their rows in the writer for long. When
+                        # the results are limited they are sent at once, the writer decides when to stop
+                        if buffered_rows > 1_000 or len(result_buffer) > 100 \
+                                or (self._limit_reached is not None and buffered_rows > 0):
+                            # we dump everything to the shared results
+                            with stats.timer('result_buffer_put_seconds'):
+                                self._result_buffer.put(result_buffer)
+                            self._task_queue.flushed(folder_rows)
+                            heartbeat = monotonic()
+                            logger.debug("Result buffer depth from drive_utils: {}".format(self._result_buffer.depth))
+                            result_buffer = []
+                            buffered_rows = 0
+                            folder_rows = []
+                        elif monotonic() - heartbeat > HEARTBEAT_INTERVAL:
+                            # a folder with many pages and few matches is not stuck
+                            self._task_queue.heartbeat()
+                            heartbeat = monotonic()
+            except googleapiclient.errors.HttpError as httpe:
+                # once a page has been handed over, the folder can not be explored again without duplicates. A folder of
+                # the skeleton cache may have been deleted since the previous exploration
+                if httpe.resp.status not in FAILOVER_STATUSES or pages > 0 \
+                        or (len(self._identities) == 1 and not next_task.get('cached')):
+                    raise
+                self._failover(next_task, identity, httpe)
+                self._task_done()
+                continue
+            stats.inc('folders_explored_total')
+            progress.add('folders_done')
+
+            self._task_done()
+
+    def _get_task(self):
+        # with a concurrency limiter the thread waits for a slot before taking a folder
+        if self._concurrency_limiter is not None:
+            self._concurrency_limiter.acquire(self._progress_slot)
+            self._thread_state.holds_slot = True
+        task = self._task_queue.get()
+        if task is None:
+            self._thread_state.pill_taken = True
+        return task
+
+    def _task_done(self):
+        self._task_queue.task_done()
+        self._release_slot()
+
+    def _release_slot(self):
+        # the slot is only given back once, a thread starting over after an error may have given it back already
+        if self._thread_state.holds_slot:
+            self._concurrency_limiter.release(self._progress_slot)
+            self._thread_state.holds_slot = False
+
+    def _failover(self, task, identity, error):
+        """
+        Re-routes a folder that an identity can not read to the other identities: the folder is queued again and the
+        identity is added to the ones already tried. Nothing of the folder has been emitted yet, so the results are
+        the same as if it had been read at the first attempt
+
+        :param task: the folder to explore
+        :param identity: the index of the identity that failed
+        :param error: the HttpError received
+        """
+        email = self._identities.email(identity)
+        tried = list(task.get('tried', [])) + [email]
+        stats.inc('identity_failovers_total', identity=email)
+
+        if len(tried) >= len(self._identities):
+            if task.get('cached'):
+                logger.debug("Folder {} of the skeleton cache no longer readable: {}".format(task.get('id'), error))
+            else:
+                logger.error("Folder {} ({}) can not be read by any of the identities, last error: {}"
+                             .format(task.get('name'), task.get('id'), error))
+            return
 
-            # we explore the folder
-            drive_worker = DriveWorker(next_task, self._credentials, self._file_match, self._type_match,
-                                       self._folder_separator, self._include_trashed, self._recursive)
-            files_and_folders = drive_worker()
+        logger.debug("Folder {} can not be read by {}, trying another identity".format(task.get('id'), email))
+        self._task_queue.put(dict(task, tried=tried))
 
-            # files are appended to the results
-            for file in files_and_folders.get('files', []):
-                result_buffer.append(file)
 
-            # folders are queued to be explored
-            for folder in files_and_folders.get('folders', []):
-                logger.debug("Process {} Added child folder {} form task: {}".format(self, folder, next_task))
-                self._task_queue.put(folder)
+class DriveClients:
+    def __init__(self, identities):
+        """
+        The Drive clients of a process. httplib2 connections can not be shared by threads, so every thread has its own
+        client for every identity, kept for all the folders it explores so that the connections are reused
 
-            self._task_queue.task_done()
+        :param identities: the IdentityPool of the process
+        """
+        self._identities = identities
+        self._credentials = {}
+        self._local = threading.local()
+
+    def credentials(self, identity):
+        """
+        Gets the credentials of an identity, shared by all the threads of the process
+
+        :param identity: the index of the identity
+        :return: the credentials
+        """
+        # the access tokens are renewed by the main process, we only read them
+        if identity not in self._credentials:
+            self._credentials[identity] = self._identities.credentials(identity)
+        return self._credentials[identity]
+
+    def get(self, identity):
+        """
+        Gets the Drive client of an identity for the current thread
+
+        :param identity: the index of the identity
+        :return: the Drive client
+        """
+        drive_sdks = getattr(self._local, 'drive_sdks', None)
+        if drive_sdks is None:
+            drive_sdks = self._local.drive_sdks = {}
+        if identity not in drive_sdks:
+            drive_sdks[identity] = build_service('drive', 'v3', self.credentials(identity))
+        return drive_sdks[identity]
 
 
 class DriveWorker:
     def __init__(self, next_task, credentials, file_match, type_match, folder_separator=os.sep, include_trashed=False,
-                 recursive=True):
+                 recursive=True, throttle=None, drive_sdk=None, split_pages=0, max_depth=None, checksums=False,
+                 folder_rows=False):
         """
         This class will call the Google APIs and get the files in the folders
 
@@ -187,6 +515,16 @@ class DriveWorker:
         :param folder_separator: the folder separator character, defaults to os.sep
         :param include_trashed: should trashed items be scanned?
         :param recursive: are we going to traverse folders recursively?
+        :param throttle: called before every request to respect the rate of the identity, None for no limit
+        :param drive_sdk: the Drive client to be used, None to create a new one
+        :param split_pages: number of pages after which the rest of a folder is split in createdTime ranges, that are
+        explored in parallel as separate tasks. 0 to always list a folder one page after another
+        :param max_depth: the sub folders deeper than this are not explored, the folders the exploration starts from
+        are at depth 0. None for no limit
+        :param checksums: are the files listed with their md5Checksum, to look for duplicates? It is not listed by
+        default, so that the requests (and the cassettes) of the other explorations do not change
+        :param folder_rows: are the rows of the folders sent whatever the file name and type filters? The totals of
+        the folders are computed from the tree of the folders (see output.rollup)
         """
 
         self._next_task = next_task
@@ -196,22 +534,85 @@ class DriveWorker:
         self._folder_separator = folder_separator
         self._include_trashed = include_trashed
         self._recursive = recursive
+        self._throttle = throttle
+        self._split_pages = split_pages
+        self._max_depth = max_depth
+        self._checksums = checksums
+        self._folder_rows = folder_rows
+
+        # the depth of the folder, its sub folders are one level deeper
+        self._depth = next_task.get('depth', 0)
 
-        if self._credentials.expired:
-            self._credentials.refresh(Request())
+        # with the skeleton strategy the task only lists the sub folders or only the files of the folder
+        self._phase = next_task.get('phase')
+
+        # a folder queued again after its worker died: what the worker had already handed over is skipped
+        handed_over = next_task.get('handed_over', {})
+        self._handed_rows = set(handed_over.get('rows', ()))
+        self._handed_subtasks = set(handed_over.get('subtasks', ()))
 
         # Properties used outside the init
-        self._drive_sdk = build('drive', 'v3', credentials=self._credentials)
+        self._drive_sdk = drive_sdk if drive_sdk is not None else build_service('drive', 'v3', self._credentials)
 
-    def _list_files(self, root_folder_id, trashed=False):
+    def _split(self, drive_list_params, start, skip, trashed, partition):
+        """
+        Splits the rest of a folder listing, sorted by createdTime, in PARTITIONS_PER_SPLIT disjoint ranges between the
+        last item listed and the newest one. The items already listed that share the createdTime of the last one are
+        skipped by the first range, so that every item is emitted once
+
+        :param drive_list_params: the parameters of the listing
+        :param start: the createdTime of the last item listed
+        :param skip: the ids of the items already listed created at start
+        :param trashed: are trashed items listed?
+        :param partition: the range being listed, None for the whole folder
+        :return: the list of partitions, empty if the rest of the listing is too short in time to be split
         """
-        Internal method used to call the Google API
+        end = partition.get('to') if partition is not None else None
+
+        # the newest item tells us how the rest of the listing can be split evenly
+        if self._throttle is not None:
+            self._throttle()
+        newest = execute_request(self._drive_sdk.files().list(**dict(drive_list_params, pageSize=1,
+                                                                     orderBy='createdTime desc',
+                                                                     fields='files(createdTime)')))
+        if not newest.get('files'):
+            return []
+
+        step = (_parse_time(newest['files'][0]['createdTime']) - _parse_time(start)) / PARTITIONS_PER_SPLIT
+        if step < MIN_PARTITION_DURATION:
+            return []
+
+        skip = list(skip)
+        if partition is not None and partition['from'] == start:
+            skip.extend(partition.get('skip', []))
+
+        # the last range keeps the upper bound of the range being split, none for a whole folder, so that the items
+        # created while exploring are not lost
+        bounds = [start] + [_format_time(_parse_time(start) + step * i) for i in range(1, PARTITIONS_PER_SPLIT)] \
+            + [end]
+        return [{'from': bounds[i], 'to': bounds[i + 1], 'trashed': trashed, 'skip': skip if i == 0 else []}
+                for i in range(PARTITIONS_PER_SPLIT)]
+
+    def _list_files(self, root_folder_id, trashed=False, partition=None):
+        """
+        Internal method used to call the Google API, one page at a time
 
         :param root_folder_id: the folder to explore
         :param trashed: should trashed items be explored?
-        :return: a list containing all the results from the Google APIs
+        :param partition: the createdTime range to be listed (see _split), None for the whole folder
+        :return: a generator of tuples with the items of a page and the list of partitions in which the rest of the
+        folder has been split, the partitions are only in the last tuple and only when the folder has been split
         """
         trashed_str = 'true' if trashed else 'false'
+        query = "'{}' in parents and trashed = {}".format(root_folder_id, trashed_str)
+        skip = ()
+        if partition is not None:
+            query += " and createdTime >= '{}'".format(partition['from'])
+            if partition.get('to'):
+                query += " and createdTime < '{}'".format(partition['to'])
+            skip = set(partition.get('skip', ()))
+        if self._phase == SKELETON_PHASE:
+            query += " and mimeType = '{}'".format(FOLDER_MIME_TYPE)
 
         # https://developers.google.com/drive/api/v3/reference/files/list
         # https://developers.google.com/drive/api/v3/performance#partial
@@ -219,84 +620,167 @@ class DriveWorker:
         page_size = 1000
         drive_list_params = {
             'pageSize': page_size,
-            'q': "'{}' in parents and trashed = {}".format(root_folder_id, trashed_str),
-            'orderBy': 'name',
-            'fields': 'files(id,mimeType,name,size,trashed,teamDriveId,'
-                      'createdTime,modifiedTime,parents,webViewLink,'
-                      'permissions(allowFileDiscovery,domain,emailAddress,role,type)),'
-                      'nextPageToken',
+            'q': query,
+            # folders that may be split are listed by creation time, so that the rest can be split in time ranges
+            'orderBy': 'createdTime' if self._split_pages else 'name',
+            'fields': 'files({}{}),nextPageToken'.format(FILE_FIELDS, ',' + CHECKSUM_FIELD if self._checksums else ''),
             'supportsTeamDrives': True,
             'includeTeamDriveItems': True,
         }
+        if self._phase == SKELETON_PHASE:
+            # the rows of the folders are written by the files listing of their parent
+            drive_list_params['fields'] = 'files(id,name,teamDriveId,createdTime),nextPageToken'
 
         g_drive_files = self._drive_sdk.files()
         list_request = g_drive_files.list(**drive_list_params)
 
-        folder_files = []
+        # the createdTime of the last item listed and the ids of the items created at the same time
+        last_created = None
+        last_created_ids = []
+        pages = 0
         while list_request is not None:
-            # all the paginated results are queued in one single list
-            folder_items = execute_request(list_request)
-            folder_files.extend(folder_items.get('files', []))
+            # a folder with many pages would be the longest task of the exploration, the rest of it is split
+            if self._split_pages and pages >= self._split_pages and last_created is not None:
+                partitions = self._split(drive_list_params, last_created, last_created_ids, trashed, partition)
+                if partitions:
+                    logger.info("Folder {} has more than {} pages, the rest of it is split in {} partitions"
+                                .format(root_folder_id, pages, len(partitions)))
+                    stats.inc('folder_partitions_total', len(partitions))
+                    yield [], partitions
+                    break
+
+            if self._throttle is not None:
+                self._throttle()
+            with tracing.span('files.list', 'api', folder=root_folder_id, page=pages + 1):
+                folder_items = execute_request(list_request)
             list_request = g_drive_files.list_next(list_request, folder_items)
+            pages += 1
 
-        return folder_files
+            page_files = [item for item in folder_items.get('files', []) if item.get('id') not in skip]
+            for item in page_files:
+                if item.get('createdTime') != last_created:
+                    last_created = item.get('createdTime')
+                    last_created_ids = []
+                last_created_ids.append(item.get('id'))
 
-    def __call__(self):
+            # every page is handed over as soon as it is received
+            yield page_files, []
+
+        stats.observe('folder_pages', pages)
+
+    def _to_results(self, folder_full_name, folder_files):
         """
-        This method calls the Google API and transform the results to feed the writer process. Any filter specified by
-        the user (on file name and/or type) is applied here
+        Transforms the items returned by the Google API to feed the writer process. Any filter specified by the user
+        (on file name and/or type) is applied here
 
+        :param folder_full_name: the full name of the folder of the items
+        :param folder_files: the items
         :return: a dictionary with two keys: files and folders. The first for drive files and the second for drive
         folders. The distinction is made using the mimeType
         """
-        folder_id = self._next_task.get('id')
-        folder_full_name = self._next_task.get('name')
-
-        logger.debug('[{}] Exploring folder {} -> {}'.format(self, folder_id, folder_full_name))
-        folder_files = []
-
-        # we get the list of files
-        folder_files.extend(self._list_files(folder_id))
-
-        # we also take care of trashed items
-        if self._include_trashed:
-            logger.info('{}: Including trashed files for folder '.format(folder_id))
-            folder_files.extend(self._list_files(folder_id, True))
-
-        #
         results = {'files': [], 'folders': []}
         for gdrive_file in folder_files:
             gdrive_file_id = gdrive_file.get('id', '')
 
-            new_file = {
-                'id': gdrive_file_id,
-                'mimeType': gdrive_file.get('mimeType'),
-                'name': "{}{}{}".format(folder_full_name, self._folder_separator, gdrive_file.get('name')),
-                'size': gdrive_file.get('size'),
-                'trashed': gdrive_file.get('trashed'),
-                'teamDriveId': gdrive_file.get('teamDriveId'),
-                'createdTime': gdrive_file.get('createdTime'),
-                'modifiedTime': gdrive_file.get('modifiedTime'),
-                'parents': gdrive_file.get('parents'),
-                'url': gdrive_file.get('webViewLink'),
-                'permissions': gdrive_file.get('permissions', {}),
-            }
+            new_file = file_row(gdrive_file, "{}{}{}".format(folder_full_name, self._folder_separator,
+                                                              gdrive_file.get('name')), self._checksums)
 
             # we check the the file names matches the user settings
-            if self._file_match.search(gdrive_file.get('name')) \
-                    and self._type_match.search(gdrive_file.get('mimeType')):
+            if self._phase != SKELETON_PHASE and gdrive_file_id not in self._handed_rows \
+                    and ((self._file_match.search(gdrive_file.get('name'))
+                          and self._type_match.search(gdrive_file.get('mimeType')))
+                         or (self._folder_rows and gdrive_file.get('mimeType') == FOLDER_MIME_TYPE)):
                 results['files'].append(new_file)
 
-            # if the file is a folder and the explore process is recursive, we add the folder to the results
-            if gdrive_file.get('mimeType') == 'application/vnd.google-apps.folder' and self._recursive:
+            # if the file is a folder and the explore process is recursive, we add the folder to the results. With
+            # the skeleton strategy the sub folders are only found by the skeleton tasks
+            # the sub folders below the maximum depth are listed as files, but not explored
+            if self._max_depth is not None and self._depth >= self._max_depth:
+                continue
+            if self._phase == SKELETON_PHASE \
+                    or (gdrive_file.get('mimeType') == FOLDER_MIME_TYPE and self._recursive and self._phase is None):
                 new_folder = {
                     'id': gdrive_file_id,
                     'name': "{}{}{}".format(folder_full_name, self._folder_separator, gdrive_file.get('name')),
+                    'depth': self._depth + 1,
                 }
+                if self._phase == SKELETON_PHASE:
+                    new_folder['phase'] = SKELETON_PHASE
+                # the shared drive of the folder, used to schedule the drives in turn
+                if gdrive_file.get('teamDriveId'):
+                    new_folder['drive'] = gdrive_file.get('teamDriveId')
                 results['folders'].append(new_folder)
                 logger.debug("New folder added to the results: {}".format(new_folder))
 
         return results
 
+    def pages(self):
+        """
+        Explores the folder one page at a time, so that the sub folders can be explored and the files written while the
+        rest of a big folder is still being listed, without holding all of it in memory
+
+        :return: a generator of dictionaries like the one returned by __call__, one per page. The partitions in which a
+        big folder is split are returned as folders
+        """
+        folder_id = self._next_task.get('id')
+        folder_full_name = self._next_task.get('name')
+
+        logger.debug('[{}] Exploring folder {} -> {}'.format(self, folder_id, folder_full_name))
+
+        partition = self._next_task.get('partition')
+        if partition is not None:
+            # a part of a big folder, split by another worker
+            listings = [(partition['trashed'], partition)]
+        else:
+            # we get the list of files, we also take care of trashed items
+            listings = [(False, None)]
+            if self._include_trashed:
+                logger.info('{}: Including trashed files for folder '.format(folder_id))
+                listings.append((True, None))
+
+        for trashed, listing_partition in listings:
+            for folder_files, partitions in self._list_files(folder_id, trashed, listing_partition):
+                results = self._to_results(folder_full_name, folder_files)
+
+                # the partitions are explored like folders, by the first worker available
+                results['folders'].extend(subtask for subtask in (self._subtask(partition=folder_partition)
+                                                                  for folder_partition in partitions)
+                                          if subtask_marker(subtask) not in self._handed_subtasks)
+                yield results
+
+        if self._phase == SKELETON_PHASE and partition is None:
+            # the sub folders have been queued first, so that the tree keeps opening up, then the files of the folder.
+            # The identities that could not read the folder are skipped
+            files_task = self._subtask(phase=FILES_PHASE)
+            if 'tried' in self._next_task:
+                files_task['tried'] = self._next_task['tried']
+            if subtask_marker(files_task) not in self._handed_subtasks:
+                yield {'files': [], 'folders': [files_task]}
+
+    def _subtask(self, **extra):
+        # a new task on the same folder, e.g. a partition
+        subtask = {'id': self._next_task.get('id'), 'name': self._next_task.get('name')}
+        if self._phase is not None:
+            subtask['phase'] = self._phase
+        if self._next_task.get('drive'):
+            subtask['drive'] = self._next_task.get('drive')
+        if self._depth:
+            subtask['depth'] = self._depth
+        subtask.update(extra)
+        return subtask
+
+    def __call__(self):
+        """
+        This method calls the Google API and transform the results to feed the writer process
+
+        :return: a dictionary with two keys: files and folders. The first for drive files and the second for drive
+        folders. The distinction is made using the mimeType
+        """
+        results = {'files': [], 'folders': []}
+        for page_results in self.pages():
+            results['files'].extend(page_results['files'])
+            results['folders'].extend(page_results['folders'])
+        return results
+
     # def __repr__(self):
     #     return "DriveWorker for {}".format(self._next_task)
@@ -38,6 +38,21 @@ class NoOuputhPath(OutputException):
     pass
 
 
+class InvalidSpillDir(DriveExplorerException):
+    """The directory used to spill the buffered results can not be used"""
+    pass
+
+
+class CassetteMissingResponse(DriveExplorerException):
+    """No response recorded in the cassette for a request"""
+    pass
+
+
+class InvalidCoordinator(DriveExplorerException):
+    """Missing or invalid settings of the coordinator of a distributed exploration"""
+    pass
+
+
 def manage_generic_exception(exception, info, sender='unspecified'):
     """This function is to save the details of an unmanaged exception in a pickle file for troubleshooting.
     :param exception: the exception triggered
@@ -0,0 +1,413 @@
+# standard imports
+import itertools
+import multiprocessing
+import os
+import sys
+import threading
+
+# standard from imports
+from multiprocessing.managers import BaseManager
+from time import monotonic
+
+# third parties libraries
+import googleapiclient.errors
+
+# libraries import
+from common import progress, stats
+from common.drive_utils import DriveClients, DriveWorker
+from common.exceptions import InvalidCoordinator, manage_generic_exception
+from common.identities import FAILOVER_STATUSES
+from common.logging import get_logger
+from common.scheduler import FifoPolicy
+
+logger = get_logger(__name__)
+
+# seconds a worker node waits for a folder before asking again
+LEASE_WAIT = 1
+# a folder whose lease expires this many times is given up, it is probably crashing the nodes
+MAX_LEASE_ATTEMPTS = 3
+# the methods of the frontier that the worker nodes can call
+EXPOSED_METHODS = ('settings', 'lease', 'renew', 'complete')
+
+
+def parse_address(address):
+    """
+    Parses a coordinator address
+
+    :param address: the address as host:port, the host can be omitted to use all the interfaces
+    :return: a (host, port) tuple
+    """
+    host, _, port = address.rpartition(':')
+    if not port.isdigit():
+        raise InvalidCoordinator("Invalid coordinator address {}, use host:port".format(address))
+    return host, int(port)
+
+
+class Frontier:
+    def __init__(self, settings, results_buffer, lease_timeout, log_level, policy=None):
+        """
+        The folders still to be explored when the exploration is shared by several worker nodes, possibly on other
+        machines. It lives in the coordinator and it is exposed to the nodes by a FrontierServer. The nodes lease the
+        folders, explore them and send back the rows and the sub folders: the rows go to the results buffer of the
+        coordinator. A lease that is not completed or renewed in time is given to another node, rows are only
+        accepted for a lease that is still valid, so every folder is written once.
+
+        :param settings: the exploration settings sent to the nodes (file and type regex, folder separator...)
+        :param results_buffer: the ResultBuffer read by the OutputWriter of the coordinator
+        :param lease_timeout: seconds after which a folder leased by a node that is not heard from is queued again
+        :param log_level: the logging level (see the standar python logging module)
+        :param policy: the policy choosing the next folder to lease (see common.scheduler), breadth-first if None
+        """
+        self._settings = dict(settings, lease_timeout=lease_timeout)
+        self._results_buffer = results_buffer
+        self._lease_timeout = lease_timeout
+
+        self._condition = threading.Condition()
+        self._pending = policy if policy is not None else FifoPolicy()
+        self._leases = {}
+        self._lease_ids = itertools.count(1)
+        self._closed = False
+
+        logger.setLevel(log_level)
+
+    def settings(self):
+        """The exploration settings, the same for all the nodes so that they emit the same rows."""
+        return self._settings
+
+    def add(self, task):
+        """
+        Queues a folder to be explored
+
+        :param task: the folder, a dictionary with its id and its full name
+        """
+        with self._condition:
+            self._pending.push(task)
+            self._condition.notify_all()
+
+    def _requeue_expired(self):
+        # to be called holding the condition
+        now = monotonic()
+        for lease_id, (task, deadline, node) in list(self._leases.items()):
+            if deadline > now:
+                continue
+
+            del self._leases[lease_id]
+            stats.inc('frontier_leases_expired_total')
+            attempts = task.get('attempts', 0) + 1
+            if attempts >= MAX_LEASE_ATTEMPTS:
+                logger.error("Giving up folder {} ({}), its lease expired {} times".format(task.get('name'),
+                                                                                        task.get('id'), attempts))
+                continue
+
+            logger.warning("Lease of folder {} expired on node {}, queuing it again".format(task.get('id'), node))
+            self._pending.push(dict(task, attempts=attempts))
+            self._condition.notify_all()
+
+    def lease(self, node, wait=LEASE_WAIT):
+        """
+        Leases the next folder to explore, waiting for one if none is available
+
+        :param node: the name of the node, used in the logs
+        :param wait: maximum seconds to wait for a folder
+        :return: a list with a (lease id, folder) tuple, empty if no folder is available, None when the exploration is
+        over and the node can exit
+        """
+        deadline = monotonic() + wait
+        with self._condition:
+            while not self._pending and not self._closed:
+                self._requeue_expired()
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return []
+                self._condition.wait(remaining)
+
+            if self._closed:
+                return None
+
+            task = self._pending.pop()
+            lease_id = next(self._lease_ids)
+            self._leases[lease_id] = (task, monotonic() + self._lease_timeout, node)
+            return [(lease_id, task)]
+
+    def renew(self, lease_ids):
+        """
+        Extends leases, called by the nodes while they are exploring big folders
+
+        :param lease_ids: the leases to extend
+        :return: the leases that are no longer valid, their folders have been given to another node
+        """
+        lost = []
+        with self._condition:
+            for lease_id in lease_ids:
+                if lease_id in self._leases:
+                    task, _, node = self._leases[lease_id]
+                    self._leases[lease_id] = (task, monotonic() + self._lease_timeout, node)
+                else:
+                    lost.append(lease_id)
+        return lost
+
+    def complete(self, lease_id, files, folders):
+        """
+        Completes a lease with the results of the folder
+
+        :param lease_id: the lease
+        :param files: the rows to write
+        :param folders: the sub folders to explore
+        :return: True if the results have been accepted, False if the lease expired and the folder has been given to
+        another node
+        """
+        with self._condition:
+            lease = self._leases.pop(lease_id, None)
+            if lease is None:
+                stats.inc('frontier_late_completions_total')
+                return False
+
+            # the rows are buffered before the lease is released, so the exploration can not be over without them
+            if files:
+                self._results_buffer.put(files)
+            for folder in folders:
+                self._pending.push(folder)
+            self._condition.notify_all()
+
+        stats.inc('folders_explored_total')
+        stats.inc('files_emitted_total', len(files))
+        progress.add('folders_done')
+        progress.add('files_emitted', len(files))
+        progress.add('folders_queued', len(folders))
+        return True
+
+    def wait(self):
+        """Waits until all the folders have been explored, re-queuing the expired leases in the meanwhile."""
+        with self._condition:
+            while self._pending or self._leases:
+                self._requeue_expired()
+                self._condition.wait(max(self._lease_timeout / 4, 0.1))
+
+    def close(self):
+        """Tells the nodes that the exploration is over."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class _FrontierServerManager(BaseManager):
+    pass
+
+
+class _FrontierClientManager(BaseManager):
+    pass
+
+
+_FrontierClientManager.register('get_frontier', exposed=EXPOSED_METHODS)
+
+
+class FrontierServer:
+    def __init__(self, frontier, address, authkey, log_level):
+        """
+        Exposes a Frontier to the worker nodes with a multiprocessing manager, served by threads of the current
+        process. The connections are authenticated with authkey, but the messages are pickles: only use it on a
+        trusted network
+
+        :param frontier: the Frontier
+        :param address: the (host, port) to listen on
+        :param authkey: the key shared with the nodes
+        :param log_level: the logging level (see the standar python logging module)
+        """
+        _FrontierServerManager.register('get_frontier', callable=lambda: frontier, exposed=EXPOSED_METHODS)
+        try:
+            self._server = _FrontierServerManager(address=address, authkey=authkey).get_server()
+        except OSError as ose:
+            raise InvalidCoordinator("Impossible to listen on {}:{}: {}".format(*address, ose))
+        self._thread = None
+
+        logger.setLevel(log_level)
+
+    @property
+    def address(self):
+        """The (host, port) the server listens on."""
+        return self._server.address
+
+    def start(self):
+        """Starts serving the nodes."""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info("Coordinator listening on {}:{}".format(*self.address))
+
+    def stop(self):
+        """Stops serving the nodes."""
+        self._server.stop_event.set()
+        self._thread.join()
+        self._server.listener.close()
+
+
+def connect_frontier(address, authkey):
+    """
+    Connects to the Frontier of a coordinator
+
+    :param address: the (host, port) of the coordinator
+    :param authkey: the key shared with the coordinator
+    :return: a proxy of the Frontier
+    """
+    manager = _FrontierClientManager(address=address, authkey=authkey)
+    try:
+        manager.connect()
+    except (OSError, EOFError, multiprocessing.AuthenticationError) as e:
+        raise InvalidCoordinator("Impossible to connect to the coordinator {}:{}: {}".format(*address, repr(e)))
+    return manager.get_frontier()
+
+
+class FrontierConsumer(multiprocessing.Process):
+    def __init__(self, address, authkey, identities, log_level, node_name, drive_cassette=None, threads=1,
+                 request_policy=None):
+        """
+        A worker process of a node: it leases folders from the Frontier of the coordinator, explores them and sends
+        back the rows and the sub folders. Leases are renewed while a folder is explored. With more than one thread,
+        every thread leases folders on its own
+
+        :param address: the (host, port) of the coordinator
+        :param authkey: the key shared with the coordinator
+        :param identities: the IdentityPool of the node used to call the APIs
+        :param log_level: the logging level (see the standar python logging module)
+        :param node_name: the name of the node, used in the logs of the coordinator
+        :param drive_cassette: the CassetteRecorder or CassettePlayer used for the Drive responses, None if disabled
+        :param threads: the number of threads exploring folders in the process
+        :param request_policy: the RequestPolicy with the timeouts and the hedging of the API requests, None for the
+        defaults of googleapiclient (see common.transport)
+        """
+        super().__init__(daemon=False)
+
+        self._address = address
+        self._authkey = authkey
+        self._identities = identities
+        self._log_level = log_level
+        self._node_name = node_name
+        self._drive_cassette = drive_cassette
+        self._threads = threads
+        self._request_policy = request_policy
+
+        # per process state
+        self._settings = None
+        self._drive_clients = None
+        self._current_leases = set()
+        self._stopped = None
+
+    def run(self):
+        logger.setLevel(self._log_level)
+        if self._drive_cassette is not None:
+            self._drive_cassette.attach()
+        if self._request_policy is not None:
+            self._request_policy.attach()
+
+        try:
+            self._safe_run()
+        except KeyboardInterrupt:
+            logger.debug("KeyboardInterrupt in FrontierConsumer.run")
+        except (EOFError, OSError, InvalidCoordinator) as e:
+            # the coordinator is gone, the leases we hold will be given to other nodes if it is still running
+            logger.warning("{}: lost the connection with the coordinator: {}".format(self.name, e))
+        except Exception as e:
+            manage_generic_exception(e, sys.exc_info(), "FrontierConsumer.run")
+        finally:
+            if self._stopped is not None:
+                self._stopped.set()
+            if self._drive_cassette is not None:
+                self._drive_cassette.detach()
+            if self._request_policy is not None:
+                self._request_policy.detach()
+
+    def _renew_leases(self):
+        # proxies open one connection per thread, so the main thread is never blocked by the renewals
+        frontier = connect_frontier(self._address, self._authkey)
+        while not self._stopped.wait(self._settings['lease_timeout'] / 3):
+            leases = list(self._current_leases)
+            if leases:
+                # a lease completed in the meanwhile is not lost
+                for lease_id in set(frontier.renew(leases)) & self._current_leases:
+                    logger.warning("{}: lease {} lost, the folder has been given to another node"
+                                   .format(self.name, lease_id))
+
+    def _safe_run(self):
+        frontier = connect_frontier(self._address, self._authkey)
+        self._settings = frontier.settings()
+        self._drive_clients = DriveClients(self._identities)
+
+        self._stopped = threading.Event()
+        threading.Thread(target=self._renew_leases, daemon=True).start()
+
+        if self._threads == 1:
+            self._consume(frontier)
+            return
+
+        threads = [threading.Thread(target=self._safe_consume, name='{}-{}'.format(self.name, thread_i))
+                   for thread_i in range(self._threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _safe_consume(self):
+        # a thread that loses the coordinator stops like the process does without threads
+        try:
+            self._consume(connect_frontier(self._address, self._authkey))
+        except (EOFError, OSError, InvalidCoordinator) as e:
+            logger.warning("{}: lost the connection with the coordinator: {}".format(threading.current_thread().name,
+                                                                                     e))
+        except Exception as e:
+            manage_generic_exception(e, sys.exc_info(), "FrontierConsumer thread")
+
+    def _consume(self, frontier):
+        """
+        Leases and explores folders until the exploration is over
+
+        :param frontier: the proxy of the Frontier used by the current thread
+        :return: None
+        """
+        name = threading.current_thread().name if self._threads > 1 else self.name
+        node = '{}/{}-{}'.format(self._node_name, name, os.getpid())
+
+        while True:
+            leased = frontier.lease(node)
+            if leased is None:
+                logger.debug('{}: Exiting'.format(name))
+                break
+
+            for lease_id, task in leased:
+                self._current_leases.add(lease_id)
+                files_and_folders = self._explore(task)
+                self._current_leases.discard(lease_id)
+                if not frontier.complete(lease_id, files_and_folders.get('files', []),
+                                         files_and_folders.get('folders', [])):
+                    logger.warning("{}: results of folder {} discarded, its lease expired".format(name,
+                                                                                                task.get('id')))
+
+    def _explore(self, task):
+        """
+        Explores a folder, trying all the identities of the node that can not read it
+
+        :param task: the folder to explore
+        :return: the files and the folders found, both empty if no identity can read the folder
+        """
+        tried = []
+        while True:
+            identity = self._identities.choose(dict(task, tried=tried))
+            if identity is None:
+                logger.error("Folder {} ({}) can not be read by any of the identities of the node"
+                             .format(task.get('name'), task.get('id')))
+                return {'files': [], 'folders': []}
+
+            try:
+                drive_worker = DriveWorker(task, self._drive_clients.credentials(identity),
+                                           self._settings['file_match'], self._settings['type_match'],
+                                           self._settings['folder_separator'], self._settings['include_trashed'],
+                                           self._settings['recursive'],
+                                           throttle=lambda: self._identities.throttle(identity),
+                                           drive_sdk=self._drive_clients.get(identity),
+                                           split_pages=self._settings['split_pages'],
+                                           max_depth=self._settings.get('max_depth'),
+                                           checksums=self._settings.get('checksums', False),
+                                           folder_rows=self._settings.get('folder_rows', False))
+                return drive_worker()
+            except googleapiclient.errors.HttpError as httpe:
+                if httpe.resp.status not in FAILOVER_STATUSES:
+                    raise
+                tried.append(self._identities.email(identity))
@@ -0,0 +1,107 @@
+# standard imports
+import multiprocessing
+import zlib
+
+# standard from imports
+from time import monotonic, sleep
+
+# libraries import
+from common.logging import get_logger
+
+logger = get_logger(__name__)
+
+# HTTP statuses meaning that an identity can not read a folder, the folder is explored with another identity
+FAILOVER_STATUSES = (403, 404)
+
+
+class IdentityPool:
+    def __init__(self, token_brokers, log_level, max_qps=0):
+        """
+        The identities (stored credentials) used to explore the folders. Drive quotas are per user, so spreading the
+        folders across several identities that can all read the tree multiplies the available quota. Each identity
+        has its own access token (see TokenBroker) and its own request rate, shared by all the processes. It is
+        created in the main process and passed to the child processes.
+
+        :param token_brokers: one TokenBroker per identity, the first one is the primary identity
+        :param log_level: the logging level (see the standar python logging module)
+        :param max_qps: maximum number of requests per second sent with every identity, 0 for no limit
+        """
+        self._token_brokers = list(token_brokers)
+        self._log_level = log_level
+        self._min_interval = 1 / max_qps if max_qps > 0 else 0
+
+        # when the next request of every identity can be sent, shared by all the processes
+        self._next_slots = [multiprocessing.Value('d', 0) for _ in self._token_brokers]
+
+        logger.setLevel(self._log_level)
+
+    def __len__(self):
+        return len(self._token_brokers)
+
+    @property
+    def primary(self):
+        """The TokenBroker of the primary identity, used for everything that is not a folder exploration."""
+        return self._token_brokers[0]
+
+    def email(self, identity):
+        """
+        :param identity: the index of the identity
+        :return: the email of the identity
+        """
+        return self._token_brokers[identity].email
+
+    def credentials(self, identity):
+        """
+        Creates the credentials of an identity, to be used in the current process
+
+        :param identity: the index of the identity
+        :return: a BrokeredCredentials instance
+        """
+        return self._token_brokers[identity].credentials()
+
+    def choose(self, task):
+        """
+        Chooses the identity used to explore a folder. Folders are spread across the identities by their id (and the
+        partitions of a big folder by their start), skipping the ones that already failed to read the folder (listed in
+        the 'tried' key of the task)
+
+        :param task: the folder to explore
+        :return: the index of the identity, None if all of them have been tried
+        """
+        tried = task.get('tried', ())
+        key = task['id'] + (task['partition']['from'] if task.get('partition') else '')
+        first = zlib.crc32(key.encode('utf-8')) % len(self._token_brokers)
+        for offset in range(len(self._token_brokers)):
+            identity = (first + offset) % len(self._token_brokers)
+            if self.email(identity) not in tried:
+                return identity
+        return None
+
+    def throttle(self, identity):
+        """
+        Waits until a request can be sent with an identity without exceeding its rate. Does nothing when there is no
+        limit
+
+        :param identity: the index of the identity
+        """
+        if not self._min_interval:
+            return
+
+        # every caller books the next free slot, so the requests of all the processes are evenly spaced
+        next_slot = self._next_slots[identity]
+        with next_slot.get_lock():
+            now = monotonic()
+            slot = max(now, next_slot.value)
+            next_slot.value = slot + self._min_interval
+        if slot > now:
+            sleep(slot - now)
+
+    def start(self):
+        """Starts renewing the access tokens in the main process."""
+        for token_broker in self._token_brokers:
+            token_broker.start()
+
+    def stop(self):
+        """Stops renewing the access tokens."""
+        for token_broker in self._token_brokers:
+            token_broker.stop()
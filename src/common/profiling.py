@@ -0,0 +1,157 @@
+# standard imports
+import cProfile
+import glob
+import os
+import pstats
+import sys
+import threading
+
+# standard from imports
+from datetime import datetime
+
+# libraries import
+from common.logging import get_logger
+
+logger = get_logger(__name__)
+
+MERGED_NAME = 'merged'
+
+
+def create_run_dir(profile_dir, log_level):
+    """
+    Creates the directory where the profiles of an exploration are saved, in profile_dir. Every exploration has its
+    own, so that the profiles of a previous one are never merged with the new ones
+
+    :param profile_dir: the directory chosen by the user
+    :param log_level: the logging level (see the standar python logging module)
+    :return: the path of the new directory, named after the start of the exploration
+    """
+    logger.setLevel(log_level)
+    run_dir = os.path.join(profile_dir, '{:%Y%m%d-%H%M%S}-{}'.format(datetime.now(), os.getpid()))
+    os.makedirs(run_dir)
+    logger.info("Profiles saved in {}".format(run_dir))
+    return run_dir
+
+
+class WallClockSampler(threading.Thread):
+    def __init__(self, thread_id, interval):
+        """
+        Samples the stack of a thread at regular intervals, no matter if it is running or waiting on I/O. The result
+        is compatible with the collapsed stack format used by flamegraph tools.
+
+        :param thread_id: the identifier of the thread to sample
+        :param interval: seconds between two samples
+        """
+        super().__init__(daemon=True)
+        self._thread_id = thread_id
+        self._interval = interval
+        self._stopped = threading.Event()
+        self.stacks = {}
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                frame = frame.f_back
+
+            # collapsed stacks go from the root to the leaf
+            collapsed = ';'.join(reversed(stack))
+            self.stacks[collapsed] = self.stacks.get(collapsed, 0) + 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def run_profiled(func, profile_dir, name, sample_interval=0):
+    """
+    Runs func under cProfile, saving the stats in profile_dir. When sample_interval is greater than zero, a
+    wall-clock sampler is also started and its collapsed stacks are saved next to the stats. Like cProfile, the sampler
+    only sees the calling thread: a process with more threads profiles every one of them.
+
+    :param func: the function to profile
+    :param profile_dir: the directory where the profile files are saved
+    :param name: the name used for the profile files, it should be unique among all the processes and threads
+    :param sample_interval: milliseconds between two wall-clock samples, 0 to disable the sampler
+    :return: whatever func returns
+    """
+    sampler = None
+    if sample_interval > 0:
+        sampler = WallClockSampler(threading.get_ident(), sample_interval / 1000)
+        sampler.start()
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func)
+    finally:
+        profiler.dump_stats(os.path.join(profile_dir, '{}.prof'.format(name)))
+
+        if sampler is not None:
+            sampler.stop()
+            # the name of the process (without pid) is used as root of the stacks, so that the different kind of
+            # processes are easy to tell apart in the merged flamegraph
+            root = name.split('-')[0]
+            with open(os.path.join(profile_dir, '{}.collapsed'.format(name)), 'w') as collapsed_file:
+                for stack, count in sorted(sampler.stacks.items()):
+                    collapsed_file.write('{};{} {}\n'.format(root, stack, count))
+
+
+def _write_report(stats, report_path):
+    with open(report_path, 'w') as report_file:
+        stats.stream = report_file
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(100)
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(100)
+
+
+def merge_profiles(profile_dir, log_level):
+    """
+    Merges the profiles of all the processes in a single report. A text report is also created for every process.
+
+    :param profile_dir: the directory where the profile files have been saved
+    :param log_level: the logging level (see the standar python logging module)
+    """
+    logger.setLevel(log_level)
+    merged_prof = os.path.join(profile_dir, '{}.prof'.format(MERGED_NAME))
+    profile_files = sorted(path for path in glob.glob(os.path.join(profile_dir, '*.prof')) if path != merged_prof)
+
+    if not profile_files:
+        logger.warning("No profile found in {}".format(profile_dir))
+        return
+
+    merged_stats = None
+    for profile_file in profile_files:
+        process_stats = pstats.Stats(profile_file)
+        _write_report(process_stats, '{}.txt'.format(os.path.splitext(profile_file)[0]))
+
+        if merged_stats is None:
+            merged_stats = pstats.Stats(profile_file)
+        else:
+            merged_stats.add(profile_file)
+
+    merged_stats.dump_stats(merged_prof)
+    _write_report(merged_stats, os.path.join(profile_dir, '{}.txt'.format(MERGED_NAME)))
+
+    # collapsed stacks from the different processes are summed up
+    merged_collapsed = os.path.join(profile_dir, '{}.collapsed'.format(MERGED_NAME))
+    collapsed_files = [path for path in glob.glob(os.path.join(profile_dir, '*.collapsed'))
+                       if path != merged_collapsed]
+    if collapsed_files:
+        stacks = {}
+        for collapsed_path in collapsed_files:
+            with open(collapsed_path) as collapsed_file:
+                for line in collapsed_file:
+                    stack, count = line.rstrip('\n').rsplit(' ', 1)
+                    stacks[stack] = stacks.get(stack, 0) + int(count)
+
+        with open(merged_collapsed, 'w') as collapsed_file:
+            for stack, count in sorted(stacks.items()):
+                collapsed_file.write('{} {}\n'.format(stack, count))
+
+    logger.info("Merged {} profiles in {}".format(len(profile_files), merged_prof))
@@ -0,0 +1,150 @@
+# standard imports
+import multiprocessing
+import sys
+import threading
+
+# standard from imports
+from time import perf_counter
+
+# libraries import
+from common.buffer import format_bytes
+from common.logging import get_logger
+
+logger = get_logger(__name__)
+
+# the counters every process can update, each process owns a slot so no lock is needed between processes
+COUNTERS = ('folders_done', 'folders_queued', 'files_emitted', 'api_calls', 'api_call_microseconds', 'throttle_events',
+            'rows_written', 'bytes_written')
+_COUNTER_INDEX = {name: i for i, name in enumerate(COUNTERS)}
+
+# slots reserved to the main and the writer processes, workers use the following ones
+MAIN_SLOT = 0
+WRITER_SLOT = 1
+FIRST_WORKER_SLOT = 2
+
+# the shared array and the offset of the slot of the current process: when None progress is disabled
+_values = None
+_offset = 0
+# the threads of a process share its slot (see FolderConsumer)
+_lock = threading.Lock()
+
+
+def add(name, value=1):
+    """
+    Increments one of the progress counters of the current process. Does nothing when progress is disabled
+
+    :param name: the name of the counter, one of COUNTERS
+    :param value: the increment
+    """
+    if _values is not None:
+        with _lock:
+            _values[_offset + _COUNTER_INDEX[name]] += value
+
+
+def set_value(name, value):
+    """
+    Sets one of the progress counters of the current process. Does nothing when progress is disabled
+
+    :param name: the name of the counter, one of COUNTERS
+    :param value: the new value
+    """
+    if _values is not None:
+        with _lock:
+            _values[_offset + _COUNTER_INDEX[name]] = value
+
+
+class ProgressCounters:
+    def __init__(self, num_slots):
+        """
+        Cheap counters shared between all the processes. Every process writes in its own slot of a shared array,
+        the main process sums them up when it needs to report the progress.
+
+        :param num_slots: the number of slots, one per process
+        """
+        self._num_slots = num_slots
+        self._values = multiprocessing.RawArray('q', num_slots * len(COUNTERS))
+
+    def attach(self, slot):
+        """
+        Enables the progress counters in the current process
+
+        :param slot: the slot owned by the current process
+        """
+        global _values, _offset
+        if slot >= self._num_slots:
+            raise ValueError("Progress slot {} not available, only {} slots allocated".format(slot, self._num_slots))
+
+        _values = self._values
+        _offset = slot * len(COUNTERS)
+
+    def totals(self):
+        """
+        Sums the counters of all the slots
+
+        :return: a dictionary with the name of the counters as keys
+        """
+        values = self._values[:]
+        return {name: sum(values[i::len(COUNTERS)]) for i, name in enumerate(COUNTERS)}
+
+
+class ProgressReporter(threading.Thread):
+    def __init__(self, counters, log_level, interval=5, stream=sys.stderr):
+        """
+        Thread used in the main process to periodically report the progress of the exploration. When the stream is a
+        terminal the progress line is refreshed in place, otherwise it is logged.
+
+        :param counters: the shared ProgressCounters
+        :param log_level: the logging level (see the standar python logging module)
+        :param interval: seconds between two reports
+        :param stream: where to write the progress line
+        """
+        super().__init__(daemon=True)
+        self._counters = counters
+        self._interval = interval
+        self._stream = stream
+        self._is_tty = hasattr(stream, 'isatty') and stream.isatty()
+        self._stopped = threading.Event()
+
+        self._last_api_calls = 0
+        self._last_time = perf_counter()
+        self._last_line_len = 0
+
+        logger.setLevel(log_level)
+
+    def _format_line(self):
+        totals = self._counters.totals()
+
+        now = perf_counter()
+        elapsed = now - self._last_time
+        api_rate = (totals['api_calls'] - self._last_api_calls) / elapsed if elapsed > 0 else 0
+        self._last_api_calls = totals['api_calls']
+        self._last_time = now
+
+        return "Folders: {:,} done / {:,} queued | Files: {:,} | API: {:.1f} calls/s | Throttled: {:,} | " \
+               "Written: {:,} rows ({})".format(totals['folders_done'],
+                                                max(totals['folders_queued'] - totals['folders_done'], 0),
+                                                totals['files_emitted'], api_rate, totals['throttle_events'],
+                                                totals['rows_written'], format_bytes(totals['bytes_written']))
+
+    def _report(self):
+        line = self._format_line()
+        if self._is_tty:
+            # we pad the line so that no characters from the previous one are left behind
+            self._stream.write('\r{}'.format(line.ljust(self._last_line_len)))
+            self._stream.flush()
+            self._last_line_len = len(line)
+        else:
+            logger.info(line)
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            self._report()
+
+    def stop(self):
+        """Stops the reporter, printing the last progress line."""
+        self._stopped.set()
+        self.join()
+        self._report()
+        if self._is_tty:
+            self._stream.write('\n')
+            self._stream.flush()
@@ -0,0 +1,474 @@
+# standard imports
+import heapq
+import itertools
+import os
+import threading
+
+# standard from imports
+from collections import OrderedDict, deque
+from multiprocessing.managers import BaseManager
+from time import monotonic
+
+# libraries import
+from common.logging import get_logger
+from common.skeleton import folder_key
+
+logger = get_logger(__name__)
+
+# the methods of the scheduler that the worker processes can call
+EXPOSED_METHODS = ('put', 'get', 'task_done', 'flushed', 'heartbeat', 'release', 'qsize')
+# a folder held by workers that died is queued again until this many attempts, it is probably crashing the workers
+MAX_FOLDER_ATTEMPTS = 3
+
+
+class FifoPolicy:
+    """Breadth-first: the folders are explored in the order they are found, like with a JoinableQueue."""
+
+    def __init__(self):
+        self._tasks = deque()
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def push(self, task):
+        self._tasks.append(task)
+
+    def pop(self):
+        return self._tasks.popleft()
+
+
+class LifoPolicy:
+    """Depth-first: the last folder found is explored first, the folders waiting grow with the depth of the tree and
+    not with its width."""
+
+    def __init__(self):
+        self._tasks = []
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def push(self, task):
+        self._tasks.append(task)
+
+    def pop(self):
+        return self._tasks.pop()
+
+
+class LargestFirstPolicy:
+    def __init__(self, sizes):
+        """
+        The folders with more rows in the previous exploration are explored first, so that the longest ones do not
+        start last and keep a single worker busy at the end. The folders without a hint may open a new part of the tree,
+        they come before all the others. Folders of the same size are explored in the order they are found
+
+        :param sizes: the rows of every folder in the previous exploration, by folder key (see common.skeleton)
+        """
+        self._sizes = sizes
+        self._tasks = []
+        self._order = itertools.count()
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def push(self, task):
+        size = self._sizes.get(folder_key(task), float('inf'))
+        heapq.heappush(self._tasks, (-size, next(self._order), task))
+
+    def pop(self):
+        return heapq.heappop(self._tasks)[2]
+
+
+class DriveRoundRobinPolicy:
+    """The folders are taken from every shared drive in turn, so that a huge drive does not delay the others and the
+    requests are spread across the drives. The folders of My Drive are a drive of their own."""
+
+    def __init__(self):
+        self._drives = OrderedDict()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def push(self, task):
+        self._drives.setdefault(task.get('drive'), deque()).append(task)
+        self._count += 1
+
+    def pop(self):
+        # the drive served goes to the end of the line
+        drive, tasks = next(iter(self._drives.items()))
+        task = tasks.popleft()
+        del self._drives[drive]
+        if tasks:
+            self._drives[drive] = tasks
+        self._count -= 1
+        return task
+
+
+def create_policy(name, sizes=None):
+    """
+    Creates the policy that chooses the next folder to explore
+
+    :param name: bfs, dfs, largest or drives
+    :param sizes: the rows of every folder in the previous exploration, used by the largest policy
+    :return: the policy, an object with the push and pop methods and a length
+    """
+    if name == 'dfs':
+        return LifoPolicy()
+    if name == 'largest':
+        return LargestFirstPolicy(sizes or {})
+    if name == 'drives':
+        return DriveRoundRobinPolicy()
+    return FifoPolicy()
+
+
+def subtask_marker(task):
+    """
+    What a task does on its folder, used to know which tasks on the same folder have already been queued (see
+    TaskScheduler.release)
+
+    :param task: the task
+    :return: a string, 'folder' for the whole folder
+    """
+    if task.get('partition'):
+        return 'partition:{}:{}'.format(task['partition']['trashed'], task['partition']['from'])
+    if task.get('phase'):
+        return 'phase:{}'.format(task['phase'])
+    return 'folder'
+
+
+class TaskScheduler:
+    def __init__(self, policy, log_level):
+        """
+        The folders waiting to be explored, taken in the order chosen by a policy. It lives in the main process and it
+        is exposed to the workers by a SchedulerServer. Poison pills (None) are only given once no folder is waiting.
+
+        It also knows what every worker thread is holding: the folder it is exploring, what it has already handed over
+        of it (sub folders queued and rows sent to the writer) and the folders explored whose rows are still in its
+        buffer. When a worker dies, those folders are queued again (see release), skipping what has been handed over
+
+        :param policy: the policy (see create_policy)
+        :param log_level: the logging level (see the standar python logging module)
+        """
+        self._policy = policy
+        self._condition = threading.Condition()
+        self._poison_pills = 0
+        self._unfinished = 0
+
+        # by worker, a (process id, thread name) tuple: the folder being explored and the ones explored since the
+        # last time the rows have been sent to the writer
+        self._holdings = {}
+        self._unflushed = {}
+        # by worker, since when it is waiting for a folder
+        self._waiting = {}
+
+        # once cleared, the folders queued are dropped and the workers whose folder has been dropped are not waited for
+        self._cleared = False
+        self._dropped = set()
+
+        logger.setLevel(log_level)
+
+    def _hand_over(self, worker, task):
+        # to be called holding the condition
+        holding = self._holdings.get(worker)
+        if holding is None:
+            return
+
+        if task.get('id') != holding['task'].get('id'):
+            holding['folders'].add(task.get('id'))
+        elif subtask_marker(task) == subtask_marker(holding['task']):
+            # the folder itself has been queued again, e.g. for another identity
+            holding['requeued'] = True
+        else:
+            holding['subtasks'].add(subtask_marker(task))
+        holding['active'] = monotonic()
+
+    def put(self, task, worker=None):
+        """
+        Queues a folder to be explored
+
+        :param task: the folder, None for a poison pill
+        :param worker: the worker that found the folder, None for the main process
+        """
+        with self._condition:
+            if task is None:
+                self._poison_pills += 1
+            elif self._cleared:
+                return
+            else:
+                self._policy.push(task)
+                self._hand_over(worker, task)
+            self._unfinished += 1
+            self._condition.notify()
+
+    def get(self, worker=None):
+        """
+        Takes the next folder to explore, waiting for one if none is available
+
+        :param worker: the worker taking the folder
+        :return: the folder, None for a poison pill
+        """
+        with self._condition:
+            while not self._policy and not self._poison_pills:
+                self._waiting.setdefault(worker, monotonic())
+                self._condition.wait()
+            self._waiting.pop(worker, None)
+
+            if not self._policy:
+                self._poison_pills -= 1
+                return None
+
+            task = self._policy.pop()
+            if worker is not None:
+                self._holdings[worker] = {'task': task, 'rows': set(), 'folders': set(), 'subtasks': set(),
+                                          'requeued': False, 'active': monotonic()}
+            return task
+
+    def task_done(self, worker=None):
+        """
+        Tells that a folder taken with get has been explored
+
+        :param worker: the worker that explored the folder
+        """
+        with self._condition:
+            if worker in self._dropped:
+                self._dropped.discard(worker)
+                return
+
+            holding = self._holdings.pop(worker, None)
+            if holding is not None and not holding['requeued']:
+                self._unflushed.setdefault(worker, []).append(holding)
+
+            self._unfinished -= 1
+            if not self._unfinished:
+                self._condition.notify_all()
+
+    def flushed(self, worker, rows):
+        """
+        Tells that a worker has sent its rows to the writer
+
+        :param worker: the worker
+        :param rows: the ids of the rows sent that belong to the folder it is exploring
+        """
+        with self._condition:
+            self._unflushed.pop(worker, None)
+            holding = self._holdings.get(worker)
+            if holding is not None:
+                holding['rows'].update(rows)
+                holding['active'] = monotonic()
+
+    def heartbeat(self, worker):
+        """
+        Tells that a worker is still exploring its folder, without handing over anything
+
+        :param worker: the worker
+        """
+        with self._condition:
+            holding = self._holdings.get(worker)
+            if holding is not None:
+                holding['active'] = monotonic()
+
+    def release(self, process_id, thread_name=None):
+        """
+        Queues again the folders held by the threads of a worker process that died, or by one of its threads. The
+        folders are explored again skipping what has already been handed over, a folder is given up after
+        MAX_FOLDER_ATTEMPTS attempts
+
+        :param process_id: the process id of the worker
+        :param thread_name: the name of the thread, None for all the threads of the process
+        :return: the number of folders queued again and the number of folders given up
+        """
+        queued = given_up = 0
+        with self._condition:
+            workers = {worker for worker in itertools.chain(self._holdings, self._unflushed)
+                       if worker[0] == process_id and thread_name in (None, worker[1])}
+            for worker in workers:
+                # the folders explored whose rows were still in the buffer did not cause the death, their attempts do
+                # not count
+                holdings = [(holding, 0) for holding in self._unflushed.pop(worker, [])]
+                holding = self._holdings.pop(worker, None)
+                if holding is not None:
+                    # the folder being explored is replaced by the one queued again
+                    self._unfinished -= 1
+                    if not holding['requeued']:
+                        holdings.append((holding, 1))
+
+                for holding, attempt in holdings:
+                    task = holding['task']
+                    attempts = task.get('attempts', 0) + attempt
+                    if attempts >= MAX_FOLDER_ATTEMPTS:
+                        logger.error("Giving up folder {} ({}), the workers exploring it died {} times"
+                                     .format(task.get('name'), task.get('id'), attempts))
+                        given_up += 1
+                        continue
+
+                    handed_over = task.get('handed_over', {})
+                    self._policy.push(dict(task, attempts=attempts, handed_over={
+                        key: sorted(set(handed_over.get(key, ())) | holding[key])
+                        for key in ('rows', 'folders', 'subtasks')}))
+                    self._unfinished += 1
+                    queued += 1
+
+            self._condition.notify_all()
+        return queued, given_up
+
+    def stuck(self, timeout):
+        """
+        :param timeout: seconds after which a worker that has not handed over anything of its folder, nor told that it
+        is still exploring it, is stuck
+        :return: the process ids of the workers with a stuck thread
+        """
+        deadline = monotonic() - timeout
+        with self._condition:
+            return {worker[0] for worker, holding in self._holdings.items() if holding['active'] < deadline}
+
+    def unblock(self, timeout):
+        """
+        Gives a poison pill to the worker threads waiting for a folder when no folder and no poison pill are left. Used
+        once all the poison pills have been given: a thread that has taken its pill and started over after an error
+        would wait forever
+
+        :param timeout: seconds after which a waiting thread is blocked
+        :return: the number of poison pills given
+        """
+        deadline = monotonic() - timeout
+        with self._condition:
+            if self._policy or self._poison_pills:
+                return 0
+
+            blocked = sum(1 for since in self._waiting.values() if since < deadline)
+            self._poison_pills += blocked
+            self._unfinished += blocked
+            self._condition.notify_all()
+        return blocked
+
+    def clear(self):
+        """
+        Drops all the folders waiting and held, and the ones queued later. Used when no worker is left to explore them
+        or when the exploration is stopped early, the workers still exploring a folder get their poison pill once done
+
+        :return: the number of folders dropped
+        """
+        with self._condition:
+            dropped = len(self._policy) + len(self._holdings)
+            while self._policy:
+                self._policy.pop()
+            self._cleared = True
+            self._dropped.update(self._holdings)
+            self._holdings.clear()
+            self._unflushed.clear()
+            self._unfinished = self._poison_pills
+            self._condition.notify_all()
+        return dropped
+
+    def join(self):
+        """Waits until all the folders queued have been explored."""
+        with self._condition:
+            while self._unfinished:
+                self._condition.wait()
+
+    def qsize(self):
+        """The number of folders waiting to be explored."""
+        with self._condition:
+            return len(self._policy) + self._poison_pills
+
+
+class _SchedulerServerManager(BaseManager):
+    pass
+
+
+class _SchedulerClientManager(BaseManager):
+    pass
+
+
+_SchedulerClientManager.register('get_scheduler', exposed=EXPOSED_METHODS)
+
+
+class SchedulerServer:
+    def __init__(self, scheduler, log_level):
+        """
+        Exposes a TaskScheduler to the worker processes with a multiprocessing manager, served by threads of the main
+        process on a local socket
+
+        :param scheduler: the TaskScheduler
+        :param log_level: the logging level (see the standar python logging module)
+        """
+        _SchedulerServerManager.register('get_scheduler', callable=lambda: scheduler, exposed=EXPOSED_METHODS)
+        self._server = _SchedulerServerManager().get_server()
+        self._thread = None
+
+        logger.setLevel(log_level)
+
+    def client(self):
+        """
+        :return: a SchedulerClient for the worker processes
+        """
+        return SchedulerClient(self._server.address, bytes(self._server.authkey))
+
+    def start(self):
+        """Starts serving the workers."""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.debug("Scheduler listening on {}".format(self._server.address))
+
+    def stop(self):
+        """Stops serving the workers."""
+        self._server.stop_event.set()
+        self._thread.join()
+        self._server.listener.close()
+
+
+class SchedulerClient:
+    def __init__(self, address, authkey):
+        """
+        Used by the worker processes to call the TaskScheduler of the main process, every call tells which worker thread
+        is calling. The connection is opened by every process the first time it is used, every thread has its own
+
+        :param address: the address of the SchedulerServer
+        :param authkey: the key of the SchedulerServer
+        """
+        self._address = address
+        self._authkey = authkey
+
+        # per process state
+        self._pid = None
+        self._scheduler = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pid'] = None
+        state['_scheduler'] = None
+        return state
+
+    def _proxy(self):
+        if self._pid != os.getpid():
+            manager = _SchedulerClientManager(address=self._address, authkey=self._authkey)
+            manager.connect()
+            self._scheduler = manager.get_scheduler()
+            self._pid = os.getpid()
+        return self._scheduler
+
+    @staticmethod
+    def _worker():
+        return os.getpid(), threading.current_thread().name
+
+    def put(self, task):
+        self._proxy().put(task, self._worker())
+
+    def get(self):
+        return self._proxy().get(self._worker())
+
+    def task_done(self):
+        self._proxy().task_done(self._worker())
+
+    def flushed(self, rows):
+        self._proxy().flushed(self._worker(), rows)
+
+    def heartbeat(self):
+        self._proxy().heartbeat(self._worker())
+
+    def release_thread(self):
+        """Queues again the folders held by the current thread, that is starting over after an error."""
+        return self._proxy().release(*self._worker())
+
+    def qsize(self):
+        return self._proxy().qsize()
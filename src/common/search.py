@@ -0,0 +1,235 @@
+# standard imports
+import os
+
+# standard from imports
+from time import sleep
+
+# third parties libraries
+import googleapiclient.errors
+
+# libraries import
+from common import stats, tracing
+from common.api import new_batch_request
+from common.backoff import EXP_MAX_WAIT, EXP_MULTIPLIER, call_endpoint, execute_batch, execute_request
+from common.drive_utils import FILE_FIELDS, file_row
+from common.logging import get_logger
+
+logger = get_logger(__name__)
+
+# the parent folders read with a single batch request, the maximum allowed by Drive
+BATCH_SIZE = 100
+# the times the requests of a batch that failed on their own are sent with a new batch, then they are sent one by one
+MAX_BATCH_ATTEMPTS = 5
+# the statuses of the parent folders that can not be read by the user: the full names start below them
+UNREADABLE_STATUSES = (403, 404)
+
+
+def _quote(value):
+    # https://developers.google.com/drive/api/guides/ref-search-terms#string_values
+    return "'{}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+
+
+def build_query(names=(), full_texts=(), mime_types=(), include_trashed=False):
+    """
+    Creates the Drive query of a search
+
+    :param names: texts that must all be in the names of the items
+    :param full_texts: texts that must all be in the names, descriptions or contents of the items
+    :param mime_types: the items must have one of these types, all the types when empty
+    :param include_trashed: are trashed items searched?
+    :return: the query, in the Drive query language
+    """
+    clauses = ['name contains {}'.format(_quote(name)) for name in names]
+    clauses.extend('fullText contains {}'.format(_quote(full_text)) for full_text in full_texts)
+    if len(mime_types) == 1:
+        clauses.append('mimeType = {}'.format(_quote(mime_types[0])))
+    elif mime_types:
+        clauses.append('({})'.format(' or '.join('mimeType = {}'.format(_quote(mime_type))
+                                                 for mime_type in mime_types)))
+    if not include_trashed:
+        clauses.append('trashed = false')
+    return ' and '.join(clauses)
+
+
+class AncestryResolver:
+    def __init__(self, drive_sdk, folder_separator=os.sep, throttle=None, batch_size=BATCH_SIZE):
+        """
+        Rebuilds the full names of the items found by a search, that only know the ids of their parents. The parent
+        folders are read once and kept, so that the items of the same folders cost nothing: the folders that are not
+        known yet are read level by level, with batches of files.get requests
+
+        :param drive_sdk: the Drive client used to read the folders
+        :param folder_separator: the folder separator used in the full names
+        :param throttle: called before every request to respect the rate of the identity, None for no limit
+        :param batch_size: the folders read with a single batch request
+        """
+        self._drive_sdk = drive_sdk
+        self._folder_separator = folder_separator
+        self._throttle = throttle
+        self._batch_size = batch_size
+
+        # the folders read by id, None for the ones the user can not read
+        self._folders = {}
+        # the full names of the folders by id, a folder with more than one parent has more than one full name
+        self._full_names = {}
+
+    def _unknown(self, items):
+        return {parent for item in items for parent in item.get('parents') or () if parent not in self._folders}
+
+    def resolve(self, items):
+        """
+        Reads all the folders above the items that are not known yet
+
+        :param items: the items returned by the Google API, with their parents
+        """
+        pending = self._unknown(items)
+        while pending:
+            self._read_folders(sorted(pending))
+            pending = self._unknown(self._folders[folder_id] for folder_id in pending
+                                    if self._folders[folder_id] is not None)
+
+    def _read_folders(self, folder_ids):
+        # the requests of a batch count one by one against the rate limit: the ones that failed on their own are sent
+        # again with a new batch, waiting more and more like the single requests (see common.backoff). After the last
+        # attempt they are sent one by one
+        pending = folder_ids
+        for attempt in range(1, MAX_BATCH_ATTEMPTS + 1):
+            failed = self._read_batches(pending)
+            if not failed:
+                break
+
+            pending = failed
+            wait = min(EXP_MAX_WAIT, EXP_MULTIPLIER * 2 ** attempt)
+            logger.debug("{} folders of a batch not read, trying again in {} seconds".format(len(pending), wait))
+            stats.inc('api_retries_total')
+            stats.inc('api_retry_wait_seconds_total', wait)
+            sleep(wait)
+        else:
+            for folder_id in pending:
+                self._read_folder(folder_id)
+
+        stats.inc('search_folders_read_total', len(folder_ids))
+
+    def _read_batches(self, folder_ids):
+        failed = []
+
+        def on_response(folder_id, response, error):
+            if error is None:
+                self._folders[folder_id] = response
+            elif error.resp.status == 404:
+                self._folders[folder_id] = None
+            else:
+                failed.append(folder_id)
+
+        for start in range(0, len(folder_ids), self._batch_size):
+            batch = new_batch_request(self._drive_sdk, 'drive', 'v3', callback=on_response)
+            for folder_id in folder_ids[start:start + self._batch_size]:
+                batch.add(self._drive_sdk.files().get(fileId=folder_id, fields='id,name,parents',
+                                                      supportsAllDrives=True), request_id=folder_id)
+            if self._throttle is not None:
+                self._throttle()
+            with tracing.span('batch', 'api', requests=min(self._batch_size, len(folder_ids) - start)):
+                execute_batch(batch)
+
+        return failed
+
+    def _read_folder(self, folder_id):
+        if self._throttle is not None:
+            self._throttle()
+        try:
+            self._folders[folder_id] = call_endpoint(self._drive_sdk.files().get, {
+                'fileId': folder_id,
+                'fields': 'id,name,parents',
+                'supportsAllDrives': True,
+            })
+        except googleapiclient.errors.HttpError as httpe:
+            if httpe.resp.status not in UNREADABLE_STATUSES:
+                raise
+            logger.debug("Folder {} can not be read: {}".format(folder_id, httpe))
+            self._folders[folder_id] = None
+
+    def _parent_names(self, parents):
+        names = []
+        for parent in parents or ():
+            for name in self._folder_names(parent):
+                if name not in names:
+                    names.append(name)
+        return names
+
+    def _folder_names(self, folder_id):
+        names = self._full_names.get(folder_id)
+        if names is None:
+            folder = self._folders.get(folder_id)
+            names = self.full_names(folder) if folder is not None else []
+            self._full_names[folder_id] = names
+        return names
+
+    def full_names(self, item):
+        """
+        Gets the full names of an item whose folders have been resolved. The full names start from the highest folder
+        that the user can read, e.g. My Drive
+
+        :param item: the item returned by the Google API, with its name and its parents
+        :return: the list of the full names of the item, one per path from the top
+        """
+        parent_names = self._parent_names(item.get('parents'))
+        if not parent_names:
+            return [item.get('name')]
+        return ['{}{}{}'.format(parent_name, self._folder_separator, item.get('name')) for parent_name in parent_names]
+
+
+class DriveSearch:
+    def __init__(self, drive_sdk, query, folder_separator=os.sep, corpora='user', drive_id=None, throttle=None,
+                 page_size=1000):
+        """
+        Searches the items of a corpus with a single files.list query, instead of exploring the folder tree
+
+        :param drive_sdk: the Drive client to be used
+        :param query: the query, in the Drive query language (see build_query)
+        :param folder_separator: the folder separator used in the full names
+        :param corpora: the items searched: user, domain or allDrives (see the files.list documentation)
+        :param drive_id: the id of the shared drive to search, instead of the corpora
+        :param throttle: called before every request to respect the rate of the identity, None for no limit
+        :param page_size: the items of every page, the folders above them are read before the next page
+        """
+        self._drive_sdk = drive_sdk
+        self._throttle = throttle
+        self._ancestry = AncestryResolver(drive_sdk, folder_separator, throttle)
+
+        # https://developers.google.com/drive/api/v3/reference/files/list
+        self._list_params = {
+            'pageSize': page_size,
+            'q': query,
+            'fields': 'files({}),nextPageToken'.format(FILE_FIELDS),
+            'corpora': corpora if drive_id is None else 'drive',
+            'supportsAllDrives': True,
+            'includeItemsFromAllDrives': True,
+        }
+        if drive_id is not None:
+            self._list_params['driveId'] = drive_id
+
+    def pages(self):
+        """
+        Searches the items one page at a time, the folders above the items of a page are read before the page is
+        returned
+
+        :return: a generator of lists of rows, the rows of the folder explore command. An item with more than one
+        parent has one row per full name
+        """
+        g_drive_files = self._drive_sdk.files()
+        list_request = g_drive_files.list(**self._list_params)
+        pages = 0
+        while list_request is not None:
+            if self._throttle is not None:
+                self._throttle()
+            with tracing.span('files.list', 'api', page=pages + 1):
+                search_items = execute_request(list_request)
+            list_request = g_drive_files.list_next(list_request, search_items)
+            pages += 1
+
+            items = search_items.get('files', [])
+            stats.inc('search_items_total', len(items))
+            self._ancestry.resolve(items)
+            yield [file_row(item, full_name) for item in items for full_name in self._ancestry.full_names(item)]
+
+        logger.debug("Search over, {} pages".format(pages))
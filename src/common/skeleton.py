@@ -0,0 +1,165 @@
+# standard imports
+import json
+import os
+
+# libraries import
+from common.logging import get_logger
+
+logger = get_logger(__name__)
+
+SKELETON_VERSION = 1
+
+# the virtual parent of the folders the exploration starts from, it is always in the tree
+ROOT_KEY = None
+
+
+def folder_key(task):
+    """
+    The key of a folder in the skeleton. A folder with more than one parent is explored once per parent, with a
+    different full name, so the id alone is not enough
+
+    :param task: the folder, a dictionary with its id and its full name
+    :return: a (id, full name) tuple
+    """
+    return task.get('id'), task.get('name')
+
+
+class SkeletonCache:
+    def __init__(self, cache_file, folder_ids, folder_separator, include_trashed, log_level):
+        """
+        The folders found by the previous exploration of the same folders. They are all queued when the exploration
+        starts, so that the workers do not have to wait for the tree to be discovered one level at a time. It is
+        created in the main process and passed to the child processes.
+
+        The rows of every folder are held by the writer (see SkeletonReconciler) until the folder is confirmed to
+        still be in the tree, with the same full name: when its parent, itself confirmed, lists it. The rows of the
+        folders deleted or moved since the previous exploration are dropped, new folders are explored as usual, so the
+        output is the same as without the cache. The confirmed folders are saved for the next exploration.
+
+        :param cache_file: the file where the skeleton is loaded from and saved to
+        :param folder_ids: the ids of the folders the exploration starts from
+        :param folder_separator: the folder separator used in the full names
+        :param include_trashed: are trashed items explored?
+        :param log_level: the logging level (see the standar python logging module)
+        """
+        self._cache_file = cache_file
+        self._settings = {
+            'folder_ids': list(folder_ids),
+            'folder_separator': folder_separator,
+            'include_trashed': include_trashed,
+        }
+
+        logger.setLevel(log_level)
+
+        # the folders of the previous exploration, in the order they have been confirmed: parents come first
+        self.folders = []
+        if os.path.isfile(cache_file):
+            self.folders = self._load()
+        self._keys = {folder_key(folder) for folder in self.folders}
+
+    @property
+    def sizes(self):
+        """The rows of every folder in the previous exploration, by folder key, used to schedule the biggest first."""
+        return {folder_key(folder): folder.get('rows', 0) for folder in self.folders}
+
+    def _load(self):
+        with open(self._cache_file) as cache_file:
+            header = json.loads(cache_file.readline() or '{}')
+            if header.get('version') != SKELETON_VERSION or header.get('settings') != self._settings:
+                logger.info("Skeleton cache {} created by a different exploration, starting from scratch"
+                            .format(self._cache_file))
+                return []
+
+            folders = [json.loads(line) for line in cache_file]
+
+        logger.info("Skeleton cache: {} known folders queued".format(len(folders)))
+        return folders
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def save(self, folders, rows):
+        """
+        Saves the skeleton of the current exploration
+
+        :param folders: the confirmed folders as (key, parent key) tuples, parents first
+        :param rows: the rows written for every folder, by key
+        """
+        # we write a new file and then we replace the old one, so that an interrupted save does not lose the cache
+        temp_file = '{}.tmp'.format(self._cache_file)
+        with open(temp_file, 'w') as cache_file:
+            cache_file.write(json.dumps({'version': SKELETON_VERSION, 'settings': self._settings}) + '\n')
+            for key, parent in folders:
+                cache_file.write(json.dumps({'id': key[0], 'name': key[1],
+                                             'parent': parent[0] if parent is not None else None,
+                                             'rows': rows.get(key, 0)}) + '\n')
+        os.replace(temp_file, self._cache_file)
+        logger.info("Skeleton of {} folders saved in {}".format(len(folders), self._cache_file))
+
+
+class SkeletonReconciler:
+    def __init__(self, skeleton_cache):
+        """
+        Used by the writer to hold the rows of the folders until they are confirmed to be in the tree. The workers
+        send, for every page, a (folder key, rows, sub folder keys) tuple: a folder is confirmed when its parent is
+        confirmed and lists it, the folders the exploration starts from are listed by ROOT_KEY
+
+        :param skeleton_cache: the SkeletonCache, used to save the confirmed folders
+        """
+        self._skeleton_cache = skeleton_cache
+
+        self._confirmed = {ROOT_KEY}
+        self._confirmed_order = []
+        self._children = {}
+        self._held_rows = {}
+        self._held_count = 0
+        self._rows = {}
+
+    @property
+    def held_rows(self):
+        """The number of rows waiting for their folder to be confirmed."""
+        return self._held_count
+
+    def _confirm(self, key, parent, ready_rows):
+        pending = [(key, parent)]
+        while pending:
+            key, parent = pending.pop()
+            if key in self._confirmed:
+                continue
+
+            self._confirmed.add(key)
+            self._confirmed_order.append((key, parent))
+            held_rows = self._held_rows.pop(key, [])
+            self._held_count -= len(held_rows)
+            ready_rows.extend(held_rows)
+            pending.extend((child, key) for child in self._children.pop(key, []))
+
+    def reconcile(self, batch):
+        """
+        Takes a batch sent by the workers
+
+        :param batch: a list of (folder key, rows, sub folder keys) tuples
+        :return: the rows that can be written
+        """
+        ready_rows = []
+        for key, rows, children in batch:
+            if rows:
+                self._rows[key] = self._rows.get(key, 0) + len(rows)
+            if key in self._confirmed:
+                ready_rows.extend(rows)
+                for child in children:
+                    self._confirm(child, key, ready_rows)
+            else:
+                if rows:
+                    self._held_rows.setdefault(key, []).extend(rows)
+                    self._held_count += len(rows)
+                if children:
+                    self._children.setdefault(key, []).extend(children)
+        return ready_rows
+
+    def finish(self):
+        """Drops the rows of the folders no longer in the tree and saves the skeleton for the next exploration."""
+        if self._held_count:
+            logger.info("Skeleton cache: {} rows of {} folders no longer in the tree dropped"
+                        .format(self._held_count, len(self._held_rows)))
+        self._skeleton_cache.save(self._confirmed_order, self._rows)
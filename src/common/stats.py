@@ -0,0 +1,460 @@
+# standard imports
+import json
+import math
+import multiprocessing
+import threading
+
+# standard from imports
+from time import perf_counter
+
+# libraries import
+from common.logging import get_logger
+
+logger = get_logger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1_000, 5_000, 10_000, 100_000, math.inf)
+
+# all the metrics collected by the explorer: name -> (type, help, histogram buckets)
+METRICS = {
+    'api_calls_total': ('counter', 'Google API calls per endpoint', None),
+    'api_errors_total': ('counter', 'Google API calls ended with an HTTP error, per endpoint and status', None),
+    'api_call_seconds': ('histogram', 'Latency of the Google API calls per endpoint', LATENCY_BUCKETS),
+    'api_bytes_received_total': ('counter', 'Bytes received from the Google APIs per endpoint', None),
+    'api_retries_total': ('counter', 'Google API calls retried because of rate limits or backend errors', None),
+    'api_timeouts_total': ('counter', 'Google API calls that could not connect or read the response in time, per '
+                                      'endpoint', None),
+    'api_hedges_total': ('counter', 'Slow listing calls sent a second time, per endpoint', None),
+    'api_hedge_wins_total': ('counter', 'Listing calls sent a second time whose second response arrived first, per '
+                                        'endpoint', None),
+    'api_retry_wait_seconds_total': ('counter', 'Time spent waiting before retrying Google API calls', None),
+    'folders_explored_total': ('counter', 'Folders explored by the workers', None),
+    'folder_seconds': ('histogram', 'Time spent exploring a single folder', LATENCY_BUCKETS),
+    'folder_pages': ('histogram', 'Number of files.list pages per folder', SIZE_BUCKETS),
+    'folder_partitions_total': ('counter', 'createdTime ranges in which the listing of big folders has been split',
+                                None),
+    'files_emitted_total': ('counter', 'Files sent by the workers to the output writer', None),
+    'search_items_total': ('counter', 'Items found by the folder search command', None),
+    'search_folders_read_total': ('counter', 'Parent folders read to rebuild the full names of the items found by the '
+                                             'folder search command', None),
+    'duplicate_runs_spilled_total': ('counter', 'Runs of duplicate candidates sorted and spilled to disk by the '
+                                                'writer', None),
+    'identity_failovers_total': ('counter', 'Folders explored again with another identity after an access error',
+                                 None),
+    'frontier_leases_expired_total': ('counter', 'Folders leased by worker nodes and not completed in time', None),
+    'frontier_late_completions_total': ('counter', 'Results sent by worker nodes after their lease expired', None),
+    'worker_restarts_total': ('counter', 'Worker processes restarted after they died or got stuck', None),
+    'folders_requeued_total': ('counter', 'Folders queued again because the worker exploring them died, per outcome',
+                               None),
+    'autoscale_decisions_total': ('counter', 'Changes of the number of folders explored at the same time, per '
+                                             'direction', None),
+    'task_queue_depth': ('histogram', 'Folders waiting to be explored, sampled by the main process', SIZE_BUCKETS),
+    'time_to_saturation_seconds': ('gauge', 'Time elapsed before the folders waiting to be explored were enough to '
+                                            'keep all the workers busy', None),
+    'tail_seconds': ('gauge', 'Time elapsed between the last moment all the workers were busy and the end of the '
+                              'exploration', None),
+    'result_buffer_put_seconds': ('histogram', 'Time spent by the workers to hand results to the writer',
+                                  LATENCY_BUCKETS),
+    'result_buffer_wait_seconds': ('histogram', 'Time spent by the writer waiting for results', LATENCY_BUCKETS),
+    'writer_rows_total': ('counter', 'Rows written to the output, per writer', None),
+    'writer_writerows_seconds': ('histogram', 'Time spent in the writerows method, per writer', LATENCY_BUCKETS),
+    'writer_active_seconds': ('gauge', 'Time elapsed between the first result received and the output closed',
+                              None),
+}
+
+PROMETHEUS_PREFIX = 'drive_explorer_'
+
+# seconds between two checks of the task queue, to know when the workers are saturated (see QueueSampler)
+SATURATION_POLL_INTERVAL = 0.05
+
+# the registry of the current process: when None the stats are disabled and all the functions below do nothing
+_registry = None
+# the worker processes may explore folders with several threads (see FolderConsumer)
+_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self, buckets):
+        """
+        A simple cumulative histogram, compatible with the Prometheus one
+
+        :param buckets: the upper bounds of the buckets, the last one should be math.inf
+        """
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+
+class StatsRegistry:
+    def __init__(self):
+        """
+        Holds the metrics of a single process. Every metric is identified by its name and by a tuple of labels.
+        """
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value, labels):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels):
+        self.gauges[(name, labels)] = value
+
+    def observe(self, name, value, labels):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = Histogram(METRICS[name][2])
+            self.histograms[key] = histogram
+
+        histogram.observe(value)
+
+    def merge(self, other):
+        """
+        Merges the metrics from another registry into this one: counters and histograms are added up, for gauges we
+        keep the highest value
+
+        :param other: the other StatsRegistry
+        """
+        for key, value in other.counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+        for key, value in other.gauges.items():
+            self.gauges[key] = max(self.gauges.get(key, value), value)
+
+        for key, histogram in other.histograms.items():
+            if key in self.histograms:
+                self.histograms[key].merge(histogram)
+            else:
+                self.histograms[key] = histogram
+
+    def total(self, name):
+        """Sum of a counter over all its labels."""
+        return sum(value for (counter_name, _), value in self.counters.items() if counter_name == name)
+
+    def to_dict(self, elapsed):
+        """
+        JSON friendly version of the registry
+
+        :param elapsed: the duration of the exploration in seconds
+        :return: a dictionary
+        """
+        def series(key):
+            name, labels = key
+            return {'name': name, 'labels': dict(labels)}
+
+        result = {
+            'elapsed_seconds': elapsed,
+            'counters': [{**series(key), 'value': value} for key, value in sorted(self.counters.items())],
+            'gauges': [{**series(key), 'value': value} for key, value in sorted(self.gauges.items())],
+            'histograms': [],
+            'derived': {},
+        }
+
+        for key, histogram in sorted(self.histograms.items()):
+            result['histograms'].append({
+                **series(key),
+                'count': histogram.count,
+                'sum': histogram.sum,
+                'max': histogram.max,
+                'buckets': {str(bound): count for bound, count in zip(histogram.buckets, histogram.counts)},
+            })
+
+        # rates are computed on the whole exploration, but the writer ones that use the writer active time
+        derived = result['derived']
+        if elapsed > 0:
+            derived['api_calls_per_second'] = self.total('api_calls_total') / elapsed
+            derived['folders_per_second'] = self.total('folders_explored_total') / elapsed
+
+        writer_active = max((value for (name, _), value in self.gauges.items() if name == 'writer_active_seconds'),
+                            default=0)
+        if writer_active > 0:
+            derived['writer_rows_per_second'] = self.total('writer_rows_total') / writer_active
+
+        return result
+
+    def to_prometheus(self, elapsed):
+        """
+        Prometheus text exposition format version of the registry
+
+        :param elapsed: the duration of the exploration in seconds
+        :return: a string
+        """
+        def labels_str(labels, extra=()):
+            all_labels = tuple(labels) + tuple(extra)
+            if not all_labels:
+                return ''
+            return '{{{}}}'.format(','.join('{}="{}"'.format(key, str(value).replace('"', '\\"'))
+                                            for key, value in all_labels))
+
+        def bound_str(bound):
+            return '+Inf' if bound == math.inf else str(bound)
+
+        lines = []
+        for metric_name, (metric_type, metric_help, _) in METRICS.items():
+            full_name = PROMETHEUS_PREFIX + metric_name
+            lines.append('# HELP {} {}'.format(full_name, metric_help))
+            lines.append('# TYPE {} {}'.format(full_name, metric_type))
+
+            if metric_type == 'counter':
+                for (name, labels), value in sorted(self.counters.items()):
+                    if name == metric_name:
+                        lines.append('{}{} {}'.format(full_name, labels_str(labels), value))
+            elif metric_type == 'gauge':
+                for (name, labels), value in sorted(self.gauges.items()):
+                    if name == metric_name:
+                        lines.append('{}{} {}'.format(full_name, labels_str(labels), value))
+            else:
+                for (name, labels), histogram in sorted(self.histograms.items()):
+                    if name != metric_name:
+                        continue
+
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append('{}_bucket{} {}'.format(full_name, labels_str(labels, (('le', bound_str(bound)),)),
+                                                             cumulative))
+                    lines.append('{}_sum{} {}'.format(full_name, labels_str(labels), histogram.sum))
+                    lines.append('{}_count{} {}'.format(full_name, labels_str(labels), histogram.count))
+
+        lines.append('# HELP {}elapsed_seconds Duration of the exploration'.format(PROMETHEUS_PREFIX))
+        lines.append('# TYPE {}elapsed_seconds gauge'.format(PROMETHEUS_PREFIX))
+        lines.append('{}elapsed_seconds {}'.format(PROMETHEUS_PREFIX, elapsed))
+
+        return '\n'.join(lines) + '\n'
+
+
+def enabled():
+    """Are stats collected in the current process?"""
+    return _registry is not None
+
+
+def inc(name, value=1, **labels):
+    """
+    Increments a counter. Does nothing when stats are disabled
+
+    :param name: the name of the counter, as defined in METRICS
+    :param value: the increment
+    :param labels: the labels of the counter
+    """
+    if _registry is not None:
+        with _lock:
+            _registry.inc(name, value, tuple(sorted(labels.items())))
+
+
+def set_gauge(name, value, **labels):
+    """
+    Sets the value of a gauge. Does nothing when stats are disabled
+
+    :param name: the name of the gauge, as defined in METRICS
+    :param value: the value
+    :param labels: the labels of the gauge
+    """
+    if _registry is not None:
+        with _lock:
+            _registry.set(name, value, tuple(sorted(labels.items())))
+
+
+def observe(name, value, **labels):
+    """
+    Adds a value to an histogram. Does nothing when stats are disabled
+
+    :param name: the name of the histogram, as defined in METRICS
+    :param value: the observed value
+    :param labels: the labels of the histogram
+    """
+    if _registry is not None:
+        with _lock:
+            _registry.observe(name, value, tuple(sorted(labels.items())))
+
+
+class _Timer:
+    def __init__(self, name, labels):
+        self._name = name
+        self._labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        observe(self._name, perf_counter() - self._start, **self._labels)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+def timer(name, **labels):
+    """
+    Context manager used to add the duration of a block of code to an histogram
+
+    :param name: the name of the histogram, as defined in METRICS
+    :param labels: the labels of the histogram
+    :return: the context manager
+    """
+    if _registry is None:
+        return _null_timer
+
+    return _Timer(name, labels)
+
+
+class QueueSampler(threading.Thread):
+    def __init__(self, queue, interval=1, saturation=None):
+        """
+        Thread used in the main process to periodically sample the number of folders waiting to be explored
+
+        :param queue: the task queue
+        :param interval: seconds between two samples
+        :param saturation: number of folders waiting that keep all the workers busy, the time it takes to reach it is
+        saved in the time_to_saturation_seconds gauge and the time between the last moment it was reached and the end
+        of the exploration in the tail_seconds one. None to not measure them
+        """
+        super().__init__(daemon=True)
+        self._queue = queue
+        self._interval = interval
+        self._saturation = saturation
+        self._stopped = threading.Event()
+        self._last_saturated = None
+
+    def run(self):
+        dt_start = perf_counter()
+        self._last_saturated = dt_start
+        last_sample = dt_start
+        saturated = False
+
+        # to know when the workers are saturated the queue is checked more often, the samples are still taken every
+        # interval
+        poll_interval = self._interval if self._saturation is None else min(self._interval, SATURATION_POLL_INTERVAL)
+        while not self._stopped.wait(poll_interval):
+            try:
+                depth = self._queue.qsize()
+            except NotImplementedError:
+                # qsize() is not available on every platform (e.g. macOS)
+                break
+
+            now = perf_counter()
+            if self._saturation is not None and depth >= self._saturation:
+                if not saturated:
+                    saturated = True
+                    set_gauge('time_to_saturation_seconds', now - dt_start)
+                self._last_saturated = now
+            if now - last_sample >= self._interval:
+                observe('task_queue_depth', depth)
+                last_sample = now
+
+    def stop(self):
+        """Stops sampling, to be called as soon as the exploration is over."""
+        self._stopped.set()
+        self.join()
+        if self._saturation is not None and self._last_saturated is not None:
+            set_gauge('tail_seconds', perf_counter() - self._last_saturated)
+
+
+class StatsCollector:
+    def __init__(self, stats_file, log_level):
+        """
+        Collects the stats from all the processes and writes them to stats_file. It is created in the main process
+        and passed to the child processes that call attach() when they start and detach() when they are done.
+
+        :param stats_file: the output file, JSON if the extension is .json, Prometheus text format otherwise
+        :param log_level: the logging level (see the standar python logging module)
+        """
+        self._stats_file = stats_file
+        self._log_level = log_level
+        self._queue = multiprocessing.Queue()
+
+        # only used in the main process
+        self._merged = None
+        self._collector_thread = None
+
+        logger.setLevel(self._log_level)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_merged'] = None
+        state['_collector_thread'] = None
+        return state
+
+    def attach(self):
+        """Enables the stats in the current process."""
+        global _registry
+        _registry = StatsRegistry()
+
+    def detach(self):
+        """Sends the stats of the current child process to the main one and disables them."""
+        global _registry
+        if _registry is not None:
+            self._queue.put(_registry)
+            _registry = None
+
+    def start(self):
+        """
+        Enables the stats in the main process and starts collecting the ones from the child processes. Child
+        snapshots are read while the exploration is running so that no child process is stuck on exit with a full
+        pipe.
+        """
+        self.attach()
+        self._merged = StatsRegistry()
+        self._collector_thread = threading.Thread(target=self._collect, daemon=True)
+        self._collector_thread.start()
+
+    def _collect(self):
+        while True:
+            registry = self._queue.get()
+            if registry is None:
+                break
+            self._merged.merge(registry)
+
+    def finish(self, elapsed):
+        """
+        Merges all the stats and writes them to the stats file. To be called once all the child processes are over.
+
+        :param elapsed: the duration of the exploration in seconds
+        """
+        global _registry
+
+        self._queue.put(None)
+        self._collector_thread.join()
+
+        if _registry is not None:
+            self._merged.merge(_registry)
+            _registry = None
+
+        with open(self._stats_file, 'w') as stats_file:
+            if self._stats_file.lower().endswith('.json'):
+                json.dump(self._merged.to_dict(elapsed), stats_file, indent=2)
+            else:
+                stats_file.write(self._merged.to_prometheus(elapsed))
+
+        logger.info("Stats saved to {}".format(self._stats_file))
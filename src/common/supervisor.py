@@ -0,0 +1,112 @@
+# standard imports
+import threading
+
+# libraries import
+from common import progress
+from common import stats
+from common.logging import get_logger
+
+logger = get_logger(__name__)
+
+# seconds between two checks of the workers
+SUPERVISION_INTERVAL = 1
+# a worker process that died is restarted at most this many times
+MAX_WORKER_RESTARTS = 5
+
+
+class WorkerSupervisor(threading.Thread):
+    def __init__(self, scheduler, workers, create_worker, log_level, concurrency_limiter=None, stuck_timeout=0,
+                 interval=SUPERVISION_INTERVAL):
+        """
+        Thread used in the main process to watch the worker processes. A worker that died is replaced by a new one and
+        the folders it was holding are queued again by the scheduler (see TaskScheduler.release). A worker with a
+        thread that has not handed over anything of its folder for too long is stuck: it is terminated and replaced
+        the same way. When no worker is left, the folders waiting are dropped so that the exploration can end. Once
+        the workers are told to exit (see drain) they are not replaced anymore, the threads still waiting for a folder
+        after all the poison pills have been taken are given one
+
+        :param scheduler: the TaskScheduler serving the workers
+        :param workers: the list of the worker processes, the workers replaced are changed in place
+        :param create_worker: function creating the worker process of a position of the list, not started
+        :param log_level: the logging level (see the standar python logging module)
+        :param concurrency_limiter: the ConcurrencyLimiter of the workers, if any, the slots of the dead workers are
+        given back
+        :param stuck_timeout: seconds after which a worker is stuck, 0 to never terminate a worker
+        :param interval: seconds between two checks
+        """
+        super().__init__(daemon=True)
+        self._scheduler = scheduler
+        self._workers = workers
+        self._create_worker = create_worker
+        self._concurrency_limiter = concurrency_limiter
+        self._stuck_timeout = stuck_timeout
+        self._interval = interval
+        self._stopped = threading.Event()
+        # the workers are not replaced while they are draining, the check is not run in the middle of the change
+        self._draining = False
+        self._lock = threading.Lock()
+
+        self._restarts = [0] * len(workers)
+        self._lost = set()
+
+        logger.setLevel(log_level)
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            with self._lock:
+                self._supervise()
+
+    def _supervise(self):
+        if self._stuck_timeout > 0:
+            stuck = self._scheduler.stuck(self._stuck_timeout)
+            for worker in self._workers:
+                if worker.pid in stuck and worker.is_alive():
+                    logger.warning("Worker {} made no progress for {} seconds, terminating it"
+                                   .format(worker.pid, self._stuck_timeout))
+                    worker.terminate()
+                    worker.join()
+
+        if self._draining:
+            blocked = self._scheduler.unblock(self._interval)
+            if blocked:
+                logger.warning("{} worker threads waiting for a folder after the poison pills, giving them one"
+                               .format(blocked))
+            return
+
+        for worker_i, worker in enumerate(self._workers):
+            if worker_i in self._lost or worker.is_alive():
+                continue
+
+            queued, given_up = self._scheduler.release(worker.pid)
+            if self._concurrency_limiter is not None:
+                self._concurrency_limiter.reset(progress.FIRST_WORKER_SLOT + worker_i)
+            stats.inc('folders_requeued_total', queued, outcome='queued')
+            stats.inc('folders_requeued_total', given_up, outcome='given_up')
+
+            if self._restarts[worker_i] >= MAX_WORKER_RESTARTS:
+                logger.error("Worker {} died (exit code {}), {} folders queued again. It died too many times, it is "
+                             "not restarted".format(worker.pid, worker.exitcode, queued))
+                self._lost.add(worker_i)
+                continue
+
+            self._restarts[worker_i] += 1
+            self._workers[worker_i] = self._create_worker(worker_i)
+            self._workers[worker_i].start()
+            stats.inc('worker_restarts_total')
+            logger.warning("Worker {} died (exit code {}), {} folders queued again, restarted as worker {}"
+                           .format(worker.pid, worker.exitcode, queued, self._workers[worker_i].pid))
+
+        if len(self._lost) == len(self._workers):
+            dropped = self._scheduler.clear()
+            logger.error("No worker left, {} folders are not explored".format(dropped))
+            self._stopped.set()
+
+    def drain(self):
+        """Stops replacing the workers, before they are told to exit."""
+        with self._lock:
+            self._draining = True
+
+    def stop(self):
+        """Stops watching the workers."""
+        self._stopped.set()
+        self.join()
@@ -0,0 +1,218 @@
+# standard imports
+import multiprocessing
+import threading
+
+# standard from imports
+from datetime import datetime, timezone
+from time import monotonic, sleep
+
+# third parties from imports
+from google.auth.credentials import Credentials
+from google.auth.exceptions import RefreshError
+
+# libraries import
+from commands.credential import GoogleCredential
+from common.logging import get_logger
+
+logger = get_logger(__name__)
+
+# access tokens are renewed this many seconds before they expire. It is more than the threshold used by google-auth to
+# consider a token expired, so the child processes always find a valid token in the shared memory
+REFRESH_MARGIN = 300
+# seconds to wait before trying again when the token can not be renewed
+REFRESH_RETRY_SECONDS = 10
+# seconds a child process waits for a new token when it asked the broker to renew it
+REFRESH_TIMEOUT = 60
+# maximum size of an access token, Google ones are way shorter
+MAX_TOKEN_BYTES = 4096
+
+
+def _to_timestamp(expiry):
+    # google-auth expiries are naive UTC datetimes
+    return expiry.replace(tzinfo=timezone.utc).timestamp() if expiry is not None else 0
+
+
+def _from_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None) if timestamp else None
+
+
+class TokenBroker:
+    def __init__(self, email, credentials, log_level, refresh=True, refresh_margin=REFRESH_MARGIN):
+        """
+        Owns the credentials of the user in the main process and shares the access token with the child processes,
+        that never renew it or read the credential store on their own. The token is renewed ahead of its expiry by a
+        thread of the main process, that is also the only one saving it in the credential store.
+
+        :param email: the email of the credentials
+        :param credentials: the credentials loaded from the credential store
+        :param log_level: the logging level (see the standar python logging module)
+        :param refresh: when False the token is never renewed (e.g. when the responses are replayed from a cassette)
+        :param refresh_margin: seconds before the expiry when the token is renewed, at most half of the lifetime of
+        the token
+        """
+        self._email = email
+        self._log_level = log_level
+        self._refresh = refresh
+        self._refresh_margin = refresh_margin
+
+        # shared with the child processes, the version changes every time a new token is published
+        self._token = multiprocessing.Array('c', MAX_TOKEN_BYTES)
+        self._expiry = multiprocessing.Value('d', 0)
+        self._version = multiprocessing.Value('q', 0)
+        self._refresh_requested = multiprocessing.Event()
+
+        # only used in the main process
+        self._credentials = credentials
+        self._stopped = threading.Event()
+        self._refresh_thread = None
+        # when the current token has been received, to know its lifetime
+        self._received = datetime.now(timezone.utc)
+
+        logger.setLevel(self._log_level)
+        self._publish()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the real credentials never leave the main process
+        state['_credentials'] = None
+        state['_stopped'] = None
+        state['_refresh_thread'] = None
+        return state
+
+    @property
+    def email(self):
+        """The email of the credentials."""
+        return self._email
+
+    def _publish(self):
+        token = (self._credentials.token or '').encode('utf-8')
+        if len(token) >= MAX_TOKEN_BYTES:
+            raise ValueError("Access token too long: {} bytes".format(len(token)))
+
+        with self._token.get_lock():
+            self._token.value = token
+            self._expiry.value = _to_timestamp(self._credentials.expiry)
+            self._version.value += 1
+
+    def current(self):
+        """
+        Gets the token currently shared by the broker
+
+        :return: a tuple with the token, its expiry (naive UTC datetime or None) and its version
+        """
+        with self._token.get_lock():
+            return self._token.value.decode('utf-8'), _from_timestamp(self._expiry.value), self._version.value
+
+    def credentials(self):
+        """
+        Creates the credentials to be used in a child process
+
+        :return: a BrokeredCredentials instance
+        """
+        return BrokeredCredentials(self)
+
+    def request_refresh(self, version):
+        """
+        Asks the main process for a new token and waits for it. Used by the child processes when their token is
+        rejected or expired
+
+        :param version: the version of the token the caller has
+        """
+        dt_start = monotonic()
+        self._refresh_requested.set()
+        while self._version.value == version:
+            if monotonic() - dt_start > REFRESH_TIMEOUT:
+                raise RefreshError("No new access token received from the main process in {} seconds"
+                                   .format(REFRESH_TIMEOUT))
+            sleep(0.1)
+
+    def start(self):
+        """Starts renewing the token in the main process."""
+        if not self._refresh:
+            return
+
+        self._refresh_thread = threading.Thread(target=self._run, daemon=True)
+        self._refresh_thread.start()
+
+    def _seconds_to_refresh(self):
+        if self._credentials.expiry is None:
+            return None
+
+        # a token living less than the margin would be renewed again as soon as it is received
+        expiry = self._credentials.expiry.replace(tzinfo=timezone.utc)
+        margin = min(self._refresh_margin, (expiry - self._received).total_seconds() / 2)
+        return max((expiry - datetime.now(timezone.utc)).total_seconds() - margin, 0)
+
+    def _run(self):
+        # requests is only needed to renew the token, we do not import it when the token is never renewed
+        from google.auth.transport.requests import Request
+
+        while not self._stopped.is_set():
+            # we wake up when the token is about to expire or when a child process asks for a new one
+            if self._refresh_requested.wait(self._seconds_to_refresh()):
+                self._refresh_requested.clear()
+            if self._stopped.is_set():
+                break
+
+            try:
+                self._credentials.refresh(Request())
+                self._received = datetime.now(timezone.utc)
+            except Exception as e:
+                logger.warning("Impossible to renew the access token of {}, retrying in {} seconds: {}"
+                               .format(self._email, REFRESH_RETRY_SECONDS, e))
+                self._stopped.wait(REFRESH_RETRY_SECONDS)
+                continue
+
+            self._publish()
+            logger.debug("Access token of {} renewed, it expires at {}".format(self._email,
+                                                                              self._credentials.expiry))
+
+            with GoogleCredential(log_level=self._log_level) as google_cred:
+                google_cred.update_credentials(self._email, self._credentials)
+
+    def stop(self):
+        """Stops renewing the token."""
+        if self._refresh_thread is None:
+            return
+
+        self._stopped.set()
+        self._refresh_requested.set()
+        self._refresh_thread.join()
+        self._refresh_thread = None
+
+
+class BrokeredCredentials(Credentials):
+    def __init__(self, broker):
+        """
+        Credentials used in the child processes: the token is read from the TokenBroker shared memory, Google is never
+        called to renew it
+
+        :param broker: the TokenBroker of the main process
+        """
+        super().__init__()
+        self._broker = broker
+        self._version = None
+        self._load()
+
+    def _load(self):
+        self.token, self.expiry, self._version = self._broker.current()
+
+    @property
+    def expired(self):
+        # google-auth considers a token expired minutes before its expiry, a token living less than that would be
+        # renewed before every request: the broker already renews it ahead of its expiry
+        if not self.expiry:
+            return False
+        return datetime.now(timezone.utc).replace(tzinfo=None) >= self.expiry
+
+    def refresh(self, request):
+        """
+        Gets the latest token from the broker. If it is the one we already have (it has been rejected or it is
+        expired), the main process is asked to renew it
+
+        :param request: not used, the token is never renewed here
+        """
+        _, _, version = self._broker.current()
+        if version == self._version:
+            self._broker.request_refresh(self._version)
+        self._load()
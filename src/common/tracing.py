@@ -0,0 +1,207 @@
+# standard imports
+import json
+import multiprocessing
+import os
+import threading
+
+# standard from imports
+from time import perf_counter_ns
+
+# libraries import
+from common.logging import get_logger
+
+logger = get_logger(__name__)
+
+# number of events kept in memory by every process before sending them to the main one
+FLUSH_EVENTS = 10_000
+
+# the events of the current process and the collector used to send them: when None tracing is disabled
+_events = None
+_collector = None
+_process_name = None
+# the worker processes may explore folders with several threads (see FolderConsumer), the events are recorded and
+# swapped under this lock
+_lock = threading.Lock()
+
+
+def enabled():
+    """Are trace events recorded in the current process?"""
+    return _events is not None
+
+
+def add_span(name, category, start_ns, duration_ns, **args):
+    """
+    Records a span that already happened (or that is going to happen, like a retry wait). Does nothing when tracing
+    is disabled
+
+    :param name: the name of the span
+    :param category: the category of the span, used by the trace viewers to filter events
+    :param start_ns: when the span started, as returned by time.perf_counter_ns()
+    :param duration_ns: the duration of the span in nanoseconds
+    :param args: extra details shown by the trace viewers
+    """
+    with _lock:
+        if _events is None:
+            return
+
+        # events are kept as tuples, they are only converted to the trace format when sent to the main process
+        _events.append((name, category, start_ns, duration_ns, threading.get_ident(), args))
+        collector = _collector if len(_events) >= FLUSH_EVENTS else None
+
+    if collector is not None:
+        collector.flush()
+
+
+class _Span:
+    def __init__(self, name, category, args):
+        self._name = name
+        self._category = category
+        self._args = args
+        self._start = None
+
+    def __enter__(self):
+        self._start = perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        add_span(self._name, self._category, self._start, perf_counter_ns() - self._start, **self._args)
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+def span(name, category, **args):
+    """
+    Context manager used to record a span around a block of code
+
+    :param name: the name of the span
+    :param category: the category of the span
+    :param args: extra details shown by the trace viewers
+    :return: the context manager
+    """
+    if _events is None:
+        return _null_span
+
+    return _Span(name, category, args)
+
+
+class TraceCollector:
+    def __init__(self, trace_file, log_level):
+        """
+        Collects the trace events from all the processes and writes them to trace_file in the Chrome trace event
+        format (https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU), that can be
+        loaded in Perfetto or in chrome://tracing. It is created in the main process and passed to the child
+        processes that call attach() when they start and detach() when they are done.
+
+        :param trace_file: the output file
+        :param log_level: the logging level (see the standar python logging module)
+        """
+        self._trace_file = trace_file
+        self._log_level = log_level
+        self._queue = multiprocessing.Queue()
+
+        # all the timestamps are relative to the creation of the collector
+        self._origin_ns = perf_counter_ns()
+
+        # only used in the main process
+        self._collector_thread = None
+        self._event_count = 0
+
+        logger.setLevel(self._log_level)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_collector_thread'] = None
+        return state
+
+    def attach(self, process_name):
+        """
+        Enables tracing in the current process
+
+        :param process_name: the name of the process shown in the trace viewers
+        """
+        global _events, _collector, _process_name
+        with _lock:
+            _events = []
+            _collector = self
+            _process_name = process_name
+
+    def flush(self):
+        """Sends the events recorded in the current process to the main one."""
+        global _events
+        # the list is swapped first, the other threads of the process keep recording in the new one
+        with _lock:
+            if _events is None:
+                return
+            events, _events = _events, []
+        if not events:
+            return
+        pid = os.getpid()
+        trace_events = [
+            {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': (start_ns - self._origin_ns) / 1000,
+                'dur': duration_ns / 1000,
+                'pid': pid,
+                'tid': tid,
+                'args': args,
+            }
+            for name, category, start_ns, duration_ns, tid, args in events]
+        self._queue.put(trace_events)
+
+    def detach(self):
+        """Sends the remaining events of the current child process to the main one and disables tracing."""
+        global _events, _collector
+        if _events is None:
+            return
+
+        self.flush()
+        self._queue.put([{'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': _process_name}}])
+        with _lock:
+            _events = None
+            _collector = None
+
+    def start(self):
+        """
+        Enables tracing in the main process and starts writing the events sent by the child processes, so that they
+        are never all kept in memory at the same time.
+        """
+        self.attach('main')
+        self._collector_thread = threading.Thread(target=self._collect, daemon=True)
+        self._collector_thread.start()
+
+    def _collect(self):
+        with open(self._trace_file, 'w') as trace_file:
+            trace_file.write('{"traceEvents": [\n')
+            first = True
+            while True:
+                trace_events = self._queue.get()
+                if trace_events is None:
+                    break
+
+                for trace_event in trace_events:
+                    if not first:
+                        trace_file.write(',\n')
+                    first = False
+                    trace_file.write(json.dumps(trace_event, default=str))
+
+                self._event_count += len(trace_events)
+
+            trace_file.write('\n], "displayTimeUnit": "ms"}\n')
+
+    def finish(self):
+        """Writes the remaining events and closes the trace file. To be called once all the child processes are over."""
+        self.detach()
+        self._queue.put(None)
+        self._collector_thread.join()
+        logger.info("Saved {} trace events to {}".format(self._event_count, self._trace_file))
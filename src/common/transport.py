@@ -0,0 +1,230 @@
+# standard imports
+import copy
+import threading
+
+# standard from imports
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import perf_counter
+from urllib.parse import urlsplit
+
+# third parties libraries
+import httplib2
+
+# libraries import
+from common import stats
+from common.logging import get_logger
+
+logger = get_logger(__name__)
+
+# seconds to wait for a connection to Google and for every read of a response, when not set by the user
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+# the API methods hedged: the listings, that only read and are the bulk of the calls
+HEDGED_METHODS = ('drive.files.list',)
+# the latency of the last listing calls of a process is used to choose when to hedge
+HEDGE_WINDOW = 200
+# a process starts hedging once it has measured this many listing calls
+MIN_HEDGE_SAMPLES = 20
+# the threads sending the hedged calls of a process, the calls that lost the race keep one until they end
+MAX_HEDGE_THREADS = 64
+
+# the RequestPolicy of the current process: when None the defaults of googleapiclient are used
+_policy = None
+
+
+def _read_timeout_connection(connection_class, read_timeout):
+    # httplib2 uses the same timeout to connect and to read, the socket of the connection gets the read timeout once it
+    # is connected
+    class ReadTimeoutConnection(connection_class):
+        def connect(self):
+            super().connect()
+            self.sock.settimeout(read_timeout)
+
+    return ReadTimeoutConnection
+
+
+class _TimeoutHttp(httplib2.Http):
+    def __init__(self, connect_timeout, read_timeout):
+        super().__init__(timeout=connect_timeout)
+        self._connection_types = {
+            'http': _read_timeout_connection(httplib2.HTTPConnectionWithTimeout, read_timeout),
+            'https': _read_timeout_connection(httplib2.HTTPSConnectionWithTimeout, read_timeout),
+        }
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=httplib2.DEFAULT_MAX_REDIRECTS,
+                connection_type=None):
+        if connection_type is None:
+            connection_type = self._connection_types.get(urlsplit(uri).scheme)
+        return super().request(uri, method, body, headers, redirections, connection_type)
+
+
+def build_http():
+    """
+    Creates the http object sending the API requests of the current process, with the timeouts of its RequestPolicy
+
+    :return: the httplib2 http object
+    """
+    if _policy is None:
+        from googleapiclient.http import build_http as build_default_http
+        return build_default_http()
+
+    return _policy.build_http()
+
+
+def http_for(credentials):
+    """
+    Gets the http object to be used by an API client in the current process
+
+    :param credentials: the credentials used to call the APIs
+    :return: the http object, None when no RequestPolicy is attached to the current process
+    """
+    if _policy is None:
+        return None
+
+    from google_auth_httplib2 import AuthorizedHttp
+
+    return AuthorizedHttp(credentials, http=_policy.build_http())
+
+
+def execute(request):
+    """
+    Sends an API request with the RequestPolicy of the current process
+
+    :param request: a googleapiclient HttpRequest
+    :return: the API response
+    """
+    if _policy is None:
+        return request.execute()
+
+    return _policy.execute(request)
+
+
+class RequestPolicy:
+    def __init__(self, connect_timeout, read_timeout, hedge_percentile, log_level):
+        """
+        How the API requests are sent. A request that can not connect or that waits too long for the response fails
+        with a timeout, and it is tried again (see common.backoff). With hedging, a listing still running after the
+        given percentile of the latencies measured by the process gets a duplicate request: the first response
+        received is used, so a single slow call does not hold up a folder. It is created in the main process and
+        passed to the child processes
+
+        :param connect_timeout: seconds to wait for a connection
+        :param read_timeout: seconds to wait for every read of a response
+        :param hedge_percentile: the latency percentile after which a listing is hedged, 0 to never hedge
+        :param log_level: the logging level (see the standar python logging module)
+        """
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._hedge_percentile = hedge_percentile
+
+        logger.setLevel(log_level)
+
+        # per process state, created by attach
+        self._lock = None
+        self._latencies = None
+        self._executor = None
+        self._spare_https = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        state['_latencies'] = None
+        state['_executor'] = None
+        state['_spare_https'] = None
+        return state
+
+    def attach(self):
+        """Sends the API requests of the current process with this policy."""
+        global _policy
+        _policy = self
+
+        # forked processes inherit the state of the parent, every process measures its own latencies
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=HEDGE_WINDOW)
+        self._executor = ThreadPoolExecutor(max_workers=MAX_HEDGE_THREADS, thread_name_prefix='hedge')
+        self._spare_https = {}
+
+    def detach(self):
+        """Stops using this policy in the current process."""
+        global _policy
+        _policy = None
+        # the calls that lost the race are not waited for
+        self._executor.shutdown(wait=False)
+
+    def build_http(self):
+        """
+        :return: a httplib2 http object with the timeouts of the policy
+        """
+        return _TimeoutHttp(self._connect_timeout, self._read_timeout)
+
+    def execute(self, request):
+        """
+        Sends an API request, hedging it when it is a listing
+
+        :param request: a googleapiclient HttpRequest
+        :return: the API response
+        """
+        # only the requests sent with the http objects of the policy can be duplicated, not the recorded ones
+        if not self._hedge_percentile or getattr(request, 'methodId', None) not in HEDGED_METHODS \
+                or not isinstance(getattr(request.http, 'http', None), _TimeoutHttp):
+            return request.execute()
+
+        threshold = self._threshold()
+        if threshold is None:
+            dt_start = perf_counter()
+            response = request.execute()
+            with self._lock:
+                self._latencies.append(perf_counter() - dt_start)
+            return response
+
+        # the http objects can not be shared by threads: every call is sent with its own, the one that loses the race
+        # keeps it until it ends
+        first = self._executor.submit(self._send, request)
+        done, _ = wait([first], timeout=threshold)
+        if done:
+            return first.result()
+
+        stats.inc('api_hedges_total', endpoint=request.methodId)
+        second = self._executor.submit(self._send, request)
+        done, _ = wait([first, second], return_when=FIRST_COMPLETED)
+
+        winner = first if first in done else second
+        if winner.exception() is not None:
+            # the other call may still succeed
+            other = second if winner is first else first
+            if other.exception() is None:
+                winner = other
+
+        if winner is second:
+            stats.inc('api_hedge_wins_total', endpoint=request.methodId)
+        return winner.result()
+
+    def _threshold(self):
+        with self._lock:
+            if len(self._latencies) < MIN_HEDGE_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self._hedge_percentile / 100))]
+
+    def _send(self, request):
+        # every call works on its own copy, googleapiclient changes the headers of the request it sends
+        request = copy.copy(request)
+        request.headers = dict(request.headers)
+        credentials = request.http.credentials
+
+        with self._lock:
+            spare_https = self._spare_https.setdefault(id(credentials), [])
+            http = spare_https.pop() if spare_https else None
+        if http is None:
+            from google_auth_httplib2 import AuthorizedHttp
+            http = AuthorizedHttp(credentials, http=self.build_http())
+
+        dt_start = perf_counter()
+        try:
+            return request.execute(http=http)
+        finally:
+            with self._lock:
+                # the calls that lost the race are measured too, they are the tail the hedging is about
+                self._latencies.append(perf_counter() - dt_start)
+                spare_https.append(http)
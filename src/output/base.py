@@ -3,6 +3,8 @@ import csv
 
 
 class AbstractOutput(abc.ABC):
+    # the bytes written to the output once the last rows have been flushed, None if it is not a file
+    bytes_written = None
 
     @abc.abstractmethod
     def writeheader(self):
@@ -58,10 +58,13 @@ class CsvOutput(csv.DictWriter, output.base.AbstractOutput):
             etl_rows.append(etl_row)
 
         super().writerows(etl_rows)
+        # tell flushes the rows buffered by the file object
+        self.bytes_written = self._f.tell()
 
     def close(self):
         """
         Simply closes the underlying file object to make sure no further modifications are made to it
 
         """
+        self.bytes_written = self._f.tell()
         self._f.close()
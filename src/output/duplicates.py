@@ -0,0 +1,203 @@
+# standard imports
+import heapq
+import os
+import pickle
+import shutil
+import tempfile
+
+# standard from imports
+from itertools import chain, groupby
+from operator import itemgetter
+
+# libraries import
+from common import stats
+from common.buffer import format_bytes
+from common.drive_utils import CHECKSUM_FIELD
+from common.logging import get_logger
+
+logger = get_logger(__name__)
+
+# the bytes of memory taken by a candidate besides its name and its permissions, a rough estimate of the tuple and of
+# its strings used to know when to spill
+CANDIDATE_BYTES = 400
+PERMISSION_BYTES = 250
+# the candidates pickled together in the runs spilled to disk
+RUN_BLOCK_SIZE = 1_000
+
+# the candidates are tuples: the size is negated so that the biggest files, the ones wasting more bytes, come first.
+# The sort key stops at the id, the fields after it can not always be compared
+NEGATED_SIZE, CHECKSUM, NAME, ID, MIME_TYPE, MODIFIED_TIME, PARENTS, PERMISSIONS = range(8)
+SORT_KEY = itemgetter(NEGATED_SIZE, CHECKSUM, NAME, ID)
+
+
+def _read_run(path):
+    with open(path, 'rb') as run_file:
+        while True:
+            try:
+                block = pickle.load(run_file)
+            except EOFError:
+                return
+            yield from block
+
+
+class DuplicateFinder:
+    def __init__(self, log_level, memory_limit=256 * 1024 * 1024, spill_dir=None):
+        """
+        Used by the writer to find the files with the same content instead of writing the rows of all the files: the
+        files are grouped by size and md5Checksum, only the groups with more than one file are written, with the bytes
+        wasted by the copies. The files without a checksum, like the Google documents, or without bytes are dropped
+        at once. The sizes are counted first: only the first file of every size is kept aside, the files become
+        candidates once a second file has their size, so most of the files, with a size no other file has, are never
+        candidates. The candidates are kept in memory until memory_limit bytes, then they are sorted and spilled to
+        disk in runs, merged once the exploration is over. The first files are spilled with them only when they take
+        more than half of the memory. It is created in the main process and passed to the writer
+
+        :param log_level: the logging level (see the standar python logging module)
+        :param memory_limit: maximum number of bytes of candidates and first files kept in memory before spilling them
+        :param spill_dir: the directory where the temporary spill folder is created (defaults to the system temp)
+        """
+        self._memory_limit = memory_limit
+        self._spill_root = spill_dir if spill_dir is not None else tempfile.gettempdir()
+
+        logger.setLevel(log_level)
+
+        # the number of files of every size, and the first file of the sizes seen once, not spilled yet
+        self._sizes = {}
+        self._first_files = {}
+        self._first_bytes = 0
+        # the candidates not spilled yet and an estimate of their memory
+        self._candidates = []
+        self._memory_bytes = 0
+        # the spill folder is only created the first time the candidates need to be spilled
+        self._spill_dir = None
+        self._runs = []
+
+    def add(self, rows):
+        """
+        Keeps the files of the rows that may have copies
+
+        :param rows: the rows, as sent by the workers
+        """
+        for row in rows:
+            checksum = row.get(CHECKSUM_FIELD)
+            size = int(row.get('size') or 0)
+            if not checksum or not size:
+                continue
+
+            permissions = row.get('permissions') or []
+            candidate = (-size, checksum, row['name'], row['id'], row.get('mimeType'), row.get('modifiedTime'),
+                         row.get('parents') or [], permissions)
+            candidate_bytes = CANDIDATE_BYTES + len(row['name']) + PERMISSION_BYTES * len(permissions)
+
+            count = self._sizes[size] = self._sizes.get(size, 0) + 1
+            if count == 1:
+                self._first_files[size] = (candidate, candidate_bytes)
+                self._first_bytes += candidate_bytes
+            else:
+                first_file = self._first_files.pop(size, None)
+                if first_file is not None:
+                    # the first file of the size has not been spilled, it becomes a candidate
+                    self._first_bytes -= first_file[1]
+                    self._candidates.append(first_file[0])
+                    self._memory_bytes += first_file[1]
+                self._candidates.append(candidate)
+                self._memory_bytes += candidate_bytes
+
+            if self._memory_bytes + self._first_bytes > self._memory_limit:
+                self._spill()
+
+    def _spill(self):
+        # the first files only go to disk when they fill the memory on their own, most of them will never have a copy
+        if self._first_bytes > self._memory_limit / 2:
+            self._candidates.extend(first_file[0] for first_file in self._first_files.values())
+            self._first_files.clear()
+            self._first_bytes = 0
+
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix='drive-explorer-duplicates-{}-'.format(os.getpid()),
+                                               dir=self._spill_root)
+
+        self._candidates.sort(key=SORT_KEY)
+        path = os.path.join(self._spill_dir, 'run-{:06d}'.format(len(self._runs)))
+        with open(path, 'wb') as run_file:
+            for start in range(0, len(self._candidates), RUN_BLOCK_SIZE):
+                pickle.dump(self._candidates[start:start + RUN_BLOCK_SIZE], run_file, pickle.HIGHEST_PROTOCOL)
+        self._runs.append(path)
+        stats.inc('duplicate_runs_spilled_total')
+        logger.debug("{} duplicate candidates spilled to {} ({})".format(len(self._candidates), path,
+                                                                       format_bytes(os.path.getsize(path))))
+
+        self._candidates = []
+        self._memory_bytes = 0
+
+    def _groups(self):
+        # the candidates sorted by size and checksum, the runs on disk are read a block at a time. The first files
+        # left in memory have a size no other file has
+        logger.debug("{} duplicate candidates out of {} files with a checksum".format(
+            sum(count for count in self._sizes.values() if count > 1), sum(self._sizes.values())))
+        self._first_files.clear()
+        self._candidates.sort(key=SORT_KEY)
+        if not self._runs:
+            merged = iter(self._candidates)
+        else:
+            # the first files spilled to disk with a size no other file has are skipped
+            merged = (candidate for candidate in heapq.merge(*[_read_run(path) for path in self._runs],
+                                                             self._candidates, key=SORT_KEY)
+                      if self._sizes[-candidate[NEGATED_SIZE]] > 1)
+
+        for _, same_size in groupby(merged, key=itemgetter(NEGATED_SIZE)):
+            first = next(same_size)
+            second = next(same_size, None)
+            if second is None:
+                continue
+
+            for _, same_content in groupby(chain((first, second), same_size), key=itemgetter(CHECKSUM)):
+                # a file with more than one parent has a row per full name, it is not a copy of itself
+                copies = {}
+                for candidate in same_content:
+                    copies.setdefault(candidate[ID], candidate)
+                if len(copies) > 1:
+                    yield list(copies.values())
+
+    def rows(self, chunk_size):
+        """
+        Gets the rows of the files that have copies, the biggest first, with the rows of the same content together
+
+        :param chunk_size: the number of rows of every list returned
+        :return: a generator of lists of rows
+        """
+        groups = 0
+        files = 0
+        wasted_bytes = 0
+        chunk = []
+        try:
+            for copies in self._groups():
+                size = -copies[0][NEGATED_SIZE]
+                groups += 1
+                files += len(copies)
+                wasted_bytes += size * (len(copies) - 1)
+
+                for candidate in copies:
+                    chunk.append({
+                        'id': candidate[ID],
+                        'name': candidate[NAME],
+                        'mimeType': candidate[MIME_TYPE],
+                        'size': size,
+                        CHECKSUM_FIELD: candidate[CHECKSUM],
+                        'modifiedTime': candidate[MODIFIED_TIME],
+                        'copies': len(copies),
+                        'wastedBytes': size * (len(copies) - 1),
+                        'parents': candidate[PARENTS],
+                        'permissions': candidate[PERMISSIONS],
+                    })
+                    if len(chunk) >= chunk_size:
+                        yield chunk
+                        chunk = []
+
+            logger.info("{} files with copies found in {} groups, {} wasted by the copies".format(
+                files, groups, format_bytes(wasted_bytes)))
+            if chunk:
+                yield chunk
+        finally:
+            if self._spill_dir is not None:
+                shutil.rmtree(self._spill_dir, ignore_errors=True)
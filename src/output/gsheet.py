@@ -1,14 +1,10 @@
 from datetime import datetime
 from itertools import chain
 
-# third parties from imports
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
-
 # libraries import
+from common.api import build_service
 import output.base
 from common.backoff import execute_request
-from commands.credential import GoogleCredential
 from common.drive_utils import permissions_to_string
 from common.logging import get_logger
 
@@ -18,13 +14,12 @@ logger = get_logger(__name__)
 class GSheetOutput(output.base.AbstractOutput):
     """This class takes care of writing the provided input in a Google Spreadsheet."""
 
-    def __init__(self, sheet_name, fieldnames, credential_file, user, log_level):
+    def __init__(self, sheet_name, fieldnames, credentials, log_level):
         """
 
         :param sheet_name: the desired name for the output spreadsheet
         :param fieldnames: the names of the columns to write in the spreadsheet
-        :param credential_file: path to the file with the Google credentials
-        :param user: the email address of the user that will create the output spreadsheet
+        :param credentials: the credentials of the user that will create the output spreadsheet
         :param log_level: log level, obtained as parameter from the CLI
         """
         # id and name should always be at the beginning of the sheet
@@ -37,17 +32,10 @@ class GSheetOutput(output.base.AbstractOutput):
                                 if key not in self._fieldnames and key not in self._ignore_fields)
 
         self._sheet_name = sheet_name
-        self._credential_file = credential_file
-        self._user = user
+        self._credentials = credentials
         self._log_level = log_level
 
-        with GoogleCredential(self._credential_file, self._user, log_level=self._log_level) as google_cred:
-            self._email, self._credentials = google_cred.get_credentials()
-
-        if self._credentials.expired:
-            self._credentials.refresh(Request())
-
-        self._sheet_sdk = build('sheets', 'v4', credentials=self._credentials)
+        self._sheet_sdk = build_service('sheets', 'v4', self._credentials)
         self._sheet_title = 'drive-explorer-{}'.format(datetime.now().strftime("%Y%m%d"))
         self._total_cells = 0
         # sheets currently have a limit of 2M cells
@@ -176,7 +164,7 @@ class GSheetOutput(output.base.AbstractOutput):
         Where we clean the created files and make sure that the name is correct.
         """
         if len(self._sheets_info) > 1:
-            self._drive_sdk = build('drive', 'v3', credentials=self._credentials)
+            self._drive_sdk = build_service('drive', 'v3', self._credentials)
 
             for sheet_i, details in enumerate(self._sheets_info):
                 title = "{} {} of {}".format(details['properties']['title'], sheet_i + 1, len(self._sheets_info))
@@ -56,6 +56,8 @@ class JsonOutput(output.base.AbstractOutput):
             self._frist_write = False
 
         self._f.write(",\n  ".join(json_rows))
+        # tell flushes the rows buffered by the file object
+        self.bytes_written = self._f.tell()
 
     def close(self):
         """
@@ -63,4 +65,5 @@ class JsonOutput(output.base.AbstractOutput):
 
         """
         self._f.write("\n]}")
+        self.bytes_written = self._f.tell()
         self._f.close()
@@ -0,0 +1,210 @@
+# standard imports
+from array import array
+from datetime import datetime, timezone
+
+# libraries import
+from common.drive_utils import FOLDER_MIME_TYPE
+from common.logging import get_logger
+
+logger = get_logger(__name__)
+
+
+def _timestamp(value):
+    # Drive returns RFC 3339 timestamps in UTC, like 2019-02-14T10:21:43.459Z
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def _rfc3339(timestamp):
+    value = datetime.fromtimestamp(timestamp, timezone.utc)
+    return value.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}Z'.format(value.microsecond // 1000)
+
+
+class FolderRollup:
+    def __init__(self, log_level):
+        """
+        Used by the writer to compute the recursive totals of every folder, like du, instead of writing the rows of the
+        files: the bytes, the files and the sub folders, the files per type and the newest modifiedTime. The tree is
+        rebuilt from the ids of the parents of the rows, not from their full names, so the workers send the rows of
+        all the folders whatever the filters. An item listed more than once, e.g. below a folder with two parents, is
+        counted once, and every folder above it counts it once. The rows only update the totals of their own folder,
+        that are added to the folders above once the exploration is over: the memory grows with the folders and with
+        the ids of the items. It is created in the main process and passed to the writer
+
+        :param log_level: the logging level (see the standar python logging module)
+        """
+        logger.setLevel(log_level)
+
+        # the folders by id. The name and the parents of a folder are known once its row is there, the folders
+        # without a name are outside of the exploration, e.g. the second parent of a folder. A folder with more than
+        # one parent is written once, with the smallest of its full names
+        self._folders = {}
+        self._ids = []
+        self._names = []
+        self._parents = []
+
+        # the totals of the files with a single parent, by folder
+        self._bytes = array('q')
+        self._files = array('q')
+        self._newest = array('d')
+        # the files per type of every folder, by the index of the type
+        self._types = []
+        self._type_names = {}
+        # the files with more than one parent: (the ids of the parents, size, modifiedTime timestamp, type index)
+        self._shared_files = []
+
+        # the ids of the files already counted
+        self._counted = set()
+
+    def __len__(self):
+        return len(self._names)
+
+    def _folder(self, folder_id):
+        """
+        Gets the index of a folder, adding it when it is new
+
+        :param folder_id: the id of the folder
+        :return: the index of the folder
+        """
+        folder = self._folders.get(folder_id)
+        if folder is not None:
+            return folder
+
+        folder = len(self._ids)
+        self._folders[folder_id] = folder
+        self._ids.append(folder_id)
+        self._names.append(None)
+        self._parents.append(())
+        self._bytes.append(0)
+        self._files.append(0)
+        self._newest.append(0)
+        self._types.append({})
+        return folder
+
+    def add_top_folder(self, folder_id, name):
+        """
+        Adds a folder the exploration starts from, it has no row
+
+        :param folder_id: the id of the folder
+        :param name: the name of the folder, the full names of the rows below it start with it
+        """
+        self._names[self._folder(folder_id)] = name
+
+    def add(self, rows):
+        """
+        Adds the rows of the exploration to the totals of their folders
+
+        :param rows: the rows, as sent by the workers
+        """
+        for row in rows:
+            parents = tuple(row.get('parents') or ())
+            if row.get('mimeType') == FOLDER_MIME_TYPE:
+                # the rows of the same folder come in any order, the name does not depend on it
+                folder = self._folder(row['id'])
+                if self._names[folder] is None or row['name'] < self._names[folder]:
+                    self._names[folder] = row['name']
+                self._parents[folder] = parents
+                continue
+
+            if row['id'] in self._counted:
+                continue
+            self._counted.add(row['id'])
+
+            size = int(row.get('size') or 0)
+            newest = _timestamp(row['modifiedTime']) if row.get('modifiedTime') else 0
+            type_index = self._type_names.setdefault(row.get('mimeType'), len(self._type_names))
+            if len(parents) != 1:
+                self._shared_files.append((parents, size, newest, type_index))
+                continue
+
+            folder = self._folder(parents[0])
+            self._files[folder] += 1
+            self._bytes[folder] += size
+            self._newest[folder] = max(self._newest[folder], newest)
+            self._types[folder][type_index] = self._types[folder].get(type_index, 0) + 1
+
+    def _above(self, folder, above_folders):
+        """
+        Gets a folder and all the folders above it in the exploration, each one once even when it can be reached from
+        more than one parent
+
+        :param folder: the index of the folder
+        :param above_folders: the folders already computed, by index
+        :return: a frozenset of indexes
+        """
+        above = above_folders.get(folder)
+        if above is None:
+            above = {folder}
+            for parent_id in self._parents[folder]:
+                parent = self._folders.get(parent_id)
+                if parent is not None and self._names[parent] is not None:
+                    above.update(self._above(parent, above_folders))
+            above = above_folders[folder] = frozenset(above)
+        return above
+
+    def rows(self, chunk_size):
+        """
+        Adds the totals of every folder to the ones of the folders above it and gets the row of every folder, sorted
+        by full name and id
+
+        :param chunk_size: the number of rows of every list returned
+        :return: a generator of lists of rows
+        """
+        folders = [folder for folder in range(len(self._names)) if self._names[folder] is not None]
+        total_bytes = array('q', [0]) * len(self._names)
+        total_files = array('q', [0]) * len(self._names)
+        total_sub_folders = array('q', [0]) * len(self._names)
+        total_newest = array('d', [0]) * len(self._names)
+        total_types = [{} for _ in range(len(self._names))]
+
+        def add_to(above, files, size, newest, types):
+            for folder in above:
+                total_files[folder] += files
+                total_bytes[folder] += size
+                total_newest[folder] = max(total_newest[folder], newest)
+                folder_types = total_types[folder]
+                for type_index, count in types.items():
+                    folder_types[type_index] = folder_types.get(type_index, 0) + count
+
+        above_folders = {}
+        for folder in folders:
+            above = self._above(folder, above_folders)
+            add_to(above, self._files[folder], self._bytes[folder], self._newest[folder], self._types[folder])
+            for above_folder in above:
+                if above_folder != folder:
+                    total_sub_folders[above_folder] += 1
+
+        for parents, size, newest, type_index in self._shared_files:
+            above = set()
+            for parent_id in parents:
+                parent = self._folders.get(parent_id)
+                if parent is not None and self._names[parent] is not None:
+                    above.update(self._above(parent, above_folders))
+            add_to(above, 1, size, newest, {type_index: 1})
+
+        logger.info("Totals of {} folders with {} files computed".format(
+            len(folders), sum(self._files[folder] for folder in folders) + len(self._shared_files)))
+
+        type_names = sorted(self._type_names, key=self._type_names.get)
+        chunk = []
+        # two folders can have the same full name
+        for folder in sorted(folders, key=lambda folder: (self._names[folder], self._ids[folder])):
+            types = sorted(total_types[folder].items(),
+                           key=lambda type_count: (-type_count[1], type_names[type_count[0]] or ''))
+            chunk.append({
+                'id': self._ids[folder],
+                'name': self._names[folder],
+                'mimeType': FOLDER_MIME_TYPE,
+                'size': total_bytes[folder],
+                'files': total_files[folder],
+                'folders': total_sub_folders[folder],
+                'newestModifiedTime': _rfc3339(total_newest[folder]) if total_newest[folder] else None,
+                'mimeTypes': ', '.join('{}: {}'.format(type_names[type_index], count)
+                                       for type_index, count in types),
+                'parents': list(self._parents[folder]),
+                'permissions': [],
+            })
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
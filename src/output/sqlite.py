@@ -1,3 +1,4 @@
+import os
 import sqlite3
 from datetime import datetime
 from io import StringIO
@@ -29,6 +30,7 @@ class SQLiteOutput(output.base.AbstractOutput):
         self._editors_table_name = "{}_editors".format(self._table_prefix)
 
         # sqlite connection
+        self._path = f
         self._con = sqlite3.connect(f, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
         self._cur = self._con.cursor()
 
@@ -259,6 +261,8 @@ class SQLiteOutput(output.base.AbstractOutput):
 
         self._cur.execute('COMMIT')
         self._con.commit()
+        self.bytes_written = os.path.getsize(self._path)
 
     def close(self):
         self._con.close()
+        self.bytes_written = os.path.getsize(self._path)
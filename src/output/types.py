@@ -0,0 +1,3 @@
+# the output formats, by file extension. This module is imported at startup to build the help of the CLI, so it must
+# not import any output backend: they are imported by the writer only when needed
+supported_types = {'.csv', '.json', '.gs', '.gsheet', '.sqlite', '.sqlite3', '.tsv'}
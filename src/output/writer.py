@@ -1,55 +1,78 @@
 import multiprocessing
+import os
 import sys
 
-from time import sleep
+from time import perf_counter
 
-import output.csv
-import output.json
-import output.gsheet
-import output.sqlite
+from common import progress, stats, tracing
+from common.buffer import format_bytes
 from common.exceptions import UnkwonOutputType, manage_generic_exception
 from common.logging import get_logger
+from common.profiling import run_profiled
+from common.skeleton import SkeletonReconciler
+from output.types import supported_types
 
 logger = get_logger(__name__)
 
-supported_types = {'.csv', '.json', '.gs', '.gsheet', '.sqlite', '.sqlite3', '.tsv'}
-
 
 class OutputWriter(multiprocessing.Process):
-    def __init__(self, results_list, results_lock, restuls_finished, output_path, output_extension, log_level,
-                 email, credential_file, chuck_size=1_000):
-        self._results_list = results_list
-        self.results_lock = results_lock
+    def __init__(self, results_buffer, output_path, output_extension, log_level, token_broker, chuck_size=1_000,
+                 stats_collector=None, progress_counters=None, profile_dir=None, profile_sample_interval=0,
+                 trace_collector=None, skeleton_cache=None, request_policy=None, max_results=0, limit_reached=None,
+                 rollup=None, duplicates=None):
+        self._results_buffer = results_buffer
         self._chuck_size = chuck_size
-        self._restuls_finished = restuls_finished
         self._output_path = output_path
         self._output_extension = output_extension
         self._log_level = log_level
-        self._credential_file = credential_file
-        self._email = email
+        self._token_broker = token_broker
+        self._stats_collector = stats_collector
+        self._progress_counters = progress_counters
+        self._profile_dir = profile_dir
+        self._profile_sample_interval = profile_sample_interval
+        self._trace_collector = trace_collector
+        self._skeleton_cache = skeleton_cache
+        # the timeouts of the Google Sheets requests (see common.transport)
+        self._request_policy = request_policy
+        # with a limit, the rows above it are dropped and the workers are told to stop with the event
+        self._max_results = max_results
+        self._limit_reached = limit_reached
+        # the ids of the rows accepted: the backends write a file with more than one parent once, it takes one slot
+        self._accepted = set()
+        # with a FolderRollup the rows only update the totals of their folders, one row per folder is written
+        self._rollup = rollup
+        # with a DuplicateFinder only the rows of the files with the same content are written, once they are all there
+        self._duplicates = duplicates
 
         self._writer = None
+        # with a skeleton cache the workers send the rows of every folder, held until the folder is confirmed
+        self._skeleton = None
 
         super().__init__(daemon=False)
 
-    def _get_writer(self, file_type):
+    def _get_writer(self, file_type, fieldnames):
         if file_type not in supported_types:
             raise UnkwonOutputType("Output format not supported: {}. Use one of the following ones: {}."
                                    .format(file_type, ", ".join(supported_types)))
         else:
+            # the backends are imported only when used, e.g. the Sheets one needs the Google API client
             if file_type in {'.csv', '.tsv'}:
+                import output.csv
                 delimiter = ',' if file_type == '.csv' else '\t'
                 csv_file = open(self._output_path, 'w', newline='', encoding='utf-8-sig')
-                self._writer = output.csv.CsvOutput(csv_file, self._results_list[0].keys(), self._log_level,
+                self._writer = output.csv.CsvOutput(csv_file, fieldnames, self._log_level,
                                                     delimiter=delimiter)
             elif file_type in {'.gsheet', '.gs'}:
-                self._writer = output.gsheet.GSheetOutput(self._output_path, self._results_list[0].keys(),
-                                                          self._credential_file, self._email, self._log_level)
+                import output.gsheet
+                self._writer = output.gsheet.GSheetOutput(self._output_path, fieldnames,
+                                                          self._token_broker.credentials(), self._log_level)
             elif file_type in {'.json'}:
+                import output.json
                 json_file = open(self._output_path, 'w')
                 self._writer = output.json.JsonOutput(json_file)
             elif file_type in {'.sqlite', '.sqlite3'}:
-                self._writer = output.sqlite.SQLiteOutput(self._output_path, self._results_list[0].keys(),
+                import output.sqlite
+                self._writer = output.sqlite.SQLiteOutput(self._output_path, fieldnames,
                                                           self._log_level)
             else:
                 raise UnkwonOutputType("Output format not supported: {}. Use one of the following ones: {}."
@@ -57,47 +80,139 @@ class OutputWriter(multiprocessing.Process):
 
     def run(self):
         logger.setLevel(self._log_level)
+        if self._stats_collector is not None:
+            self._stats_collector.attach()
+        if self._progress_counters is not None:
+            self._progress_counters.attach(progress.WRITER_SLOT)
+        if self._trace_collector is not None:
+            self._trace_collector.attach(self.name)
+        if self._request_policy is not None:
+            self._request_policy.attach()
+
         try:
-            self._safe_run()
+            if self._profile_dir is None:
+                self._safe_run()
+            else:
+                run_profiled(self._safe_run, self._profile_dir, '{}-{}'.format(self.name, os.getpid()),
+                             self._profile_sample_interval)
         except KeyboardInterrupt:
             logger.debug("KeyboardInterrupt in OutputWriter.run")
         except Exception as e:
             manage_generic_exception(e, sys.exc_info(), "OutputWriter.run process")
+            # the workers can only exit once all their results have been consumed
+            self._results_buffer.drain()
+        finally:
+            if self._stats_collector is not None:
+                self._stats_collector.detach()
+            if self._trace_collector is not None:
+                self._trace_collector.detach()
+            if self._request_policy is not None:
+                self._request_policy.detach()
+
+    def _get_results(self):
+        with stats.timer('result_buffer_wait_seconds'):
+            rows = self._results_buffer.get()
+
+        # the batches that only hold rows or confirm folders are skipped, the caller expects rows
+        while self._skeleton is not None and rows is not None:
+            rows = self._skeleton.reconcile(rows)
+            if rows:
+                break
+            with stats.timer('result_buffer_wait_seconds'):
+                rows = self._results_buffer.get()
+        return rows
+
+    def _batches(self):
+        rows = self._get_results()
+        aggregate = self._rollup if self._rollup is not None else self._duplicates
+        if aggregate is None:
+            while rows is not None:
+                yield rows
+                rows = self._get_results()
+            return
+
+        # the totals of a folder, or the copies of a file, are complete only once all the rows are there
+        while rows is not None:
+            aggregate.add(rows)
+            rows = self._get_results()
+        yield from aggregate.rows(self._chuck_size)
+
+    def _write(self, rows):
+        writer_name = type(self._writer).__name__
+        stats.inc('writer_rows_total', len(rows), writer=writer_name)
+        with stats.timer('writer_writerows_seconds', writer=writer_name), \
+                tracing.span('writerows', 'writer', writer=writer_name, rows=len(rows)):
+            self._writer.writerows(rows)
+
+        progress.add('rows_written', len(rows))
+        self._report_bytes_written()
+
+    def _report_bytes_written(self):
+        # only file outputs have a size, for the others we have no cheap way to know what has been written
+        if self._writer.bytes_written is not None:
+            progress.set_value('bytes_written', self._writer.bytes_written)
+
+    def _limit(self, rows):
+        # the rows above the maximum number of results are dropped, the workers are told to stop once it is reached
+        if not self._max_results:
+            return rows
+
+        accepted_rows = []
+        for row in rows:
+            if row['id'] in self._accepted:
+                continue
+            if len(self._accepted) >= self._max_results:
+                break
+            self._accepted.add(row['id'])
+            accepted_rows.append(row)
+
+        if len(self._accepted) >= self._max_results and not self._limit_reached.is_set():
+            logger.info("{} results found, stopping the exploration".format(len(self._accepted)))
+            self._limit_reached.set()
+        return accepted_rows
 
     def _safe_run(self):
+        if self._skeleton_cache is not None:
+            self._skeleton = SkeletonReconciler(self._skeleton_cache)
+
         # to initialize the writer we need at least one result
-        while len(self._results_list) == 0:
-            sleep(0.1)
+        batches = self._batches()
+        rows = next(batches, None)
+        if rows is None:
+            logger.info("No results to write to {}".format(self._output_path))
+            if self._skeleton is not None:
+                self._skeleton.finish()
+            return
 
-        self._get_writer(self._output_extension)
+        dt_start = perf_counter()
+
+        self._get_writer(self._output_extension, rows[0].keys())
         self._writer.writeheader()
         buffer = []
 
-        while True:
-            if len(self._results_list) > 0:
-                logger.debug("self._results_list size from writer: {}".format(len(self._results_list)))
-
-                # we move the results from the multiprocessing list to our internal buffer
-                with self.results_lock:
-                    while len(self._results_list) > 0:
-                        buffer.append(self._results_list.pop())
-
-            # if we have too many rows we start to write them
-            if len(buffer) > self._chuck_size:
-                logger.debug("Dumping {} rows to output".format(len(buffer)))
-                self._writer.writerows(buffer)
+        while rows is not None:
+            # we move the results from the shared buffer to our internal one
+            buffer.extend(self._limit(rows))
+
+            # if we have too many rows we start to write them, the results are written as soon as they are all there
+            if len(buffer) > self._chuck_size or (buffer and self._limit_reached is not None
+                                                  and self._limit_reached.is_set()):
+                logger.debug("Dumping {} rows to output (buffer depth: {} batches, {} in memory, {} spilled)"
+                             .format(len(buffer), self._results_buffer.depth,
+                                     format_bytes(self._results_buffer.memory_bytes),
+                                     format_bytes(self._results_buffer.spilled_bytes)))
+                self._write(buffer)
                 buffer.clear()
 
-            if self._restuls_finished.is_set():
-                break
+            rows = next(batches, None)
 
         if len(buffer) > 0:
-            self._writer.writerows(buffer)
+            self._write(buffer)
             buffer.clear()
 
-        if len(self._results_list) > 0:
-            with self.results_lock:
-                self._writer.writerows(self._results_list)
-                self._results_list = []
-
         self._writer.close()
+        self._report_bytes_written()
+        stats.set_gauge('writer_active_seconds', perf_counter() - dt_start)
+
+        if self._skeleton is not None:
+            self._skeleton.finish()